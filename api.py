@@ -0,0 +1,320 @@
+"""
+HTTP 接口：供其他服务以编程方式提交PDF并获取故事
+
+    POST   /jobs              上传PDF（multipart 字段 file，可选 user、priority、vl_system_prompt、story_system_prompt、
+                              image_policy，用户也可由请求头 X-User-Id 指定），返回任务ID、排队位置和预计等待时间
+    GET    /jobs/{job_id}     查询任务状态，完成后包含故事内容和文件路径
+    GET    /jobs/{job_id}/events  SSE 事件流：progress（页面进度）、story（故事增量）、结束事件 done / failed / cancelled
+    DELETE /jobs/{job_id}     取消任务
+    GET    /stories           按时间倒序分页列出已保存的故事（可选 language、pdf_hash、limit、cursor）
+    GET    /stories/{story_id}    故事内容，以及同一本书的其他版本（其他语言、其他次生成）
+
+所有请求需带上请求头 Authorization: Bearer <Config.API_TOKEN>；未设置令牌时接口拒绝所有请求。
+priority 不超过 Config.API_MAX_PRIORITY，调用方不能把任务排到界面提交的任务前面。
+
+所有连接由同一个事件循环处理，不为每个请求创建线程；任务交给与界面共用的任务调度器（core/scheduler.py）
+排队执行，因此与界面共享执行名额、缓存、断点和模型限流器。
+"""
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, Request, UploadFile
+from fastapi.responses import StreamingResponse
+
+from core import FileHandler, JobScheduler, StateManager, StoryProcessor
+from core.config import Config
+from util.auth import check_bearer_token
+from util.logger import logger
+
+# 调度器的结束状态对应的事件类型
+TERMINAL_EVENTS = {JobScheduler.STATUS_SUCCEEDED: "done", JobScheduler.STATUS_FAILED: "failed",
+                   JobScheduler.STATUS_CANCELLED: "cancelled"}
+# SSE 连接空闲时发送保活注释的间隔（秒）
+SSE_HEARTBEAT_SECONDS = 15
+# 状态查询返回的任务字段
+JOB_FIELDS = ("job_id", "status", "user", "filename", "pages", "priority", "image_policy", "created_at",
+              "started_at", "finished_at", "story_path", "error", "position", "estimated_wait_s", "progress", "desc")
+
+
+class Job:
+    """接口侧的任务记录：进度、已生成的故事和按顺序记录的事件（供 SSE 重放）"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.status = JobScheduler.STATUS_QUEUED
+        self.progress = 0.0
+        self.desc = ""
+        self.story = ""
+        self.finished_at: Optional[float] = None
+        self.events: List[Dict] = []
+        self.subscribers = set()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in JobScheduler.FINISHED_STATUSES
+
+
+class JobManager:
+    """
+    在事件循环中跟踪任务事件
+
+    调度器的工作线程通过 call_soon_threadsafe 把任务事件投递到事件循环，
+    任务记录只在事件循环线程中修改，SSE 订阅者从各自的 asyncio.Queue 中读取。
+    """
+
+    def __init__(self, scheduler: JobScheduler, job_ttl: float = Config.API_JOB_TTL_SECONDS):
+        self.scheduler = scheduler
+        self.job_ttl = job_ttl
+        self.jobs: Dict[str, Job] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def submit(self, upload: UploadFile, **options) -> Dict:
+        """
+        把上传的PDF提交给调度器
+
+        Raises:
+            ValueError: PDF无法读取
+        """
+        self.loop = asyncio.get_running_loop()
+        self._prune()
+        job = Job(self.scheduler.story_processor.state_manager.generate_request_id())
+        self.jobs[job.job_id] = job
+        # 保留原文件名，生成的故事文件以其命名
+        filename = os.path.basename(upload.filename or "") or "upload.pdf"
+        try:
+            # 上传内容已由框架缓存在临时文件中，复制和读取页数不阻塞事件循环
+            return await self.loop.run_in_executor(None, self._submit_upload, upload.file, filename, job, options)
+        except Exception:
+            del self.jobs[job.job_id]
+            raise
+
+    def _submit_upload(self, source, filename: str, job: Job, options: Dict) -> Dict:
+        """
+        复制上传内容并提交任务；复制时一并计算内容哈希，提交时硬链接到调度器上传目录，不再读取文件。
+        提交失败时删除已放入调度器上传目录的PDF和已登记的请求状态
+        """
+        temp_dir = tempfile.mkdtemp(prefix="story_api_", dir=Config.TEMP_DIR)
+        try:
+            pdf_path = os.path.join(temp_dir, filename)
+            source.seek(0)
+            pdf_hash = FileHandler.save_stream(source, pdf_path)
+            return self.scheduler.submit(pdf_path, job_id=job.job_id, filename=filename,
+                                         listener=self._listener(job), pdf_hash=pdf_hash, **options)
+        except Exception:
+            shutil.rmtree(self.scheduler.upload_dir / job.job_id, ignore_errors=True)
+            self.scheduler.story_processor.state_manager.cleanup_request(job.job_id)
+            raise
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    async def attach(self, job_id: str) -> Job:
+        """
+        返回任务记录；不是通过接口提交的任务（界面提交或重启后恢复的任务）在首次订阅时开始跟踪，
+        之前的事件不会重放
+        """
+        self.loop = asyncio.get_running_loop()
+        job = self.jobs.get(job_id)
+        if job is None:
+            job = self.jobs[job_id] = Job(job_id)
+            if not self.scheduler.subscribe(job_id, self._listener(job)):
+                # 已结束的任务从任务表读取，不阻塞事件循环
+                info = await self.loop.run_in_executor(None, self.scheduler.get, job_id)
+                self._on_event(job, info["status"], info)
+        return job
+
+    def _listener(self, job: Job):
+        """调度器事件回调：在工作线程中调用，转交事件循环处理"""
+        return lambda event, data: self.loop.call_soon_threadsafe(self._on_event, job, event, data)
+
+    def _on_event(self, job: Job, event: str, data: Dict) -> None:
+        if job.finished:
+            return
+        if event == "status":
+            job.status = data["status"]
+            self._publish(job, "status", data)
+        elif event == "progress":
+            job.progress, job.desc = data["progress"], data["desc"]
+            self._publish(job, "progress", data)
+        elif event == "story":
+            # 调度器转发的是当前已生成的全部内容，只推送增量
+            story = data["story"]
+            if story.startswith(job.story) and len(story) > len(job.story):
+                self._publish(job, "story", {"delta": story[len(job.story):]})
+                job.story = story
+        elif event in TERMINAL_EVENTS:
+            job.status = event
+            job.finished_at = time.time()
+            if event == JobScheduler.STATUS_SUCCEEDED:
+                job.story = data.get("story", job.story)
+                job.progress = 1.0
+            self._publish(job, TERMINAL_EVENTS[event], self.describe(data))
+
+    def describe(self, info: Dict) -> Dict:
+        """调度器中的任务信息加上接口侧记录的进度和故事"""
+        data = {key: info[key] for key in JOB_FIELDS if info.get(key) is not None}
+        job = self.jobs.get(info["job_id"])
+        if job is not None and job.events:
+            data.update(progress=round(job.progress, 3), desc=job.desc, story_length=len(job.story))
+            if info["status"] == JobScheduler.STATUS_SUCCEEDED and job.story:
+                data["story"] = job.story
+        return data
+
+    def _publish(self, job: Job, event: str, data: Dict) -> None:
+        """记录事件并推送给所有订阅者（事件循环线程中调用）"""
+        record = {"id": len(job.events), "event": event, "data": data}
+        job.events.append(record)
+        for queue in job.subscribers:
+            queue.put_nowait(record)
+
+    def _prune(self) -> None:
+        """不再跟踪结束超过 job_ttl 的任务（任务表中的记录仍可查询）"""
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished and now - job.finished_at > self.job_ttl]:
+            del self.jobs[job_id]
+
+    async def stream(self, job: Job, last_event_id: int = -1):
+        """SSE 事件流：先重放 last_event_id 之后的历史事件，再推送新事件，任务结束后关闭"""
+        queue: asyncio.Queue = asyncio.Queue()
+        backlog = job.events[last_event_id + 1:]
+        finished = job.finished
+        if not finished:
+            job.subscribers.add(queue)
+        try:
+            for record in backlog:
+                yield _format_event(record)
+            if finished:
+                return
+            while True:
+                try:
+                    record = await asyncio.wait_for(queue.get(), SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _format_event(record)
+                if record["event"] in TERMINAL_EVENTS.values():
+                    return
+        finally:
+            job.subscribers.discard(queue)
+
+
+def _format_event(record: Dict) -> str:
+    data = json.dumps(record["data"], ensure_ascii=False)
+    return f"id: {record['id']}\nevent: {record['event']}\ndata: {data}\n\n"
+
+
+def create_api(scheduler: Optional[JobScheduler] = None, token: str = Config.API_TOKEN,
+               max_priority: int = Config.API_MAX_PRIORITY) -> FastAPI:
+    """
+    创建 HTTP 接口应用
+
+    Args:
+        scheduler: 与界面共用的任务调度器，为空时新建并启动一个
+        token: 访问令牌，请求需带上 Authorization: Bearer <令牌>；为空时拒绝所有请求
+        max_priority: 调用方可设置的最高优先级，超出时按此值排队
+    """
+    if not token:
+        logger.warning("未设置 Config.API_TOKEN，HTTP 接口将拒绝所有请求")
+
+    async def require_token(authorization: str = Header("")):
+        if not check_bearer_token(authorization, token):
+            raise HTTPException(status_code=401, detail="缺少或错误的访问令牌", headers={"WWW-Authenticate": "Bearer"})
+
+    scheduler = scheduler or JobScheduler(StoryProcessor(StateManager(), FileHandler())).start()
+    manager = JobManager(scheduler)
+    api = FastAPI(title="儿童故事生成器 API", dependencies=[Depends(require_token)])
+    api.state.jobs = manager
+
+    async def get_job(job_id: str) -> Dict:
+        # 已结束的任务需要查询任务表，不在事件循环线程中执行
+        info = await asyncio.get_running_loop().run_in_executor(None, scheduler.get, job_id)
+        if info is None:
+            raise HTTPException(status_code=404, detail="任务不存在")
+        return info
+
+    @api.post("/jobs", status_code=202)
+    async def create_job(file: UploadFile = File(...),
+                         user: str = Form(""),
+                         priority: int = Form(0),
+                         vl_system_prompt: str = Form(Config.DEFAULT_VL_SYSTEM_PROMPT),
+                         story_system_prompt: str = Form(Config.DEFAULT_STORY_SYSTEM_PROMPT),
+                         image_policy: str = Form(Config.DEFAULT_IMAGE_POLICY),
+                         x_user_id: str = Header("")):
+        if image_policy not in Config.IMAGE_POLICIES:
+            raise HTTPException(status_code=400, detail=f"未知的页面图片策略: {image_policy}")
+        try:
+            info = await manager.submit(file, user=user or x_user_id or "anonymous",
+                                        priority=min(priority, max_priority),
+                                        vl_system_prompt=vl_system_prompt, story_system_prompt=story_system_prompt,
+                                        image_policy=image_policy)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {**manager.describe(info), "events_url": f"/jobs/{info['job_id']}/events"}
+
+    @api.get("/jobs/{job_id}")
+    async def job_status(job_id: str):
+        return manager.describe(await get_job(job_id))
+
+    @api.get("/jobs/{job_id}/events")
+    async def job_events(job_id: str, request: Request):
+        await get_job(job_id)
+        job = await manager.attach(job_id)
+        # 断线重连时 EventSource 带上最后收到的事件ID，从其后继续推送
+        last_event_id = request.headers.get("last-event-id", "")
+        start = int(last_event_id) if last_event_id.isdigit() else -1
+        return StreamingResponse(manager.stream(job, start), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @api.delete("/jobs/{job_id}", status_code=202)
+    async def cancel_job(job_id: str):
+        await get_job(job_id)
+        await asyncio.get_running_loop().run_in_executor(None, scheduler.cancel, job_id)
+        return manager.describe(await get_job(job_id))
+
+    story_store = scheduler.story_processor.file_handler.story_store
+
+    @api.get("/stories")
+    async def list_stories(limit: int = 50, cursor: Optional[str] = None, language: Optional[str] = None,
+                           pdf_hash: Optional[str] = None):
+        try:
+            items, next_cursor = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: story_store.list(limit, cursor, language, pdf_hash))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="无效的分页游标")
+        return {"items": items, "next_cursor": next_cursor}
+
+    @api.get("/stories/{story_id}")
+    async def get_story(story_id: int):
+        def load():
+            story = story_store.get(story_id)
+            if story is None:
+                return None
+            return {**story, "content": story_store.read(story), "versions": story_store.versions(story["book_id"])}
+
+        story = await asyncio.get_running_loop().run_in_executor(None, load)
+        if story is None:
+            raise HTTPException(status_code=404, detail="故事不存在")
+        return story
+
+    @api.get("/healthz")
+    async def healthz():
+        return {"status": "ok", **scheduler.stats()}
+
+    return api
+
+
+def start_api_server(scheduler: Optional[JobScheduler] = None, host: str = Config.API_HOST,
+                     port: int = Config.API_PORT):
+    """在后台线程中启动 HTTP 接口（与界面在同一进程内，共享调度器、缓存和限流器）"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(create_api(scheduler), host=host, port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="api-server", daemon=True).start()
+    logger.info(f"HTTP API: http://{host}:{port}/jobs")
+    return server
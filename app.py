@@ -1,14 +1,106 @@
+import time
+
 import gradio as gr
-from core import StateManager, FileHandler, StoryProcessor
+from core import StateManager, FileHandler, JobScheduler, StoryProcessor
 from core.config import Config
-from util import get_log_contents
+from llm import limiter_stats
+from util import metrics, read_log
+from util.logger import LOG_LEVELS
+
+STAGE_HEADERS = ["阶段", "次数", "错误", "平均(s)", "p50(s)", "p95(s)", "最大(s)"]
+SPAN_HEADERS = ["时间", "请求ID", "阶段", "耗时(s)", "出错", "其他信息"]
+# 日志页面显示的最多记录条数
+LOG_VIEW_LINES = 200
+ALL_LEVELS = "全部"
+
+
+def get_performance_stats(request_id: str = "", scheduler: JobScheduler = None):
+    """汇总各阶段耗时、token 用量、模型限流状态和任务队列，可按请求ID查看最近的耗时记录"""
+    stages = [[row["stage"], row["count"], row["errors"], row["avg_s"], row["p50_s"], row["p95_s"], row["max_s"]]
+              for row in metrics.summary()]
+    overview = {"tokens": metrics.token_totals(), "limiters": limiter_stats(),
+                "cancellations": metrics.cancellation_totals(), "filtered_pages": metrics.filtered_page_totals()}
+    if scheduler is not None:
+        overview["scheduler"] = scheduler.stats()
+    spans = []
+    for span in metrics.spans(request_id.strip() or None):
+        extra = {k: v for k, v in span.items() if k not in ("stage", "request_id", "seconds", "error", "time")}
+        spans.append([time.strftime("%H:%M:%S", time.localtime(span["time"])), span["request_id"] or "",
+                      span["stage"], span["seconds"], "是" if span["error"] else "", str(extra) if extra else ""])
+    return stages, overview, spans
+
+
+def load_logs(request_id: str = "", level: str = ALL_LEVELS):
+    """
+    从日志文件末尾读取最近的记录
+
+    Returns:
+        (日志文本, 日志页面状态)。状态记录下次增量读取的位置和读取时使用的过滤条件
+    """
+    request_id = request_id.strip()
+    text, offset = read_log(LOG_VIEW_LINES, request_id=request_id or None,
+                            level=None if level == ALL_LEVELS else level)
+    return text, (offset, request_id, level)
+
+
+def refresh_logs(current: str, log_state, request_id: str = "", level: str = ALL_LEVELS):
+    """
+    只读取上次位置之后新增的记录并追加到当前内容，保留最近 LOG_VIEW_LINES 行
+
+    过滤条件与上次读取时不同（如输入请求ID后没有按回车就点击刷新）时重新从文件末尾读取，
+    不把新条件的记录接在旧条件的内容后面。
+    """
+    request_id = request_id.strip()
+    if log_state is None or log_state[0] is None or tuple(log_state[1:]) != (request_id, level):
+        return load_logs(request_id, level)
+    text, offset = read_log(LOG_VIEW_LINES, log_state[0], request_id=request_id or None,
+                            level=None if level == ALL_LEVELS else level)
+    lines = (current + text).splitlines()[-LOG_VIEW_LINES:]
+    return "\n".join(lines) + ("\n" if lines else ""), (offset, request_id, level)
+
+
+def scheduling_user(request: gr.Request) -> str:
+    """
+    公平调度使用的用户标识：登录用户名加浏览器会话
+
+    界面的所有使用者共用同一个登录账号，只按用户名区分时所有界面任务都算同一个用户，
+    因此再按会话区分，每个浏览器会话在调度中各自轮转。
+    """
+    session = request.session_hash or "anonymous"
+    return f"{request.username}:{session}" if request.username else session
+
 
 # 创建Gradio界面
-def create_interface():
-    """创建Gradio界面"""
-    state_manager = StateManager()
-    file_handler = FileHandler()
-    story_processor = StoryProcessor(state_manager, file_handler)
+def create_interface(scheduler: JobScheduler = None):
+    """
+    创建Gradio界面
+
+    Args:
+        scheduler: 任务调度器，与 HTTP 接口共用时传入，为空时新建并启动一个
+    """
+    scheduler = scheduler or JobScheduler(StoryProcessor(StateManager(), FileHandler())).start()
+    story_processor = scheduler.story_processor
+    state_manager = story_processor.state_manager
+
+    # 界面提交的任务与 HTTP 接口的任务一起排队，以请求ID作为任务ID，登录用户名加会话作为公平调度的用户。
+    # 界面事件通过带 gr.Progress 默认参数的函数调用，Gradio 据此注入进度条
+    def process_pdf(pdf_file, request_id, vl_system_prompt, story_system_prompt, image_policy,
+                    request: gr.Request, progress=gr.Progress(), retry_failed=False):
+        yield from scheduler.stream(progress=progress, pdf_file=pdf_file, job_id=request_id,
+                                    user=scheduling_user(request),
+                                    vl_system_prompt=vl_system_prompt, story_system_prompt=story_system_prompt,
+                                    image_policy=image_policy, retry_failed=retry_failed)
+
+    def retry_failed_pages(pdf_file, request_id, vl_system_prompt, story_system_prompt, image_policy,
+                           request: gr.Request, progress=gr.Progress()):
+        yield from process_pdf(pdf_file, request_id, vl_system_prompt, story_system_prompt, image_policy,
+                               request, progress, retry_failed=True)
+
+    def stop_generation(request_id):
+        """排队中的任务直接取消，执行中的任务在下一个检查点停止"""
+        if scheduler.cancel(request_id):
+            return "正在停止生成过程..."
+        return state_manager.stop_generation(request_id)
     
     with gr.Blocks(title="儿童故事生成器", theme=gr.themes.Soft()) as demo:
         # 创建界面组件
@@ -21,6 +113,7 @@ def create_interface():
                         with gr.Row():
                             submit_btn = gr.Button("🔮 生成故事", variant="primary", size="lg")
                             stop_btn = gr.Button("⏹️ 停止生成", variant="stop", size="lg")
+                            retry_btn = gr.Button("🔁 重试失败页面", variant="secondary", size="lg")
                             chinese_file_output = gr.File(label="中文故事文件", visible=True)
                             english_file_output = gr.File(label="英文故事文件", visible=True)
                         
@@ -72,19 +165,49 @@ def create_interface():
                         - 角色塑造和互动元素
                         """)
             
+                with gr.Row():
+                    with gr.Column(scale=1):
+                        image_policy_input = gr.Dropdown(
+                            label="页面图片策略",
+                            choices=list(Config.IMAGE_POLICIES.keys()),
+                            value=Config.DEFAULT_IMAGE_POLICY
+                        )
+                    with gr.Column(scale=1):
+                        gr.Markdown("""
+                        ### 页面图片策略说明
+                        
+                        控制发送给图片识别模型的页面图片尺寸和格式。较小的尺寸和有损格式（JPEG/WebP）可以明显减少上传时间和图片token消耗，
+                        但文字较小的页面可能识别得不够准确。超大页面会自动缩小到策略允许的尺寸。
+                        """)
+            
             # 系统日志标签页
             with gr.TabItem("系统日志"):
-                refresh_log_btn = gr.Button("刷新日志")
+                with gr.Row():
+                    log_request_id_input = gr.Textbox(label="请求ID（留空显示所有请求）", scale=3)
+                    log_level_input = gr.Dropdown(label="最低级别", choices=[ALL_LEVELS] + list(LOG_LEVELS),
+                                                  value=ALL_LEVELS, scale=1)
+                    refresh_log_btn = gr.Button("刷新日志", scale=1)
                 system_log_output = gr.Textbox(
                     label="系统日志",
                     lines=20,
-                    value=get_log_contents(),
                     interactive=False
                 )
+                # 上次读取到的日志文件位置和当时的过滤条件，刷新时只读取新增内容
+                log_state = gr.State(None)
+
+            # 性能统计标签页
+            with gr.TabItem("性能"):
+                with gr.Row():
+                    perf_request_id_input = gr.Textbox(label="请求ID（留空显示所有请求）", scale=3)
+                    refresh_perf_btn = gr.Button("刷新统计", scale=1)
+                stage_stats_output = gr.Dataframe(headers=STAGE_HEADERS, label="各阶段耗时", interactive=False)
+                perf_overview_output = gr.JSON(label="Token 用量、模型限流状态与任务队列")
+                span_output = gr.Dataframe(headers=SPAN_HEADERS, label="最近的耗时记录", interactive=False)
+                gr.Markdown(f"Prometheus 格式的统计数据: `http://<服务器地址>:{Config.METRICS_PORT}/metrics`")
         
         # 添加事件处理
         stop_btn.click(
-            fn=state_manager.stop_generation,
+            fn=stop_generation,
             inputs=[request_id_output],
             outputs=[stop_status]
         )
@@ -94,9 +217,23 @@ def create_interface():
             inputs=[],
             outputs=[request_id_output],
         ).then(
-            fn=story_processor.process_pdf,
-            inputs=[pdf_input, request_id_output, vl_system_prompt_input, story_system_prompt_input],
-            outputs=[story_output, chinese_file_output]
+            fn=process_pdf,
+            inputs=[pdf_input, request_id_output, vl_system_prompt_input, story_system_prompt_input,
+                    image_policy_input],
+            outputs=[story_output, chinese_file_output],
+            show_progress="minimal"
+        )
+        
+        retry_btn.click(
+            fn=state_manager.generate_request_id,
+            inputs=[],
+            outputs=[request_id_output],
+        ).then(
+            fn=retry_failed_pages,
+            inputs=[pdf_input, request_id_output, vl_system_prompt_input, story_system_prompt_input,
+                    image_policy_input],
+            outputs=[story_output, chinese_file_output],
+            show_progress="minimal"
         )
         
         pdf_input.change(
@@ -111,10 +248,30 @@ def create_interface():
             outputs=[story_output_english, english_file_output]
         )
         
+        refresh_perf_btn.click(
+            fn=lambda request_id: get_performance_stats(request_id, scheduler),
+            inputs=[perf_request_id_input],
+            outputs=[stage_stats_output, perf_overview_output, span_output]
+        )
+
         refresh_log_btn.click(
-            fn=get_log_contents,
-            inputs=[],
-            outputs=[system_log_output]
+            fn=refresh_logs,
+            inputs=[system_log_output, log_state, log_request_id_input, log_level_input],
+            outputs=[system_log_output, log_state]
+        )
+
+        # 修改过滤条件时重新从文件末尾读取
+        gr.on(
+            triggers=[log_request_id_input.submit, log_level_input.change],
+            fn=load_logs,
+            inputs=[log_request_id_input, log_level_input],
+            outputs=[system_log_output, log_state]
+        )
+
+        demo.load(
+            fn=load_logs,
+            inputs=[log_request_id_input, log_level_input],
+            outputs=[system_log_output, log_state]
         )
         
         # 添加使用说明
@@ -133,6 +290,8 @@ def create_interface():
             - 请确保PDF文件包含清晰的页面
             - 生成的故事会根据页面内容自动创建，适合2-8岁儿童阅读
             - 自定义系统提示可以改变故事的风格和内容
+            - 处理中断或生成失败后重新点击"生成故事"，已识别的页面会从断点继续，不再重复识别
+            - 个别页面识别失败时，可点击"重试失败页面"只重新识别这些页面并重新生成故事
             """)
         
         gr.Markdown("---")
@@ -0,0 +1,83 @@
+"""
+页面图片策略基准测试
+
+对每种页面图片策略统计单页字节数、渲染编码耗时，以及发送到本地桩服务的往返延迟。
+
+用法:
+    python -m bench.image_policy book.pdf --latency 0.2 --bandwidth 2000000
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+import fitz
+
+from bench.mock_server import MockOpenAIServer
+from core.config import Config
+from llm import get_text_from_image
+from util import ImagePolicy
+
+
+def run_policy(pdf_file: str, name: str, policy: ImagePolicy, max_pages: int) -> dict:
+    """使用一种策略处理PDF的前 max_pages 页，返回统计结果"""
+    sizes, encode_times, round_trips = [], [], []
+    with fitz.open(pdf_file) as pdf_document:
+        for page_num in range(min(max_pages, pdf_document.page_count)):
+            start = time.perf_counter()
+            image_bytes = policy.render(pdf_document[page_num])
+            encode_times.append(time.perf_counter() - start)
+            sizes.append(len(image_bytes))
+
+            messages = [{"role": "system", "content": [{"type": "text", "text": Config.DEFAULT_VL_SYSTEM_PROMPT}]}]
+            start = time.perf_counter()
+            get_text_from_image(image_bytes, page_num, messages)
+            round_trips.append(time.perf_counter() - start)
+
+    return {
+        "policy": name,
+        "pages": len(sizes),
+        "bytes_per_page": statistics.mean(sizes),
+        "encode_ms_per_page": statistics.mean(encode_times) * 1000,
+        "round_trip_ms_p50": statistics.median(round_trips) * 1000,
+        "round_trip_ms_max": max(round_trips) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="页面图片策略基准测试")
+    parser.add_argument("pdf", help="用于测试的PDF文件")
+    parser.add_argument("--policies", nargs="*", default=list(Config.IMAGE_POLICIES.keys()),
+                        help="要测试的策略名称，默认测试 Config.IMAGE_POLICIES 中的全部策略")
+    parser.add_argument("--pages", type=int, default=10, help="每种策略最多处理的页数")
+    parser.add_argument("--latency", type=float, default=0.2, help="桩服务每个请求的固定延迟（秒）")
+    parser.add_argument("--bandwidth", type=float, default=None, help="模拟的上行带宽（字节/秒）")
+    parser.add_argument("--json", dest="json_path", help="将结果写入JSON文件")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(latency=args.latency, bandwidth=args.bandwidth).start()
+    # 客户端在首次创建时读取接口地址，需要在第一次调用前指向桩服务
+    os.environ["DASHSCOPE_BASE_URL"] = server.url
+    os.environ.setdefault("DASHSCOPE_API_KEY", "mock")
+
+    results = []
+    try:
+        for name in args.policies:
+            policy = ImagePolicy.from_config(Config.IMAGE_POLICIES[name])
+            results.append(run_policy(args.pdf, name, policy, args.pages))
+    finally:
+        server.stop()
+
+    print(f"{'policy':<12}{'pages':>6}{'KB/page':>10}{'encode ms':>12}{'RTT p50 ms':>12}{'RTT max ms':>12}")
+    for r in results:
+        print(f"{r['policy']:<12}{r['pages']:>6}{r['bytes_per_page'] / 1024:>10.1f}"
+              f"{r['encode_ms_per_page']:>12.1f}{r['round_trip_ms_p50']:>12.1f}{r['round_trip_ms_max']:>12.1f}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+本地 OpenAI 兼容接口桩服务
+
+支持可配置的延迟分布、上行带宽、流式输出（SSE）以及 429 限流注入，用于离线基准测试。
+
+用法:
+    python -m bench.mock_server --port 8765 --latency 0.5 --distribution lognormal --jitter 0.4 --error-rate 0.05
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+# 生成回复内容用的字符，回复长度可配置，便于测试分段翻译等与文本长度相关的环节
+REPLY_TEXT = "小熊和小兔在森林里找到了一只迷路的小鸟，它们决定一起送小鸟回家。"
+# 每张图片计入的 prompt token 数（VL 模型按图片分块计费，与 base64 体积无关）
+IMAGE_TOKENS = 1200
+
+
+def count_prompt_tokens(body: dict) -> int:
+    """粗略估计 prompt token 数：文本按 4 字符 1 token，图片按 IMAGE_TOKENS 计"""
+    tokens = 0
+    for message in body.get("messages", []):
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        for part in parts:
+            if part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS
+            else:
+                tokens += len(part.get("text") or "") // 4
+    return tokens
+
+
+class MockOpenAIServer:
+    """本地 OpenAI 兼容接口桩服务，用于离线测量请求体大小、往返延迟和吞吐"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.2,
+                 bandwidth: Optional[float] = None, distribution: str = "fixed", jitter: float = 0.0,
+                 error_rate: float = 0.0, max_concurrency: Optional[int] = None, retry_after: float = 1.0,
+                 reply_chars: int = 40, stream_chunks: int = 8, chunk_interval: float = 0.02,
+                 seed: Optional[int] = None):
+        """
+        Args:
+            host: 监听地址
+            port: 监听端口，0 表示随机端口
+            latency: 每个请求的处理延迟（秒），各分布下为中位数或均值
+            bandwidth: 模拟的上行带宽（字节/秒），None 表示不限速
+            distribution: 延迟分布，见 LATENCY_DISTRIBUTIONS
+            jitter: uniform 分布的半宽（秒），lognormal 分布的 sigma
+            error_rate: 随机返回 429 的概率
+            max_concurrency: 同时处理的请求数上限，超出时返回 429，None 表示不限制
+            retry_after: 429 响应中 Retry-After 头的秒数
+            reply_chars: 回复内容的字符数
+            stream_chunks: 流式输出时分成的数据块数
+            chunk_interval: 流式输出时数据块之间的间隔（秒）
+            seed: 随机数种子，便于重复测试
+        """
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.distribution = distribution
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.retry_after = retry_after
+        self.reply_chars = reply_chars
+        self.stream_chunks = max(1, stream_chunks)
+        self.chunk_interval = chunk_interval
+        self.requests = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockOpenAIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "throttled": self.throttled,
+                    "bytes_received": self.bytes_received, "bytes_sent": self.bytes_sent}
+
+    def sample_latency(self) -> float:
+        """按配置的分布采样一次处理延迟"""
+        with self._lock:
+            if self.distribution == "uniform":
+                return max(0.0, self._random.uniform(self.latency - self.jitter, self.latency + self.jitter))
+            if self.distribution == "exponential":
+                return self._random.expovariate(1 / self.latency) if self.latency > 0 else 0.0
+            if self.distribution == "lognormal":
+                return self.latency * self._random.lognormvariate(0, self.jitter)
+            return self.latency
+
+    def _admit(self, size: int) -> bool:
+        """登记一个请求，需要注入 429 时返回 False"""
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += size
+            if (self.max_concurrency is not None and self.in_flight >= self.max_concurrency) \
+                    or self._random.random() < self.error_rate:
+                self.throttled += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def _finish(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def _sent(self, size: int) -> None:
+        with self._lock:
+            self.bytes_sent += size
+
+    def reply_text(self, body: dict) -> str:
+        """生成回复内容：长度为 reply_chars，开头注明消息条数，便于确认上下文是否正确"""
+        prefix = f"mock reply to {len(body.get('messages', []))} messages。"
+        text = (REPLY_TEXT * (self.reply_chars // len(REPLY_TEXT) + 1))[:max(0, self.reply_chars - len(prefix))]
+        return prefix + text
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, payload: bytes, content_type: str = "application/json",
+                      headers: Optional[dict] = None) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+                server._sent(len(payload))
+
+            def _write_chunk(self, data: bytes) -> None:
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+                server._sent(len(data))
+
+            def do_POST(self):
+                length = int(self.headers.get("content-length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not server._admit(length):
+                    error = {"error": {"message": "Requests rate limit exceeded", "type": "rate_limit_error",
+                                       "code": "Throttling.RateQuota"}}
+                    self._send(429, json.dumps(error).encode("utf-8"),
+                               headers={"Retry-After": str(server.retry_after)})
+                    return
+
+                try:
+                    delay = server.sample_latency()
+                    if server.bandwidth:
+                        delay += length / server.bandwidth
+                    time.sleep(delay)
+
+                    content = server.reply_text(body)
+                    prompt_tokens = count_prompt_tokens(body)
+                    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content),
+                             "total_tokens": prompt_tokens + len(content)}
+                    if body.get("stream"):
+                        self._stream(body, content, usage)
+                        return
+                    payload = json.dumps({
+                        "id": "mock",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": body.get("model", "mock"),
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": content}}],
+                        "usage": usage,
+                    }).encode("utf-8")
+                    self._send(200, payload)
+                finally:
+                    server._finish()
+
+            def _stream(self, body: dict, content: str, usage: dict) -> None:
+                """以 SSE 分块返回回复，请求了 include_usage 时在最后一个数据块中返回用量"""
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def event(choices, chunk_usage=None):
+                    data = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                            "model": body.get("model", "mock"), "choices": choices, "usage": chunk_usage}
+                    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+                size = -(-len(content) // server.stream_chunks)
+                try:
+                    for i in range(0, len(content), size):
+                        delta = {"content": content[i:i + size]}
+                        if i == 0:
+                            delta["role"] = "assistant"
+                        self._write_chunk(event([{"index": 0, "delta": delta, "finish_reason": None}]))
+                        time.sleep(server.chunk_interval)
+                    self._write_chunk(event([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+                    if (body.get("stream_options") or {}).get("include_usage"):
+                        self._write_chunk(event([], usage))
+                    self._write_chunk(b"data: [DONE]\n\n")
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端提前关闭了数据流（例如用户停止生成）
+                    self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容接口桩服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="每个请求的处理延迟（秒）")
+    parser.add_argument("--distribution", choices=LATENCY_DISTRIBUTIONS, default="fixed", help="延迟分布")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform 的半宽或 lognormal 的 sigma")
+    parser.add_argument("--bandwidth", type=float, default=None, help="模拟的上行带宽（字节/秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机返回 429 的概率")
+    parser.add_argument("--max-concurrency", type=int, default=None, help="超出该并发时返回 429")
+    parser.add_argument("--reply-chars", type=int, default=40, help="回复内容的字符数")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(args.host, args.port, latency=args.latency, bandwidth=args.bandwidth,
+                              distribution=args.distribution, jitter=args.jitter, error_rate=args.error_rate,
+                              max_concurrency=args.max_concurrency, reply_chars=args.reply_chars)
+    print(f"Mock OpenAI server listening on {server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
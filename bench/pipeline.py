@@ -0,0 +1,285 @@
+"""
+流水线基准测试
+
+使用本地桩服务和合成绘本PDF，在 1..N 个并发用户下分别测量页面渲染、StoryProcessor.process_pdf
+和 translate_to_english，报告 p50/p95 延迟、pages/sec、峰值内存和发送字节数，并写入JSON，
+可与之前的结果比较以发现性能退化。
+
+用法:
+    python -m bench.pipeline --pages 10 --users 1 2 4 --latency 0.3 --json results.json
+    python -m bench.pipeline --pages 10 --users 1 2 4 --compare results.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence
+
+from bench.mock_server import LATENCY_DISTRIBUTIONS, MockOpenAIServer
+from bench.synthetic_pdf import PAGE_SIZES, make_picture_book
+
+SCENARIOS = ("render", "process_pdf", "translate")
+
+
+class RssSampler:
+    """在后台线程中定期采样进程常驻内存，记录采样期间的峰值"""
+
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current_rss() -> int:
+        """当前常驻内存（字节），不支持 /proc 的系统退回到进程历史峰值"""
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "RssSampler":
+        self.peak = self.current_rss()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current_rss())
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """线性插值分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def run_concurrent(func: Callable, inputs: List, users: int) -> Dict:
+    """由 users 个并发用户依次处理 inputs，返回每个操作的耗时、结果和总耗时"""
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            result = func(item)
+            return result, time.perf_counter() - start, None
+        except Exception as e:
+            return None, time.perf_counter() - start, repr(e)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users, thread_name_prefix="bench-user") as executor:
+        outcomes = list(executor.map(timed, inputs))
+    return {
+        "elapsed": time.perf_counter() - start,
+        "results": [result for result, _, _ in outcomes],
+        "latencies": [latency for _, latency, error in outcomes if error is None],
+        "errors": [error for _, _, error in outcomes if error is not None],
+    }
+
+
+def run_scenario(name: str, users: int, func: Callable, inputs: List, pages_per_op: int,
+                 server: MockOpenAIServer) -> Dict:
+    """运行一个场景并汇总统计结果"""
+    before = server.stats()
+    with RssSampler() as sampler:
+        outcome = run_concurrent(func, inputs, users)
+    after = server.stats()
+    completed = len(outcome["latencies"])
+    return {
+        "scenario": name,
+        "users": users,
+        "ops": len(inputs),
+        "errors": len(outcome["errors"]),
+        "error_samples": outcome["errors"][:3],
+        "elapsed_s": round(outcome["elapsed"], 3),
+        "p50_s": round(percentile(outcome["latencies"], 0.5), 3),
+        "p95_s": round(percentile(outcome["latencies"], 0.95), 3),
+        "pages_per_sec": round(completed * pages_per_op / outcome["elapsed"], 3) if pages_per_op else None,
+        "peak_rss_mb": round(sampler.peak / 1024 / 1024, 1),
+        "bytes_sent": after["bytes_received"] - before["bytes_received"],
+        "llm_requests": after["requests"] - before["requests"],
+        "throttled": after["throttled"] - before["throttled"],
+        "_results": outcome["results"],
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict], baseline_path: str, threshold: float) -> bool:
+    """
+    与之前的结果比较，打印 p95 延迟和 pages/sec 的变化
+
+    Returns:
+        bool: 是否存在超过阈值的退化
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(r["scenario"], r["users"]): r for r in json.load(f)["results"]}
+    regressed = False
+    print(f"\n与 {baseline_path} 比较（阈值 {threshold:.0%}）:")
+    for r in results:
+        base = baseline.get((r["scenario"], r["users"]))
+        if base is None:
+            continue
+        changes = []
+        if base["p95_s"]:
+            delta = (r["p95_s"] - base["p95_s"]) / base["p95_s"]
+            changes.append(f"p95 {delta:+.1%}")
+            regressed |= delta > threshold
+        if base.get("pages_per_sec"):
+            delta = (r["pages_per_sec"] - base["pages_per_sec"]) / base["pages_per_sec"]
+            changes.append(f"pages/sec {delta:+.1%}")
+            regressed |= delta < -threshold
+        print(f"  {r['scenario']:<12} users={r['users']:<3} " + ", ".join(changes))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流水线基准测试（本地桩服务 + 合成PDF）")
+    parser.add_argument("--scenarios", nargs="*", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--users", type=int, nargs="*", default=[1, 2, 4], help="并发用户数")
+    parser.add_argument("--pages", type=int, default=10, help="每本合成PDF的页数")
+    parser.add_argument("--page-size", choices=list(PAGE_SIZES.keys()), default="landscape")
+    parser.add_argument("--image-size", type=int, default=600, help="每页插图的像素边长")
+    parser.add_argument("--image-policy", default=None, help="页面图片策略，默认使用 Config.DEFAULT_IMAGE_POLICY")
+    parser.add_argument("--parallel", action="store_true", help="开启并发页面识别 (Config.VL_PARALLEL)")
+    parser.add_argument("--with-caches", action="store_true", help="保留各级缓存和断点（默认关闭以测量未缓存的性能）")
+    parser.add_argument("--latency", type=float, default=0.3, help="桩服务每个请求的延迟（秒）")
+    parser.add_argument("--distribution", choices=LATENCY_DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--jitter", type=float, default=0.3, help="uniform 的半宽或 lognormal 的 sigma")
+    parser.add_argument("--bandwidth", type=float, default=None, help="模拟的上行带宽（字节/秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="桩服务随机返回 429 的概率")
+    parser.add_argument("--reply-chars", type=int, default=200, help="桩服务回复的字符数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", help="将结果写入JSON文件")
+    parser.add_argument("--compare", help="与之前写入的JSON结果比较")
+    parser.add_argument("--threshold", type=float, default=0.1, help="判定为退化的相对变化")
+    parser.add_argument("--verbose", action="store_true", help="显示流水线日志和输出")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(latency=args.latency, distribution=args.distribution, jitter=args.jitter,
+                              bandwidth=args.bandwidth, error_rate=args.error_rate,
+                              reply_chars=args.reply_chars, seed=args.seed).start()
+    # 客户端在首次创建时读取接口地址，需要在导入并调用模型之前指向桩服务
+    os.environ["DASHSCOPE_BASE_URL"] = server.url
+    os.environ["DASHSCOPE_API_KEY"] = "mock"
+
+    from core.config import Config
+    Config.VL_PARALLEL = args.parallel
+    if not args.with_caches:
+        Config.CAPTION_CACHE_ENABLED = False
+        Config.BOOK_CACHE_ENABLED = False
+        Config.TRANSLATION_CACHE_ENABLED = False
+        Config.PAGE_CHECKPOINT_ENABLED = False
+    from core import FileHandler, StateManager, StoryProcessor
+    from util import ImagePolicy, logger, pdf_iter_page_images
+
+    image_policy = args.image_policy or Config.DEFAULT_IMAGE_POLICY
+    policy = ImagePolicy.from_config(Config.IMAGE_POLICIES[image_policy])
+    state_manager = StateManager()
+    story_processor = StoryProcessor(state_manager, FileHandler())
+
+    def render(pdf_file: str) -> int:
+        return sum(1 for _ in pdf_iter_page_images(pdf_file, dst_images_dir=None, in_memory=True,
+                                                   image_policy=policy, prefetch=Config.RENDER_PREFETCH))
+
+    def process(pdf_file: str) -> str:
+        request_id = state_manager.generate_request_id()
+        story, story_path = None, None
+        for story, story_path in story_processor.process_pdf(pdf_file, request_id, image_policy=image_policy,
+                                                              progress=None):
+            pass
+        if story_path is None:
+            raise RuntimeError(story)
+        return story
+
+    def translate(story: str) -> str:
+        translated, english_path = story_processor.translate_to_english(story)
+        if english_path is None:
+            raise RuntimeError(translated)
+        return translated
+
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+
+    results = []
+    max_users = max(args.users)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # 每个用户使用内容不同的书，避免相同任务合并和缓存命中
+            pdfs = [make_picture_book(os.path.join(temp_dir, f"book_{i}.pdf"), args.pages, args.page_size,
+                                      args.image_size, seed=args.seed + i) for i in range(max_users)]
+            for users in args.users:
+                stories = None
+                with quiet:
+                    if "render" in args.scenarios:
+                        results.append(run_scenario("render", users, render, pdfs[:users], args.pages, server))
+                    if "process_pdf" in args.scenarios or "translate" in args.scenarios:
+                        result = run_scenario("process_pdf", users, process, pdfs[:users], args.pages, server)
+                        stories = [story for story in result["_results"] if story]
+                        if "process_pdf" in args.scenarios:
+                            results.append(result)
+                    if "translate" in args.scenarios and stories:
+                        results.append(run_scenario("translate", users, translate, stories, 0, server))
+    finally:
+        server.stop()
+
+    for result in results:
+        result.pop("_results")
+    print(f"{'scenario':<12}{'users':>6}{'ops':>5}{'err':>5}{'p50 s':>9}{'p95 s':>9}{'pages/s':>9}"
+          f"{'RSS MB':>9}{'KB sent':>10}{'429':>5}")
+    for r in results:
+        pages_per_sec = f"{r['pages_per_sec']:>9.2f}" if r["pages_per_sec"] is not None else f"{'-':>9}"
+        print(f"{r['scenario']:<12}{r['users']:>6}{r['ops']:>5}{r['errors']:>5}{r['p50_s']:>9.3f}{r['p95_s']:>9.3f}"
+              f"{pages_per_sec}{r['peak_rss_mb']:>9.1f}{r['bytes_sent'] / 1024:>10.1f}{r['throttled']:>5}")
+
+    if args.json_path:
+        report = {
+            "meta": {
+                "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                "git_revision": git_revision(),
+                "python": sys.version.split()[0],
+                "args": vars(args),
+            },
+            "results": results,
+        }
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
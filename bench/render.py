@@ -0,0 +1,86 @@
+"""
+页面渲染基准测试
+
+用合成绘本PDF比较单线程渲染和共享进程池并行渲染：对每种页数分别测量首页可用时间、
+总耗时和 pages/sec。进程池的启动耗时（spawn 子进程并导入模块）在预热时计入，不计入各次测量。
+
+用法:
+    python -m bench.render --pages 10 50 200 --processes 0 2 4 8 --image-size 1600
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+from typing import Dict, List
+
+from bench.synthetic_pdf import make_picture_book
+
+
+def run(pdf_file: str, pages: int, processes: int, chunk_pages: int, prefetch: int, policy) -> Dict:
+    """按给定的进程数渲染整本书一次，返回统计结果"""
+    from util import pdf_iter_page_images
+
+    start = time.perf_counter()
+    first_page = None
+    count = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in pdf_iter_page_images(pdf_file, dst_images_dir=None, in_memory=True, image_policy=policy,
+                                      prefetch=prefetch, processes=processes, chunk_pages=chunk_pages):
+            if first_page is None:
+                first_page = time.perf_counter() - start
+            count += 1
+    elapsed = time.perf_counter() - start
+    assert count == pages, f"渲染了 {count} 页，应为 {pages} 页"
+    return {"pages": pages, "processes": processes, "first_page_s": first_page, "elapsed_s": elapsed,
+            "pages_per_sec": pages / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="页面渲染基准测试")
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 50, 200], help="测试的书的页数")
+    parser.add_argument("--processes", type=int, nargs="+", default=[0, os.cpu_count() or 1],
+                        help="渲染进程数，0 或 1 表示单线程渲染")
+    parser.add_argument("--chunk-pages", type=int, default=4, help="并行渲染时每个任务的连续页数")
+    parser.add_argument("--prefetch", type=int, default=8, help="最多预先渲染的页数（含进程池中正在渲染的页面），需不小于进程数才能用满进程池")
+    parser.add_argument("--image-size", type=int, default=1600, help="合成PDF插图的像素边长")
+    parser.add_argument("--image-policy", default=None, help="页面图片策略，默认 Config.DEFAULT_IMAGE_POLICY")
+    parser.add_argument("--json", dest="json_path", help="将结果写入JSON文件")
+    args = parser.parse_args()
+
+    from core.config import Config
+    from util import ImagePolicy, get_render_pool
+
+    policy = ImagePolicy.from_config(Config.IMAGE_POLICIES[args.image_policy or Config.DEFAULT_IMAGE_POLICY])
+    results: List[Dict] = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        books = {pages: make_picture_book(os.path.join(temp_dir, f"book_{pages}.pdf"), pages=pages,
+                                          image_size=args.image_size, seed=pages)
+                 for pages in args.pages}
+        # 进程池在进程内只创建一次，测试各进程数时需要分别创建；这里按最大进程数创建，
+        # 较小的进程数通过限制同一请求同时提交的任务数实现
+        max_processes = max(args.processes)
+        if max_processes > 1:
+            pool = get_render_pool(max_processes)
+            list(pool.map(abs, range(max_processes * 2)))
+        for pages, pdf_file in books.items():
+            for processes in args.processes:
+                results.append(run(pdf_file, pages, processes, args.chunk_pages, args.prefetch, policy))
+
+    print(f"CPU: {os.cpu_count()}")
+    print(f"{'pages':>6}{'procs':>7}{'first page s':>14}{'total s':>10}{'pages/s':>10}{'speedup':>9}")
+    baseline = {r["pages"]: r["elapsed_s"] for r in results if r["processes"] <= 1}
+    for r in results:
+        speedup = baseline.get(r["pages"], r["elapsed_s"]) / r["elapsed_s"]
+        print(f"{r['pages']:>6}{r['processes']:>7}{r['first_page_s']:>14.3f}{r['elapsed_s']:>10.2f}"
+              f"{r['pages_per_sec']:>10.1f}{speedup:>9.2f}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"cpu_count": os.cpu_count(), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+启动耗时基准测试
+
+用 `python -X importtime` 在新进程中导入指定模块，统计总导入耗时和最慢的模块，
+并检查 gradio、fitz、openai 等重量级依赖没有在导入时被加载。超出耗时预算或加载了
+不应加载的模块时以非零状态退出，可用于持续集成中的启动耗时回归检查。
+
+用法:
+    python -m bench.startup --budget-ms 300
+    python -m bench.startup --modules main --budget-ms 400 --json startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+# 无界面使用（批量处理、HTTP 工作进程）时不应在导入阶段加载的模块
+HEAVY_MODULES = ("gradio", "fitz", "openai", "httpx", "PIL", "numpy")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(stderr: str) -> List[Dict]:
+    """解析 -X importtime 的输出，返回每个模块的 (自身耗时, 累计耗时, 嵌套深度)"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append({"module": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us),
+                        "depth": depth})
+    return entries
+
+
+def measure(modules: List[str], heavy: List[str]) -> Dict:
+    """在新进程中导入 modules，返回导入耗时、进程耗时、最慢的模块（前两层）和被加载的重量级模块"""
+    code = (f"import sys, json; import {', '.join(modules)}; "
+            f"print(json.dumps([m for m in {list(heavy)!r} if m in sys.modules]))")
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=REPO_ROOT,
+                            capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"导入失败: {result.stderr.strip().splitlines()[-1:]}")
+    entries = parse_importtime(result.stderr)
+    top_level = [e for e in entries if e["depth"] == 0]
+    return {
+        "modules": modules,
+        "import_ms": round(sum(e["cumulative_us"] for e in top_level) / 1000, 1),
+        "process_ms": round(wall * 1000, 1),
+        "heavy_loaded": json.loads(result.stdout.strip().splitlines()[-1]),
+        "slowest": sorted((e for e in entries if e["depth"] <= 1), key=lambda e: e["cumulative_us"], reverse=True)[:10],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动耗时基准测试（-X importtime）")
+    parser.add_argument("--modules", nargs="*", default=["core", "llm"], help="要导入的模块")
+    parser.add_argument("--budget-ms", type=float, default=500.0, help="导入耗时预算（毫秒），取多次运行的中位数")
+    parser.add_argument("--runs", type=int, default=5, help="运行次数")
+    parser.add_argument("--allow", nargs="*", default=[], help="允许在导入时加载的重量级模块")
+    parser.add_argument("--json", dest="json_path", help="将结果写入JSON文件")
+    args = parser.parse_args()
+
+    heavy = [m for m in HEAVY_MODULES if m not in args.allow]
+    runs = [measure(args.modules, heavy) for _ in range(max(1, args.runs))]
+    runs.sort(key=lambda r: r["import_ms"])
+    median = runs[len(runs) // 2]
+
+    print(f"导入 {', '.join(args.modules)}: 中位数 {median['import_ms']:.1f} ms "
+          f"(进程总耗时 {median['process_ms']:.1f} ms, 预算 {args.budget_ms:.0f} ms)")
+    print(f"{'module':<40}{'cumulative ms':>15}")
+    for entry in median["slowest"]:
+        print(f"{entry['module']:<40}{entry['cumulative_us'] / 1000:>15.1f}")
+
+    failures = []
+    if median["import_ms"] > args.budget_ms:
+        failures.append(f"导入耗时 {median['import_ms']:.1f} ms 超出预算 {args.budget_ms:.0f} ms")
+    if median["heavy_loaded"]:
+        failures.append(f"导入时加载了重量级模块: {', '.join(median['heavy_loaded'])}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"budget_ms": args.budget_ms, "median": median, "runs": [r["import_ms"] for r in runs],
+                       "failures": failures}, f, ensure_ascii=False, indent=2)
+
+    for failure in failures:
+        print(f"失败: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
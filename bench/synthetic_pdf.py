@@ -0,0 +1,67 @@
+"""
+合成绘本PDF生成器
+
+每页包含一张随机像素的插图、若干彩色图形和一段文字，可配置页数、页面尺寸和插图分辨率，
+插图分辨率决定了PDF文件大小和渲染耗时。
+
+用法:
+    python -m bench.synthetic_pdf book.pdf --pages 40 --image-size 800
+"""
+import argparse
+import random
+
+import fitz
+
+PAGE_SIZES = {"a4": (595, 842), "a5": (420, 595), "square": (600, 600), "landscape": (842, 595)}
+
+
+def make_picture_book(path: str, pages: int = 10, page_size: str = "landscape", image_size: int = 600,
+                      seed: int = 0) -> str:
+    """
+    生成合成绘本PDF
+
+    Args:
+        path: 输出文件路径
+        pages: 页数
+        page_size: 页面尺寸，见 PAGE_SIZES
+        image_size: 每页插图的像素边长，0 表示不嵌入位图
+        seed: 随机数种子，不同种子生成内容不同的书（避免命中缓存）
+
+    Returns:
+        str: 输出文件路径
+    """
+    rng = random.Random(seed)
+    width, height = PAGE_SIZES[page_size]
+    document = fitz.open()
+    for page_num in range(pages):
+        page = document.new_page(width=width, height=height)
+        if image_size:
+            # 低分辨率噪声放大为插图，既有真实位图的体积，又不至于生成过慢
+            tile = max(1, image_size // 8)
+            samples = bytes(rng.getrandbits(8) for _ in range(tile * tile * 3))
+            pixmap = fitz.Pixmap(fitz.csRGB, tile, tile, samples, 0)
+            pixmap = fitz.Pixmap(pixmap, image_size, image_size, None)
+            page.insert_image(fitz.Rect(40, 40, width - 40, height * 0.7), pixmap=pixmap)
+        for _ in range(5):
+            center = fitz.Point(rng.uniform(60, width - 60), rng.uniform(60, height * 0.7))
+            color = (rng.random(), rng.random(), rng.random())
+            page.draw_circle(center, rng.uniform(10, 50), color=color, fill=color)
+        page.insert_text((50, height * 0.8), f"Page {page_num + 1}: the little bear walks on.", fontsize=20)
+    document.save(path, deflate=True)
+    document.close()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成合成绘本PDF")
+    parser.add_argument("output", help="输出PDF路径")
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--page-size", choices=list(PAGE_SIZES.keys()), default="landscape")
+    parser.add_argument("--image-size", type=int, default=600, help="插图像素边长，0 表示不嵌入位图")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    make_picture_book(args.output, args.pages, args.page_size, args.image_size, args.seed)
+
+
+if __name__ == "__main__":
+    main()
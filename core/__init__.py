@@ -1,4 +1,9 @@
+from .cache import BookCache, CaptionCache, SingleFlight, TranslationCache
+from .story_store import StoryStore
 from .file import FileHandler
 from .state import StateManager
+from .translate import ChunkedTranslator
 from .storyProcess import StoryProcessor
+from .batch import BatchRunner
+from .scheduler import JobScheduler
 # from .config import Config
\ No newline at end of file
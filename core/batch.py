@@ -0,0 +1,147 @@
+import datetime
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Set
+
+from core.config import Config
+from core.storyProcess import StoryProcessor
+from llm import track_usage
+from util import pdf_page_count
+from util.logger import logger
+
+
+# 批量处理类
+class BatchRunner:
+    """批量处理类，无界面地并发处理目录中的PDF，每本书输出一条JSONL记录"""
+
+    def __init__(self, story_processor: StoryProcessor, output_path: str, workers: int = 2,
+                 vl_system_prompt: str = Config.DEFAULT_VL_SYSTEM_PROMPT,
+                 story_system_prompt: str = Config.DEFAULT_STORY_SYSTEM_PROMPT,
+                 image_policy: str = Config.DEFAULT_IMAGE_POLICY):
+        """
+        Args:
+            story_processor: 故事处理器
+            output_path: JSONL输出文件，同时作为断点记录，已成功的书在重新运行时会被跳过
+            workers: 同时处理的书本数
+            vl_system_prompt: 图片识别系统提示
+            story_system_prompt: 故事生成系统提示
+            image_policy: 页面图片策略名称
+        """
+        self.story_processor = story_processor
+        self.output_path = output_path
+        self.workers = max(1, workers)
+        self.vl_system_prompt = vl_system_prompt
+        self.story_system_prompt = story_system_prompt
+        self.image_policy = image_policy
+        self._write_lock = threading.Lock()
+
+    @staticmethod
+    def find_pdfs(input_dir: str) -> List[str]:
+        """递归查找目录中的PDF文件，按路径排序"""
+        pdfs = []
+        for root, _, files in os.walk(input_dir):
+            pdfs.extend(os.path.join(root, name) for name in files if name.lower().endswith(".pdf"))
+        return sorted(os.path.abspath(path) for path in pdfs)
+
+    def completed_books(self) -> Set[str]:
+        """读取输出文件中已成功处理的PDF路径"""
+        completed = set()
+        if not os.path.exists(self.output_path):
+            return completed
+        with open(self.output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 中断时可能留下不完整的最后一行
+                if record.get("status") == "ok":
+                    completed.add(record["pdf"])
+        return completed
+
+    def run(self, input_dir: str) -> Dict:
+        """
+        处理目录中所有尚未完成的PDF
+
+        Returns:
+            Dict: 本次运行的汇总信息
+        """
+        pdfs = self.find_pdfs(input_dir)
+        completed = self.completed_books()
+        self._repair_tail()
+        pending = [pdf for pdf in pdfs if pdf not in completed]
+        logger.info(f"批量处理: 共 {len(pdfs)} 本，已完成 {len(pdfs) - len(pending)} 本，本次处理 {len(pending)} 本")
+
+        start_time = time.time()
+        succeeded = failed = pages = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch") as executor:
+            futures = [executor.submit(self.process_book, pdf) for pdf in pending]
+            for future in as_completed(futures):
+                record = future.result()
+                if record["status"] == "ok":
+                    succeeded += 1
+                    pages += record["pages"]
+                else:
+                    failed += 1
+                logger.info(f"批量处理进度: {succeeded + failed}/{len(pending)} ({record['status']}) {record['pdf']}")
+
+        elapsed = time.time() - start_time
+        summary = {
+            "books": len(pending),
+            "succeeded": succeeded,
+            "failed": failed,
+            "skipped": len(pdfs) - len(pending),
+            "pages": pages,
+            "elapsed_s": round(elapsed, 2),
+            "pages_per_sec": round(pages / elapsed, 3) if elapsed > 0 else 0.0,
+        }
+        logger.info(f"批量处理完成: {summary}")
+        return summary
+
+    def process_book(self, pdf_file: str) -> Dict:
+        """处理单本书并写入一条JSONL记录"""
+        request_id = self.story_processor.state_manager.generate_request_id()
+        start_time = time.time()
+        record = {"pdf": pdf_file, "request_id": request_id}
+        try:
+            record["pages"] = pdf_page_count(pdf_file)
+            with track_usage() as usage:
+                story, story_path = None, None
+                for story, story_path in self.story_processor.process_pdf(
+                        pdf_file, request_id, self.vl_system_prompt, self.story_system_prompt,
+                        self.image_policy, progress=None):
+                    pass
+            record.update(usage.summary())
+            if story_path:
+                record.update(status="ok", story_path=story_path, story_length=len(story))
+            else:
+                record.update(status="error", error=story)
+        except Exception as e:
+            logger.error(f"批量处理 {pdf_file} 时出错: {traceback.format_exc()}")
+            record.update(status="error", error=str(e))
+
+        record["elapsed_s"] = round(time.time() - start_time, 2)
+        record["finished_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+        self._write_record(record)
+        return record
+
+    def _repair_tail(self) -> None:
+        """上次运行中断在半行记录时补上换行，避免与新记录粘连"""
+        if not os.path.exists(self.output_path) or os.path.getsize(self.output_path) == 0:
+            return
+        with open(self.output_path, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+    def _write_record(self, record: Dict) -> None:
+        """追加写入一条记录并立即落盘，保证中断后可以从断点继续"""
+        line = json.dumps(record, ensure_ascii=False)
+        with self._write_lock:
+            with open(self.output_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
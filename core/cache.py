@@ -0,0 +1,232 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Dict, Tuple, Union
+
+from util.logger import logger
+
+
+def _hash_parts(*parts: Union[str, bytes]) -> str:
+    """对多个字段计算SHA-256，每个字段带长度前缀，避免不同字段拼接后产生相同的输入"""
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part.encode("utf-8") if isinstance(part, str) else part
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+# 文本缓存
+class TextCache:
+    """文本缓存基类，SQLite存储键值对，总大小超出上限时按最近最少使用淘汰"""
+
+    TABLE = "entries"
+    LABEL = "文本缓存"
+
+    def __init__(self, db_path: Union[str, Path], max_bytes: int):
+        """
+        Args:
+            db_path: SQLite数据库文件路径
+            max_bytes: 缓存内容总大小上限，超出时按最近最少使用淘汰
+        """
+        self.db_path = str(db_path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.TABLE} (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.TABLE}_last_access ON {self.TABLE} (last_access)")
+        self._conn.commit()
+        # 内容总大小只在打开时统计一次，之后随写入和淘汰增减，淘汰时不必再扫描全表
+        self._total_bytes = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.TABLE}").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存内容，未命中时返回None"""
+        with self._lock:
+            row = self._conn.execute(f"SELECT value FROM {self.TABLE} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(f"UPDATE {self.TABLE} SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        """写入缓存内容，并在超出容量时淘汰最久未使用的条目"""
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            old = self._conn.execute(f"SELECT size FROM {self.TABLE} WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.TABLE} (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time())
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        """按最近最少使用淘汰条目，直到总大小不超过上限；沿 last_access 索引只读取需要淘汰的条目"""
+        evicted = []
+        for key, size in self._conn.execute(f"SELECT key, size FROM {self.TABLE} ORDER BY last_access ASC"):
+            if self._total_bytes <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany(f"DELETE FROM {self.TABLE} WHERE key = ?", evicted)
+        logger.info(f"{self.LABEL}淘汰 {len(evicted)} 条记录")
+
+    def stats(self) -> Dict[str, int]:
+        """返回缓存命中统计"""
+        with self._lock:
+            entries = self._conn.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+            total = self._total_bytes
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": total}
+
+
+# 页面描述缓存
+class CaptionCache(TextCache):
+    """页面描述缓存类，按页面图片内容、系统提示和模型名缓存视觉模型的输出"""
+
+    TABLE = "page_captions"
+    LABEL = "页面描述缓存"
+
+    @staticmethod
+    def make_key(image_bytes: bytes, system_prompt: str, model: str) -> str:
+        """根据页面图片内容、系统提示和模型名生成缓存键"""
+        return _hash_parts(model, system_prompt, image_bytes)
+
+
+# 翻译缓存
+class TranslationCache(TextCache):
+    """翻译缓存类，按原文片段、翻译提示和模型名缓存翻译结果"""
+
+    TABLE = "translations"
+    LABEL = "翻译缓存"
+
+    @staticmethod
+    def make_key(text: str, prompt: str, model: str) -> str:
+        """根据原文片段、翻译提示和模型名生成缓存键"""
+        return _hash_parts(model, prompt, text)
+
+
+# 整本书结果缓存
+class BookCache:
+    """整本书结果缓存类，按PDF内容、提示词和模型名缓存生成的故事及其文件路径"""
+
+    def __init__(self, db_path: Union[str, Path], max_entries: int):
+        """
+        Args:
+            db_path: SQLite数据库文件路径
+            max_entries: 最多保留的记录数，超出时按最近最少使用淘汰
+        """
+        self.db_path = str(db_path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS books (
+                key TEXT PRIMARY KEY,
+                story TEXT NOT NULL,
+                story_path TEXT,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_books_last_access ON books (last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(pdf_hash: str, vl_system_prompt: str, story_system_prompt: str,
+                 vl_model: str, story_model: str, image_policy: str = "") -> str:
+        """根据PDF内容哈希、两个系统提示、模型名和页面图片策略生成缓存键"""
+        return _hash_parts(pdf_hash, vl_system_prompt, story_system_prompt, vl_model, story_model, image_policy)
+
+    def get(self, key: str) -> Optional[Tuple[str, Optional[str]]]:
+        """读取缓存的 (故事内容, 故事文件路径)，未命中时返回None"""
+        with self._lock:
+            row = self._conn.execute("SELECT story, story_path FROM books WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE books SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0], row[1]
+
+    def put(self, key: str, story: str, story_path: Optional[str]) -> None:
+        """写入故事结果，并在超出条数上限时淘汰最久未使用的记录"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO books (key, story, story_path, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, story, story_path, now, now)
+            )
+            self._conn.execute(
+                "DELETE FROM books WHERE key IN "
+                "(SELECT key FROM books ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """返回缓存命中统计"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+# 相同任务合并
+class SingleFlight:
+    """相同键的并发任务只执行一次，其余调用方等待该任务结束"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[str, threading.Event] = {}
+
+    def begin(self, key: str) -> Tuple[bool, threading.Event]:
+        """
+        登记一个任务
+
+        Returns:
+            Tuple[bool, threading.Event]: (是否由当前调用方执行, 任务结束事件)
+        """
+        with self._lock:
+            event = self._flights.get(key)
+            if event is not None:
+                return False, event
+            event = threading.Event()
+            self._flights[key] = event
+            return True, event
+
+    def end(self, key: str) -> None:
+        """任务结束，唤醒所有等待者"""
+        with self._lock:
+            event = self._flights.pop(key, None)
+        if event is not None:
+            event.set()
+
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """分块计算文件内容的SHA-256，内存占用与文件大小无关"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
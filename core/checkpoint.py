@@ -0,0 +1,138 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple, Union
+
+from core.cache import _hash_parts
+from util.logger import logger
+
+
+# 页面识别断点
+class PageCheckpoint:
+    """
+    页面识别断点类，逐页保存已完成的页面描述和失败的页面，中断或失败后从断点继续
+
+    同时保存页面预筛选计算的页面指纹，继续时与已识别页面重复的页面直接复用其描述。
+    """
+
+    STATUS_OK = "ok"
+    STATUS_FAILED = "failed"
+
+    def __init__(self, db_path: Union[str, Path], max_age_days: float):
+        """
+        Args:
+            db_path: SQLite数据库文件路径
+            max_age_days: 断点保留天数，超过后在启动时清理
+        """
+        self.db_path = str(db_path)
+        self.max_age = max_age_days * 24 * 3600
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS page_checkpoints (
+                book_key TEXT NOT NULL,
+                page_index INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                caption TEXT,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (book_key, page_index)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_page_checkpoints_updated_at "
+                           "ON page_checkpoints (updated_at)")
+        # 感知哈希为64位无符号整数，超出SQLite整数范围，按十六进制文本保存
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS page_fingerprints (
+                book_key TEXT NOT NULL,
+                page_index INTEGER NOT NULL,
+                phash TEXT NOT NULL,
+                ink REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (book_key, page_index)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_page_fingerprints_updated_at "
+                           "ON page_fingerprints (updated_at)")
+        self._conn.commit()
+        self.prune()
+
+    @staticmethod
+    def make_key(pdf_hash: str, vl_system_prompt: str, vl_model: str, image_policy: str = "") -> str:
+        """根据PDF内容哈希、图片识别系统提示、模型名和页面图片策略生成断点键（与故事提示无关）"""
+        return _hash_parts(pdf_hash, vl_system_prompt, vl_model, image_policy)
+
+    def load(self, book_key: str) -> Tuple[Dict[int, str], Set[int]]:
+        """
+        读取一本书的断点
+
+        Returns:
+            Tuple[Dict[int, str], Set[int]]: (已完成页面的 页码索引 -> 描述, 识别失败的页码索引)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT page_index, status, caption FROM page_checkpoints WHERE book_key = ?", (book_key,)
+            ).fetchall()
+        captions = {index: caption for index, status, caption in rows if status == self.STATUS_OK}
+        failed = {index for index, status, _ in rows if status == self.STATUS_FAILED}
+        return captions, failed
+
+    def save_page(self, book_key: str, index: int, caption: str) -> None:
+        """保存一页的识别结果，覆盖之前的失败记录"""
+        self._write(book_key, index, self.STATUS_OK, caption, None)
+
+    def mark_failed(self, book_key: str, index: int, error: str) -> None:
+        """记录一页识别失败"""
+        self._write(book_key, index, self.STATUS_FAILED, None, error)
+
+    def save_fingerprint(self, book_key: str, index: int, phash: int, ink: float) -> None:
+        """保存一页的页面指纹（感知哈希和墨迹覆盖率，见 util.page_filter.page_fingerprint）"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO page_fingerprints (book_key, page_index, phash, ink, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (book_key, index, format(phash, "016x"), ink, time.time())
+            )
+            self._conn.commit()
+
+    def load_fingerprints(self, book_key: str) -> Dict[int, Tuple[int, float]]:
+        """
+        读取一本书已保存的页面指纹
+
+        Returns:
+            Dict[int, Tuple[int, float]]: 页码索引 -> (感知哈希, 墨迹覆盖率)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT page_index, phash, ink FROM page_fingerprints WHERE book_key = ?", (book_key,)
+            ).fetchall()
+        return {index: (int(phash, 16), ink) for index, phash, ink in rows}
+
+    def _write(self, book_key: str, index: int, status: str, caption: Optional[str], error: Optional[str]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO page_checkpoints (book_key, page_index, status, caption, error, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (book_key, index, status, caption, error, time.time())
+            )
+            self._conn.commit()
+
+    def clear(self, book_key: str) -> None:
+        """删除一本书的断点（全部页面成功且故事已保存后调用）"""
+        with self._lock:
+            self._conn.execute("DELETE FROM page_checkpoints WHERE book_key = ?", (book_key,))
+            self._conn.execute("DELETE FROM page_fingerprints WHERE book_key = ?", (book_key,))
+            self._conn.commit()
+
+    def prune(self) -> None:
+        """清理超过保留期限的断点"""
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM page_checkpoints WHERE updated_at < ?", (time.time() - self.max_age,)
+            ).rowcount
+            self._conn.execute("DELETE FROM page_fingerprints WHERE updated_at < ?", (time.time() - self.max_age,))
+            self._conn.commit()
+        if deleted:
+            logger.info(f"页面识别断点清理 {deleted} 条过期记录")
@@ -9,6 +9,105 @@ class Config:
     # 文件路径配置
     STORIES_DIR = Path("stories")
     STORIES_DIR.mkdir(exist_ok=True)
+    CACHE_DIR = Path("cache")
+    CACHE_DIR.mkdir(exist_ok=True)
+    # 处理PDF时的临时目录，与 SCHEDULER_UPLOAD_DIR 在同一文件系统内，上传文件以硬链接放入而不复制
+    TEMP_DIR = CACHE_DIR / "tmp"
+    TEMP_DIR.mkdir(exist_ok=True)
+    # 界面上传文件的保存目录（设置为 GRADIO_TEMP_DIR）。默认的系统临时目录通常与缓存目录不在同一文件系统，
+    # 放在缓存目录下使提交任务时上传文件能硬链接到 SCHEDULER_UPLOAD_DIR 而不必复制
+    UPLOAD_TEMP_DIR = CACHE_DIR / "uploads"
+
+    # 故事存储配置（正文按日期分目录保存，索引记录所属的书、请求、语言和时间）
+    STORY_INDEX_PATH = STORIES_DIR / "index.sqlite3"
+    STORY_COMPRESSION = None  # 正文压缩方式：None、"gzip" 或 "zstd"（需要安装 zstandard）
+
+    # 缓存配置
+    CAPTION_CACHE_ENABLED = True  # 相同页面（图片内容、系统提示、模型均相同）复用已有描述
+    CAPTION_CACHE_PATH = CACHE_DIR / "captions.sqlite3"
+    CAPTION_CACHE_MAX_BYTES = 200 * 1024 * 1024  # 超出后按最近最少使用淘汰
+    BOOK_CACHE_ENABLED = True  # 相同PDF（提示词、模型均相同）直接返回已生成的故事，并合并同时进行的相同任务
+    BOOK_CACHE_PATH = CACHE_DIR / "books.sqlite3"
+    BOOK_CACHE_MAX_ENTRIES = 1000
+    TRANSLATION_CACHE_ENABLED = True  # 按段落缓存翻译结果，修改一个段落只会重新翻译该段落
+    TRANSLATION_CACHE_PATH = CACHE_DIR / "translations.sqlite3"
+    TRANSLATION_CACHE_MAX_BYTES = 50 * 1024 * 1024
+    PAGE_CHECKPOINT_ENABLED = True  # 逐页保存识别结果，失败或停止后重新处理同一本书时从断点继续
+    PAGE_CHECKPOINT_PATH = CACHE_DIR / "checkpoints.sqlite3"
+    PAGE_CHECKPOINT_MAX_AGE_DAYS = 7
+
+    # 翻译配置
+    TRANSLATION_CHUNK_CHARS = 600  # 单个翻译片段的最大字符数
+    TRANSLATION_CONCURRENCY = 4  # 同时翻译的最大片段数
+
+    # PDF渲染配置
+    STREAM_PDF_RENDER = True  # 边渲染边识别，首页渲染完成即开始调用视觉模型
+    RENDER_PREFETCH = 2  # 流式渲染时每个请求最多预先渲染（驻留内存）的页数，并行渲染时包括渲染进程中的页面
+    # 页面渲染进程数：大于1时由所有请求共享的进程池并行渲染（进程池按首次使用时的大小创建），
+    # 否则在处理线程旁的单个渲染线程中逐页渲染。单个请求同时在渲染的页数受 RENDER_PREFETCH 限制，
+    # 需要单本书用满多个进程时一并调大 RENDER_PREFETCH
+    RENDER_PROCESSES = 1
+    RENDER_CHUNK_PAGES = 4  # 并行渲染时每个任务渲染的连续页数（不超过 RENDER_PREFETCH），每个任务在渲染进程中打开一次文档
+    # 页面图片策略：缩放比例 zoom、最长边上限 max_dimension、单页 token 预算 max_tokens、
+    # 输出格式 format (png/jpeg/webp) 及压缩质量 quality，可在"高级设置"中按请求选择
+    IMAGE_POLICIES = {
+        "原始PNG": {"format": "png", "zoom": 2, "max_dimension": 4096},
+        "高清JPEG": {"format": "jpeg", "quality": 90, "zoom": 2, "max_dimension": 2048},
+        "均衡JPEG": {"format": "jpeg", "quality": 80, "zoom": 2, "max_dimension": 1280},
+        "紧凑WebP": {"format": "webp", "quality": 75, "zoom": 2, "max_dimension": 1024},
+        "省Token": {"format": "jpeg", "quality": 75, "zoom": 2, "max_tokens": 640},
+    }
+    DEFAULT_IMAGE_POLICY = "原始PNG"
+    SAVE_PAGE_IMAGES = False  # 流式渲染时页面图片只保存在内存中，开启后额外写入 PAGE_IMAGES_DIR
+    PAGE_IMAGES_DIR = "../images"
+
+    # 页面预筛选配置（调用视觉模型前按低分辨率灰度图的感知哈希和墨迹覆盖率筛选页面）
+    PAGE_FILTER_ENABLED = True
+    PAGE_BLANK_INK_RATIO = 0.002  # 墨迹覆盖率低于该值的页面视为空白页（环衬、空白页），不识别
+    PAGE_DUPLICATE_MAX_DISTANCE = 4  # 与之前页面的感知哈希汉明距离（共64位）不超过该值时视为重复，复用其描述
+    PAGE_DUPLICATE_MAX_INK_DELTA = 0.01  # 视为重复时墨迹覆盖率的最大差异，图片相同而文字不同的页面不会被合并
+
+    # 页面识别配置
+    VL_PARALLEL = False  # 是否并发识别页面（以封面描述作为全书上下文，代替完整的串行对话历史）
+    VL_CONCURRENCY = 4  # 并发识别时同时进行的最大请求数
+    # 串行识别时对话历史中已识别页面图片的压缩策略：
+    # "none" 保留全部图片，"caption" 图片和描述合并为一条描述文字，"stub" 替换为文字占位，
+    # "keep_last" 只保留最近一页的图片
+    VL_HISTORY_COMPACTION = "caption"
+
+    # 故事生成配置
+    STREAM_STORY = True  # 流式生成故事，界面随模型输出逐步显示
+
+    # 访问控制：界面登录账号；HTTP 接口和 /metrics 接口要求请求头 Authorization: Bearer <API_TOKEN>
+    AUTH_USERNAME = os.environ.get("STORY_AUTH_USERNAME", "admin")
+    AUTH_PASSWORD = os.environ.get("STORY_AUTH_PASSWORD", "admin")
+    API_TOKEN = os.environ.get("STORY_API_TOKEN", "")  # 为空时 HTTP 接口和 /metrics 接口拒绝所有请求
+
+    # 性能统计配置
+    METRICS_ENABLED = True  # 启动界面时同时提供 Prometheus 格式的 /metrics 接口
+    METRICS_HOST = "127.0.0.1"  # 只在本机监听；由其他主机采集时改为对外地址并设置 API_TOKEN
+    METRICS_PORT = 8001
+
+    # 任务调度配置（界面和 HTTP 接口提交的任务都经过调度器执行）
+    SCHEDULER_WORKERS = 4  # 同时执行的任务数，超出的任务排队等待
+    SCHEDULER_DB_PATH = CACHE_DIR / "jobs.sqlite3"
+    SCHEDULER_UPLOAD_DIR = CACHE_DIR / "jobs"  # 排队中任务的PDF，重启后仍可执行
+    SCHEDULER_DEFAULT_SECONDS_PER_PAGE = 6.0  # 还没有完成记录时估计等待时间使用的每页耗时
+    SCHEDULER_AGING_SECONDS_PER_PAGE = 10.0  # 排队每等待这么多秒，排序时视为少一页，避免长书一直等待
+    SCHEDULER_RETENTION_DAYS = 7  # 已结束任务的记录保留天数
+
+    # 请求状态配置（停止标志和进度）
+    STATE_BACKEND = "memory"  # "memory" 只在本进程内；"sqlite" 供同一主机上的多个工作进程共享
+    STATE_DB_PATH = CACHE_DIR / "request_states.sqlite3"
+    STATE_TTL_SECONDS = 6 * 3600  # 超过该时间没有更新的请求状态被清理（未能正常结束的请求）
+    STATE_POLL_INTERVAL = 0.5  # 共享存储时检查其他进程发出的停止请求的间隔（秒）
+
+    # HTTP 接口配置
+    API_ENABLED = False  # 启动界面时同时提供供其他服务调用的 HTTP 接口（与界面共享缓存和限流器）
+    API_HOST = "127.0.0.1"  # 只在本机监听；对外提供时改为对外地址，调用方需带上 API_TOKEN
+    API_PORT = 8002
+    API_MAX_PRIORITY = 0  # 接口提交的任务可设置的最高优先级，超出时按此值排队（界面提交的任务为0）
+    API_JOB_TTL_SECONDS = 3600  # 已结束的任务保留多久（可查询状态和重放事件）
 
     # 系统提示词
     DEFAULT_VL_SYSTEM_PROMPT = """角色定义：您是一位富有创意的儿童故事作家，擅长将图片内容转化为生动有趣的故事，特别适合2-8岁小朋友的价值观和兴趣。
@@ -38,3 +137,11 @@ class Config:
 
 持续改进：基于反馈不断调整和完善故事内容，使其更加贴近孩子们的生活体验和想象力。
 """
+
+    TRANSLATION_PROMPT = """请将以下中文故事片段翻译成英文，保持故事的风格和内容不变，使其适合2-8岁的中国儿童阅读。
+请直接输出翻译结果，不要添加任何解释或前言。"""
+
+    GLOSSARY_PROMPT = """请找出以下中文儿童故事中出现的所有人物（包括动物角色）名称，并为每个名称给出一个简单的英文译名。
+每行输出一个，格式为：中文名 => English Name
+如果没有人物名称，只输出：无
+不要输出任何其他内容。"""
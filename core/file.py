@@ -1,73 +1,181 @@
-import datetime
+import errno
+import hashlib
 import os
-import shutil
-from typing import Tuple, Optional, Dict, List, Union
+from typing import BinaryIO, Tuple, Optional, Union
 
+from core.cache import hash_file
 from core.config import Config
+from core.story_store import StoryStore
 from util.logger import logger
+from util.metrics import span
+
+# 流式复制和计算哈希时每次读取的块大小
+COPY_CHUNK_SIZE = 1024 * 1024
+# 内核复制（copy_file_range / sendfile）每次调用的最大字节数
+KERNEL_COPY_SIZE = 64 * 1024 * 1024
+# 表示当前平台或文件系统不支持该内核复制方式的错误码，遇到时换下一种方式
+_KERNEL_COPY_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP,
+                            errno.EBADF, errno.EPERM}
+
+
+def _copy_chunks(src_file: BinaryIO, dest_file: BinaryIO, digest=None) -> None:
+    """在用户态分块复制，可同时更新哈希"""
+    buffer = bytearray(COPY_CHUNK_SIZE)
+    view = memoryview(buffer)
+    while True:
+        size = src_file.readinto(buffer)
+        if not size:
+            break
+        if digest is not None:
+            digest.update(view[:size])
+        dest_file.write(view[:size])
+
+
+def copy_file(src_file: BinaryIO, dest_file: BinaryIO) -> None:
+    """
+    把打开的源文件从当前位置复制到目标文件，数据不经过用户态
+
+    依次尝试 os.copy_file_range（部分文件系统只复制引用）和 os.sendfile；
+    平台不支持或文件系统拒绝时退回用户态分块复制。
+    """
+    src_fd, dest_fd = src_file.fileno(), dest_file.fileno()
+    kernel_copies = []
+    if hasattr(os, "copy_file_range"):
+        kernel_copies.append(lambda: os.copy_file_range(src_fd, dest_fd, KERNEL_COPY_SIZE))
+    if hasattr(os, "sendfile"):
+        kernel_copies.append(lambda: os.sendfile(dest_fd, src_fd, None, KERNEL_COPY_SIZE))
+    for kernel_copy in kernel_copies:
+        copied = 0
+        try:
+            while True:
+                size = kernel_copy()
+                if not size:
+                    return
+                copied += size
+        except OSError as e:
+            # 已经复制了部分内容时不能换方式重来
+            if copied or e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                raise
+    _copy_chunks(src_file, dest_file)
 
 
 # 文件处理类
 class FileHandler:
     """文件处理类，处理文件保存和读取"""
 
-    @staticmethod
-    def save_story(story_content: str, story_type: str, pdf_name: Optional[str] = None) -> Optional[str]:
+    def __init__(self, story_store: Optional[StoryStore] = None):
+        if story_store is None:
+            story_store = StoryStore(Config.STORIES_DIR, Config.STORY_INDEX_PATH, Config.STORY_COMPRESSION)
+        self.story_store = story_store
+
+    def save_story(self, story_content: str, story_type: str, pdf_name: Optional[str] = None,
+                   pdf_hash: Optional[str] = None, prompts_hash: Optional[str] = None,
+                   request_id: Optional[str] = None, source: Optional[str] = None) -> Optional[str]:
         """
-        保存故事到本地文件
+        保存故事到故事存储（正文原子写入，并记录到索引）
 
         Args:
             story_content: 故事内容
             story_type: 故事类型 ('chinese' 或 'english')
             pdf_name: PDF文件名（可选）
+            pdf_hash: PDF内容哈希，同一本书的故事关联到同一条书籍记录
+            prompts_hash: 提示词哈希，见 StoryStore.make_prompts_hash
+            request_id: 生成该故事的请求ID
+            source: 翻译的原文；已保存过时译文关联到原文所属的书
 
         Returns:
             str: 故事文件路径
         """
         try:
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            story_name = f"{os.path.splitext(os.path.basename(pdf_name))[0]}_" if pdf_name else ""
-            filename = f"{story_name}{story_type}_{timestamp}.txt"
-            story_path = Config.STORIES_DIR / filename
+            book_id = None
+            if source is not None:
+                original = self.story_store.find_by_content(source)
+                if original is not None:
+                    book_id = original["book_id"]
+                    pdf_name = pdf_name or original["pdf_name"]
+            with span("file_save", story_type=story_type):
+                story = self.story_store.save(story_content, story_type, pdf_name=pdf_name, pdf_hash=pdf_hash,
+                                              prompts_hash=prompts_hash, request_id=request_id, book_id=book_id)
 
-            with open(story_path, "w", encoding="utf-8") as f:
-                f.write(story_content)
-
-            logger.info(f"{story_type.capitalize()} story saved: {story_path}")
-            return str(story_path)
+            logger.info(f"{story_type.capitalize()} story saved: {story['path']} (书籍ID: {story['book_id']})")
+            return story["path"]
         except Exception as e:
             logger.error(f"Error saving {story_type} story: {str(e)}")
             return None
 
     @staticmethod
-    def save_pdf_to_temp(pdf_file: str, temp_dir: str) -> Tuple[bool, str, str]:
+    def link_or_copy(src_path: str, dst_path: str, known_hash: Optional[str] = None) -> Tuple[str, str]:
+        """
+        把文件放到 dst_path 并返回内容的SHA-256，内存占用与文件大小无关
+
+        同一文件系统内直接创建硬链接（不复制数据，源文件之后被删除也不影响）；否则由内核复制
+        （copy_file_range，不支持时用 sendfile，都不可用时才在用户态分块复制）。
+        已知哈希时不读取文件内容；未知时读一遍源文件计算哈希。
+
+        Args:
+            src_path: 源文件路径
+            dst_path: 目标文件路径（不能已存在）
+            known_hash: 已知的内容哈希（如提交任务时已计算过），传入时不再读取文件计算
+
+        Returns:
+            Tuple[str, str]: (内容哈希, 放置方式 'link' 或 'copy')
+        """
+        try:
+            os.link(src_path, dst_path)
+        except OSError:
+            mode = "copy"
+            with open(src_path, "rb") as src_file, open(dst_path, "xb") as dest_file:
+                copy_file(src_file, dest_file)
+        else:
+            mode = "link"
+        return known_hash or hash_file(src_path, COPY_CHUNK_SIZE), mode
+
+    @staticmethod
+    def save_stream(source: BinaryIO, dst_path: str) -> str:
+        """
+        把文件对象的内容写入 dst_path，在同一次读取中计算SHA-256（如接口收到的上传内容）
+
+        Args:
+            source: 可读的二进制文件对象，从当前位置读到末尾
+            dst_path: 目标文件路径
+
+        Returns:
+            str: 内容哈希
+        """
+        digest = hashlib.sha256()
+        with open(dst_path, "wb") as dest_file:
+            _copy_chunks(source, dest_file, digest)
+        return digest.hexdigest()
+
+    @staticmethod
+    def save_pdf_to_temp(pdf_file: Union[str, bytes], temp_dir: str,
+                         pdf_hash: Optional[str] = None) -> Tuple[bool, str, str, Optional[str]]:
         """
-        保存PDF文件到临时目录
+        保存PDF文件到临时目录，同时计算PDF内容哈希（供缓存和断点使用，不必再读一遍文件）
 
         Args:
-            pdf_file: PDF文件路径或对象
+            pdf_file: PDF文件路径、带 name 属性的文件对象或文件内容
             temp_dir: 临时目录路径
+            pdf_hash: 已知的PDF内容哈希（如任务提交时已计算），硬链接时不再重新计算
 
         Returns:
-            Tuple[bool, str, str]: (是否成功, 错误信息, 临时文件路径)
+            Tuple[bool, str, str, Optional[str]]: (是否成功, 错误信息, 临时文件路径, PDF内容哈希)
         """
-        temp_pdf_path = os.path.join(temp_dir, "uploaded.pdf")
+        source = pdf_file if isinstance(pdf_file, str) else getattr(pdf_file, "name", None)
+        filename = os.path.basename(source) if source and source.lower().endswith(".pdf") else "uploaded.pdf"
+        temp_pdf_path = os.path.join(temp_dir, filename)
 
         try:
-            if isinstance(pdf_file, str):
-                if os.path.exists(pdf_file):
-                    with open(pdf_file, "rb") as src_file:
-                        with open(temp_pdf_path, "wb") as dest_file:
-                            dest_file.write(src_file.read())
-                    return True, "", temp_pdf_path
-                return False, f"错误：找不到文件 {pdf_file}", ""
-            else:
-                if hasattr(pdf_file, 'name'):
-                    shutil.copy(pdf_file.name, temp_pdf_path)
-                    return True, "", temp_pdf_path
+            with span("upload_copy") as attrs:
+                if source is not None:
+                    if not os.path.exists(source):
+                        return False, f"错误：找不到文件 {source}", "", None
+                    pdf_hash, attrs["mode"] = FileHandler.link_or_copy(source, temp_pdf_path, pdf_hash)
                 else:
                     with open(temp_pdf_path, "wb") as f:
                         f.write(pdf_file)
-                    return True, "", temp_pdf_path
+                    pdf_hash, attrs["mode"] = hashlib.sha256(pdf_file).hexdigest(), "write"
+                attrs["bytes"] = os.path.getsize(temp_pdf_path)
+                return True, "", temp_pdf_path, pdf_hash
         except Exception as e:
-            return False, f"错误：保存上传文件时出错 - {str(e)}", ""
\ No newline at end of file
+            return False, f"错误：保存上传文件时出错 - {str(e)}", "", None
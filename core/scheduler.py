@@ -0,0 +1,490 @@
+import heapq
+import json
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from core.config import Config
+from core.file import FileHandler
+from util import pdf_page_count
+from util.logger import logger
+
+# 估计每页耗时时使用最近多少本书的记录
+LATENCY_WINDOW = 20
+# 排队位置和等待时间的估计结果在队列不变时最长复用的秒数（排队时间会改变同一用户任务的先后）
+ESTIMATE_MAX_AGE = 5.0
+
+
+# 任务调度器
+class JobScheduler:
+    """
+    任务调度器：固定数量的工作线程从持久化的任务表中取任务执行
+
+    取任务的顺序：先比较显式优先级（数值越大越优先）；同一优先级内在用户之间公平轮转，
+    优先选择正在执行的任务最少、最久没有被调度的用户；同一用户的任务中页数少的书优先，
+    排队时间越长越靠前（每等待 aging_seconds_per_page 秒视为少一页），避免长书一直等待。
+    任务表保存在SQLite中，进程重启后未完成的任务重新排队（已识别的页面由断点恢复）。
+    """
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+    FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED, STATUS_CANCELLED)
+
+    def __init__(self, story_processor, db_path: Union[str, Path] = Config.SCHEDULER_DB_PATH,
+                 workers: int = Config.SCHEDULER_WORKERS, upload_dir: Union[str, Path] = Config.SCHEDULER_UPLOAD_DIR,
+                 default_seconds_per_page: float = Config.SCHEDULER_DEFAULT_SECONDS_PER_PAGE,
+                 aging_seconds_per_page: float = Config.SCHEDULER_AGING_SECONDS_PER_PAGE,
+                 retention_days: float = Config.SCHEDULER_RETENTION_DAYS):
+        """
+        Args:
+            story_processor: 执行任务的故事处理器
+            db_path: 任务表的SQLite数据库文件路径
+            workers: 同时执行的任务数
+            upload_dir: 保存排队中任务PDF的目录（重启后仍可执行）
+            default_seconds_per_page: 还没有完成记录时估计等待时间使用的每页耗时（秒）
+            aging_seconds_per_page: 排队每等待多少秒，排序时视为少一页
+            retention_days: 已结束任务的记录保留天数
+        """
+        self.story_processor = story_processor
+        self.workers = max(1, workers)
+        self.upload_dir = Path(upload_dir)
+        self.default_seconds_per_page = default_seconds_per_page
+        self.aging_seconds_per_page = aging_seconds_per_page
+        self.retention = retention_days * 24 * 3600
+        # 排队中和执行中的任务，已结束的任务只保存在任务表中
+        self._jobs: Dict[str, Dict] = {}
+        self._listeners: Dict[str, List[Callable[[str, Dict], None]]] = {}
+        self._user_running: Dict[str, int] = {}
+        self._user_last_dispatch: Dict[str, float] = {}
+        self._page_seconds = deque(maxlen=LATENCY_WINDOW)
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+        # 排队估计的缓存，队列变化时置为 None
+        self._estimates: Optional[Dict[str, Tuple[int, float]]] = None
+        self._estimated_at = 0.0
+
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                user TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                pdf_path TEXT NOT NULL,
+                pages INTEGER NOT NULL,
+                priority INTEGER NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                story_path TEXT,
+                error TEXT
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+        self._conn.commit()
+        self._recover()
+
+    def _recover(self) -> None:
+        """载入上次运行时未完成的任务：执行中断的任务重新排队，清理过期的已结束任务"""
+        with self._db_lock:
+            self._conn.execute("UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?",
+                               (self.STATUS_QUEUED, self.STATUS_RUNNING))
+            self._conn.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+                               (time.time() - self.retention,))
+            self._conn.commit()
+            rows = self._conn.execute("SELECT * FROM jobs WHERE status = ?", (self.STATUS_QUEUED,)).fetchall()
+            columns = [c[0] for c in self._conn.execute("SELECT * FROM jobs LIMIT 0").description]
+            # 用最近完成的任务估计每页耗时
+            recent = self._conn.execute(
+                "SELECT pages, finished_at - started_at FROM jobs WHERE status = ? AND pages > 0 "
+                "ORDER BY finished_at DESC LIMIT ?", (self.STATUS_SUCCEEDED, LATENCY_WINDOW)
+            ).fetchall()
+        self._page_seconds.extend(elapsed / pages for pages, elapsed in reversed(recent))
+        for row in rows:
+            job = self._from_row(dict(zip(columns, row)))
+            if not os.path.exists(job["pdf_path"]):
+                self._complete(job, self.STATUS_FAILED, error="任务的PDF文件已丢失")
+                continue
+            self.story_processor.state_manager.register_request(job["job_id"])
+            self._jobs[job["job_id"]] = job
+        if rows:
+            logger.info(f"任务调度器恢复 {len(rows)} 个未完成的任务")
+
+    @staticmethod
+    def _from_row(row: Dict) -> Dict:
+        row = dict(row)
+        row.update(json.loads(row.pop("params")))
+        return row
+
+    def start(self) -> "JobScheduler":
+        """启动工作线程"""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"任务调度器已启动: {self.workers} 个工作线程，{len(self._jobs)} 个任务排队")
+        return self
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        """停止取新任务并等待工作线程结束；执行中的任务会完成，排队的任务留在任务表中"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def submit(self, pdf_file: str, user: str = "anonymous", job_id: Optional[str] = None,
+               priority: int = 0, filename: Optional[str] = None,
+               vl_system_prompt: str = Config.DEFAULT_VL_SYSTEM_PROMPT,
+               story_system_prompt: str = Config.DEFAULT_STORY_SYSTEM_PROMPT,
+               image_policy: str = Config.DEFAULT_IMAGE_POLICY, retry_failed: bool = False,
+               listener: Optional[Callable[[str, Dict], None]] = None, pdf_hash: Optional[str] = None) -> Dict:
+        """
+        提交任务
+
+        PDF被硬链接（不在同一文件系统时由内核复制）到 upload_dir，内容哈希随任务保存，
+        执行时不再重新计算；任务写入任务表后排队等待执行。
+
+        Args:
+            pdf_file: PDF文件路径
+            user: 提交任务的用户，用于在用户之间公平调度
+            job_id: 任务ID，默认新生成；界面传入其请求ID，以便"停止生成"作用于该任务
+            priority: 优先级，数值越大越优先
+            filename: 原始文件名，生成的故事文件以其命名
+            listener: 任务事件回调 listener(event, data)，在提交前注册，不会错过任何事件
+            pdf_hash: 已知的PDF内容哈希（如接口保存上传内容时已计算），None 表示提交时计算
+
+        Returns:
+            Dict: 任务信息（含排队位置和预计等待时间）
+
+        Raises:
+            ValueError: PDF无法读取
+        """
+        if not pdf_file:
+            raise ValueError("错误：未上传PDF文件")
+        state_manager = self.story_processor.state_manager
+        job_id = job_id or state_manager.generate_request_id()
+        filename = os.path.basename(filename or pdf_file)
+        job_dir = self.upload_dir / job_id
+        job_dir.mkdir(parents=True, exist_ok=True)
+        pdf_path = str(job_dir / filename)
+        try:
+            pdf_hash, _ = FileHandler.link_or_copy(pdf_file, pdf_path, pdf_hash)
+            pages = pdf_page_count(pdf_path)
+        except Exception as e:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise ValueError(f"无法读取PDF文件: {e}")
+        state_manager.register_request(job_id)
+
+        params = {"vl_system_prompt": vl_system_prompt, "story_system_prompt": story_system_prompt,
+                  "image_policy": image_policy, "retry_failed": retry_failed, "pdf_hash": pdf_hash}
+        job = {"job_id": job_id, "user": user, "filename": filename, "pdf_path": pdf_path, "pages": pages,
+               "priority": priority, "status": self.STATUS_QUEUED, "created_at": time.time(),
+               "started_at": None, "finished_at": None, "story_path": None, "error": None, **params}
+        with self._db_lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, user, filename, pdf_path, pages, priority, params, status, "
+                "created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, user, filename, pdf_path, pages, priority, json.dumps(params, ensure_ascii=False),
+                 self.STATUS_QUEUED, job["created_at"])
+            )
+            self._conn.commit()
+        with self._cond:
+            if listener is not None:
+                self._listeners.setdefault(job_id, []).append(listener)
+            self._jobs[job_id] = job
+            self._estimates = None
+            self._cond.notify()
+        logger.info(f"任务已提交: {filename} ({pages} 页，用户 {user}，优先级 {priority}) (请求ID: {job_id})")
+        self._emit(job_id, "status", {"status": self.STATUS_QUEUED})
+        return self.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        取消任务：排队中的任务立即结束，执行中的任务正在进行的模型请求立即关闭
+
+        不在本进程中的任务通过共享的请求状态存储通知执行它的进程（见 Config.STATE_BACKEND）。
+        """
+        state_manager = self.story_processor.state_manager
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return state_manager.stop(job_id)
+            job["cancel_requested"] = True
+            state_manager.stop(job_id)
+            if job["status"] != self.STATUS_QUEUED:
+                return True
+            del self._jobs[job_id]
+            self._estimates = None
+        state_manager.cleanup_request(job_id)
+        self._complete(job, self.STATUS_CANCELLED)
+        return True
+
+    def subscribe(self, job_id: str, listener: Callable[[str, Dict], None]) -> bool:
+        """注册任务事件回调，任务已结束时返回 False"""
+        with self._cond:
+            if job_id not in self._jobs:
+                return False
+            self._listeners.setdefault(job_id, []).append(listener)
+            return True
+
+    def unsubscribe(self, job_id: str, listener: Callable[[str, Dict], None]) -> None:
+        with self._cond:
+            listeners = self._listeners.get(job_id, [])
+            if listener in listeners:
+                listeners.remove(listener)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """
+        查询任务；排队中的任务附带排队位置 (position) 和预计等待秒数 (estimated_wait_s)，
+        执行中的任务附带请求状态中的最近进度 (progress, desc)，包括在其他进程中执行的任务
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job = dict(job)
+                if job["status"] == self.STATUS_QUEUED:
+                    position, wait = self._estimate(job_id)
+                    job.update(position=position, estimated_wait_s=round(wait, 1))
+        if job is None:
+            with self._db_lock:
+                cursor = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,))
+                row = cursor.fetchone()
+                columns = [c[0] for c in cursor.description]
+            if row is None:
+                return None
+            job = self._from_row(dict(zip(columns, row)))
+        if job["status"] == self.STATUS_RUNNING:
+            snapshot = self.story_processor.state_manager.progress(job_id)
+            if snapshot is not None:
+                job.update(progress=round(snapshot["progress"], 3), desc=snapshot["desc"])
+        return job
+
+    def stats(self) -> Dict:
+        with self._cond:
+            queued = sum(job["status"] == self.STATUS_QUEUED for job in self._jobs.values())
+            return {
+                "workers": self.workers,
+                "running": len(self._jobs) - queued,
+                "queued": queued,
+                "seconds_per_page": round(self.seconds_per_page(), 2),
+                "running_by_user": {user: count for user, count in self._user_running.items() if count},
+            }
+
+    def seconds_per_page(self) -> float:
+        """最近完成的书的平均每页耗时"""
+        if not self._page_seconds:
+            return self.default_seconds_per_page
+        return sum(self._page_seconds) / len(self._page_seconds)
+
+    def _sort_key(self, job: Dict, now: float) -> Tuple[float, float]:
+        """同一用户的任务中页数少的优先，排队越久越靠前"""
+        waited = now - job["created_at"]
+        return job["pages"] - waited / self.aging_seconds_per_page, job["created_at"]
+
+    def _choose(self, queued: List[Dict], running: Dict[str, int], last_dispatch: Dict[str, float],
+                now: float) -> Optional[Dict]:
+        """按优先级、用户公平和页数选择下一个任务（调用方需持有 self._cond）"""
+        if not queued:
+            return None
+        top = max(job["priority"] for job in queued)
+        candidates = [job for job in queued if job["priority"] == top]
+        user = min({job["user"] for job in candidates},
+                   key=lambda u: (running.get(u, 0), last_dispatch.get(u, 0.0)))
+        return min((job for job in candidates if job["user"] == user), key=lambda job: self._sort_key(job, now))
+
+    def _estimate(self, job_id: str) -> Tuple[int, float]:
+        """
+        估计任务前面还有几个任务以及需要等待的秒数（调用方需持有 self._cond）
+
+        整个队列的模拟结果缓存到队列变化为止（最长 ESTIMATE_MAX_AGE 秒），期间的查询只扣除已过去的时间。
+        """
+        now = time.time()
+        if self._estimates is None or now - self._estimated_at > ESTIMATE_MAX_AGE:
+            self._estimates = self._simulate(now)
+            self._estimated_at = now
+        position, start = self._estimates.get(job_id, (0, 0.0))
+        return position, max(0.0, start - (now - self._estimated_at))
+
+    def _simulate(self, now: float) -> Dict[str, Tuple[int, float]]:
+        """
+        模拟调度顺序，返回每个排队任务的 (排队位置, 预计开始前的等待秒数)（调用方需持有 self._cond）
+
+        每本书的耗时按 页数 x 最近的平均每页耗时 估计，执行中的任务扣除已用时间。
+        """
+        per_page = self.seconds_per_page()
+        free_at = [max(0.0, job["pages"] * per_page - (now - job["started_at"]))
+                   for job in self._jobs.values() if job["status"] == self.STATUS_RUNNING]
+        free_at += [0.0] * max(0, self.workers - len(free_at))
+        heapq.heapify(free_at)
+        queued = [job for job in self._jobs.values() if job["status"] == self.STATUS_QUEUED]
+        running = dict(self._user_running)
+        last_dispatch = dict(self._user_last_dispatch)
+        estimates = {}
+        while queued:
+            job = self._choose(queued, running, last_dispatch, now)
+            start = heapq.heappop(free_at)
+            estimates[job["job_id"]] = (len(estimates), start)
+            queued.remove(job)
+            running[job["user"]] = running.get(job["user"], 0) + 1
+            last_dispatch[job["user"]] = now + start
+            heapq.heappush(free_at, start + job["pages"] * per_page)
+        return estimates
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    queued = [job for job in self._jobs.values() if job["status"] == self.STATUS_QUEUED]
+                    job = self._choose(queued, self._user_running, self._user_last_dispatch, time.time())
+                    if job is not None:
+                        break
+                    self._cond.wait()
+                job["status"] = self.STATUS_RUNNING
+                job["started_at"] = time.time()
+                self._user_running[job["user"]] = self._user_running.get(job["user"], 0) + 1
+                self._user_last_dispatch[job["user"]] = job["started_at"]
+                self._estimates = None
+            try:
+                self._run(job)
+            except Exception as e:
+                logger.error(f"任务执行出错 (请求ID: {job['job_id']}): {e}")
+                self._complete(job, self.STATUS_FAILED, error=str(e))
+            finally:
+                with self._cond:
+                    self._user_running[job["user"]] -= 1
+                    self._jobs.pop(job["job_id"], None)
+                    self._estimates = None
+                    self._cond.notify_all()
+
+    def _run(self, job: Dict) -> None:
+        """执行任务，通过事件回调报告进度、故事内容和结果"""
+        job_id = job["job_id"]
+        with self._db_lock:
+            self._conn.execute("UPDATE jobs SET status = ?, started_at = ? WHERE job_id = ?",
+                               (self.STATUS_RUNNING, job["started_at"], job_id))
+            self._conn.commit()
+        # 排队期间请求状态可能已过期被清理
+        self.story_processor.state_manager.register_request(job_id)
+        self._emit(job_id, "status", {"status": self.STATUS_RUNNING})
+        logger.info(f"任务开始执行: {job['filename']} ({job['pages']} 页，用户 {job['user']}) (请求ID: {job_id})")
+
+        def progress(value: float, desc: str = "") -> None:
+            self._emit(job_id, "progress", {"progress": round(value, 3), "desc": desc})
+
+        # process_pdf 先逐段产出部分故事，最后产出完整故事及文件路径；出错或停止时最后产出提示信息。
+        # 没有文件路径的输出立即转发，最后一条的结果随结束事件发送
+        story, story_path = "", None
+        for story, story_path in self.story_processor.process_pdf(
+                job["pdf_path"], job_id, job["vl_system_prompt"], job["story_system_prompt"], job["image_policy"],
+                retry_failed=job["retry_failed"], progress=progress, pdf_hash=job.get("pdf_hash")):
+            if not story_path:
+                self._emit(job_id, "story", {"story": story})
+
+        if story_path:
+            self._page_seconds.append((time.time() - job["started_at"]) / max(1, job["pages"]))
+            self._complete(job, self.STATUS_SUCCEEDED, story=story, story_path=story_path)
+        elif job.get("cancel_requested"):
+            self._complete(job, self.STATUS_CANCELLED)
+        else:
+            self._complete(job, self.STATUS_FAILED, error=story)
+
+    def _complete(self, job: Dict, status: str, story: Optional[str] = None, story_path: Optional[str] = None,
+                  error: Optional[str] = None) -> None:
+        """记录任务结果、删除保存的PDF并发送结束事件"""
+        job.update(status=status, finished_at=time.time(), story_path=story_path, error=error)
+        with self._db_lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, story_path = ?, error = ? WHERE job_id = ?",
+                (status, job["finished_at"], story_path, error, job["job_id"])
+            )
+            self._conn.commit()
+        shutil.rmtree(os.path.dirname(job["pdf_path"]), ignore_errors=True)
+        logger.info(f"任务结束: {status} (请求ID: {job['job_id']})")
+        result = dict(job)
+        if story is not None:
+            result["story"] = story
+        self._emit(job["job_id"], status, result)
+        with self._cond:
+            self._listeners.pop(job["job_id"], None)
+
+    def _emit(self, job_id: str, event: str, data: Dict) -> None:
+        with self._cond:
+            listeners = list(self._listeners.get(job_id, []))
+        for listener in listeners:
+            try:
+                listener(event, data)
+            except Exception as e:
+                logger.error(f"任务事件回调出错 (请求ID: {job_id}): {e}")
+
+    def stream(self, progress=None, cancel_on_close: bool = True,
+               **submit_kwargs) -> Iterator[Tuple[str, Optional[str]]]:
+        """
+        提交任务并等待其完成，产出与 StoryProcessor.process_pdf 相同的 (故事内容, 中文文件路径)
+
+        排队期间通过 progress 显示排队位置和预计等待时间，执行期间转发任务进度。
+        任务结束前生成器被关闭（如界面的客户端断开连接）时取消任务，不再为无人接收的结果排队或执行。
+
+        Args:
+            progress: 进度回调，如 Gradio 进度条对象
+            cancel_on_close: 为 False 时生成器被关闭后任务继续在后台执行，结果仍保存到故事存储
+            **submit_kwargs: 传给 submit 的参数
+        """
+        events: queue.Queue = queue.Queue()
+
+        def listener(event: str, data: Dict) -> None:
+            events.put((event, data))
+
+        try:
+            job = self.submit(listener=listener, **submit_kwargs)
+        except ValueError as e:
+            yield str(e), None
+            return
+        job_id = job["job_id"]
+        finished = False
+        try:
+            while True:
+                try:
+                    event, data = events.get(timeout=1.0)
+                except queue.Empty:
+                    info = self.get(job_id)
+                    if info and info["status"] == self.STATUS_QUEUED and progress is not None:
+                        progress(0.0, desc=f"排队中：前面还有 {info['position']} 个任务，"
+                                           f"预计等待 {int(info['estimated_wait_s'])} 秒")
+                    continue
+                if event in self.FINISHED_STATUSES:
+                    finished = True
+                if event == "progress":
+                    if progress is not None:
+                        progress(data["progress"], desc=data["desc"])
+                elif event == "story":
+                    yield data["story"], None
+                elif event == self.STATUS_SUCCEEDED:
+                    yield data["story"], data["story_path"]
+                    return
+                elif event == self.STATUS_FAILED:
+                    yield data["error"], None
+                    return
+                elif event == self.STATUS_CANCELLED:
+                    yield "处理已停止", None
+                    return
+        finally:
+            self.unsubscribe(job_id, listener)
+            if not finished and cancel_on_close:
+                logger.info(f"结果接收方已断开，取消任务 (请求ID: {job_id})")
+                self.cancel(job_id)
@@ -1,31 +1,353 @@
+import sqlite3
+import threading
+import time
 import uuid
-from typing import Tuple, Optional, Dict, List, Union
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Tuple, Optional, Dict, List, Union, Iterable, Set
 
+from core.config import Config
+from util.cancel import CancelToken
 from util.logger import logger
 
+# 两次清理过期请求状态之间的最短间隔（秒）
+PRUNE_INTERVAL = 60.0
+# 按请求ID批量查询时每条语句的最多参数个数（低于 SQLite 的参数个数上限）
+SQL_BATCH_SIZE = 500
+
+
+class StateStore(ABC):
+    """
+    请求状态存储：每个请求的停止标志和最近一次进度
+
+    shared 为 True 的存储可被同一主机上的多个进程共享，一个进程中的停止请求
+    会被执行该请求的进程读到。超过 ttl 秒没有更新的请求状态会被清理，
+    未能正常结束的请求不会一直占用存储。
+    """
+
+    shared = False
+
+    @abstractmethod
+    def create(self, request_id: str) -> None:
+        """登记请求，已存在时保持原状态"""
+
+    @abstractmethod
+    def delete(self, request_id: str) -> None:
+        """删除请求状态（请求结束时）"""
+
+    @abstractmethod
+    def existing(self, request_ids: Iterable[str]) -> Set[str]:
+        """返回其中仍存在（未结束且未过期）的请求ID"""
+
+    @abstractmethod
+    def request_stop(self, request_id: str) -> bool:
+        """设置停止标志，请求不存在时返回 False"""
+
+    @abstractmethod
+    def stopped(self, request_ids: Iterable[str]) -> Set[str]:
+        """返回其中已被请求停止的请求ID"""
+
+    @abstractmethod
+    def set_progress(self, request_id: str, value: float, desc: str) -> None:
+        """记录最近一次进度（请求不存在时忽略）"""
+
+    @abstractmethod
+    def get(self, request_id: str) -> Optional[Dict]:
+        """
+        读取请求状态快照
+
+        Returns:
+            Optional[Dict]: {"stop", "progress", "desc", "created_at", "updated_at"}，请求不存在时为 None
+        """
+
+    @abstractmethod
+    def prune(self) -> int:
+        """清理超过 ttl 秒没有更新的请求状态，返回清理的条数"""
+
+
+class MemoryStateStore(StateStore):
+    """进程内的请求状态存储，加锁后可在多个线程间共享"""
+
+    def __init__(self, ttl: float = Config.STATE_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._states: Dict[str, Dict] = {}
+        self._last_prune = time.time()
+
+    def create(self, request_id: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._states.setdefault(request_id, {"stop": False, "progress": 0.0, "desc": "",
+                                                 "created_at": now, "updated_at": now})
+            if now - self._last_prune >= PRUNE_INTERVAL:
+                self._prune(now)
+
+    def delete(self, request_id: str) -> None:
+        with self._lock:
+            self._states.pop(request_id, None)
+
+    def existing(self, request_ids: Iterable[str]) -> Set[str]:
+        with self._lock:
+            return {request_id for request_id in request_ids if request_id in self._states}
+
+    def request_stop(self, request_id: str) -> bool:
+        with self._lock:
+            state = self._states.get(request_id)
+            if state is None:
+                return False
+            state.update(stop=True, updated_at=time.time())
+            return True
+
+    def stopped(self, request_ids: Iterable[str]) -> Set[str]:
+        with self._lock:
+            return {request_id for request_id in request_ids
+                    if self._states.get(request_id, {}).get("stop")}
+
+    def set_progress(self, request_id: str, value: float, desc: str) -> None:
+        with self._lock:
+            state = self._states.get(request_id)
+            if state is not None:
+                state.update(progress=value, desc=desc, updated_at=time.time())
+
+    def get(self, request_id: str) -> Optional[Dict]:
+        with self._lock:
+            state = self._states.get(request_id)
+            return dict(state) if state is not None else None
+
+    def prune(self) -> int:
+        with self._lock:
+            return self._prune(time.time())
+
+    def _prune(self, now: float) -> int:
+        """调用方需持有 self._lock"""
+        self._last_prune = now
+        expired = [request_id for request_id, state in self._states.items() if now - state["updated_at"] > self.ttl]
+        for request_id in expired:
+            del self._states[request_id]
+        if expired:
+            logger.info(f"清理 {len(expired)} 个过期的请求状态")
+        return len(expired)
+
+
+class SqliteStateStore(StateStore):
+    """
+    基于本地SQLite文件的请求状态存储，同一主机上的多个工作进程打开同一个文件即可共享停止标志和进度
+    """
+
+    shared = True
+
+    def __init__(self, db_path: Union[str, Path] = Config.STATE_DB_PATH, ttl: float = Config.STATE_TTL_SECONDS):
+        """
+        Args:
+            db_path: SQLite数据库文件路径
+            ttl: 请求状态在最后一次更新后保留的秒数
+        """
+        self.db_path = str(db_path)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # 状态丢失时最多影响一次停止或进度显示，不需要每次提交都刷盘
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS request_states (
+                request_id TEXT PRIMARY KEY,
+                stop INTEGER NOT NULL DEFAULT 0,
+                progress REAL NOT NULL DEFAULT 0,
+                description TEXT NOT NULL DEFAULT '',
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_request_states_updated_at ON request_states (updated_at)")
+        self._conn.commit()
+        self.prune()
+
+    def _write(self, sql: str, params: Tuple) -> int:
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            self._conn.commit()
+            return cursor.rowcount
+
+    def create(self, request_id: str) -> None:
+        now = time.time()
+        self._write("INSERT OR IGNORE INTO request_states (request_id, created_at, updated_at) VALUES (?, ?, ?)",
+                    (request_id, now, now))
+        if now - self._last_prune >= PRUNE_INTERVAL:
+            self.prune()
+
+    def delete(self, request_id: str) -> None:
+        self._write("DELETE FROM request_states WHERE request_id = ?", (request_id,))
+
+    def existing(self, request_ids: Iterable[str]) -> Set[str]:
+        return self._select_ids("", request_ids)
+
+    def request_stop(self, request_id: str) -> bool:
+        return self._write("UPDATE request_states SET stop = 1, updated_at = ? WHERE request_id = ?",
+                           (time.time(), request_id)) > 0
+
+    def stopped(self, request_ids: Iterable[str]) -> Set[str]:
+        return self._select_ids("stop = 1 AND ", request_ids)
+
+    def _select_ids(self, condition: str, request_ids: Iterable[str]) -> Set[str]:
+        request_ids = list(request_ids)
+        found = set()
+        # 分批查询，请求ID很多时（大量并发或未清理的请求）也不会超出 SQLite 的参数个数上限
+        for start in range(0, len(request_ids), SQL_BATCH_SIZE):
+            batch = request_ids[start:start + SQL_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT request_id FROM request_states WHERE {condition}request_id IN ({placeholders})",
+                    batch
+                ).fetchall()
+            found.update(row[0] for row in rows)
+        return found
+
+    def set_progress(self, request_id: str, value: float, desc: str) -> None:
+        self._write("UPDATE request_states SET progress = ?, description = ?, updated_at = ? WHERE request_id = ?",
+                    (value, desc, time.time(), request_id))
+
+    def get(self, request_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT stop, progress, description, created_at, updated_at FROM request_states WHERE request_id = ?",
+                (request_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"stop": bool(row[0]), "progress": row[1], "desc": row[2], "created_at": row[3], "updated_at": row[4]}
+
+    def prune(self) -> int:
+        self._last_prune = time.time()
+        removed = self._write("DELETE FROM request_states WHERE updated_at < ?", (self._last_prune - self.ttl,))
+        if removed:
+            logger.info(f"清理 {removed} 个过期的请求状态")
+        return removed
+
+
+def create_state_store(backend: str = Config.STATE_BACKEND) -> StateStore:
+    """按配置创建请求状态存储：memory（进程内）或 sqlite（同一主机的多个进程共享）"""
+    if backend == "memory":
+        return MemoryStateStore()
+    if backend == "sqlite":
+        return SqliteStateStore()
+    raise ValueError(f"未知的请求状态存储: {backend}")
+
 
 # 全局状态管理
 class StateManager:
-    """状态管理类，处理请求状态和文件管理"""
+    """
+    状态管理类，处理请求状态
 
-    def __init__(self):
-        self.request_states: Dict[str, Dict] = {}
+    停止标志和进度保存在 StateStore 中；取消令牌只存在于执行请求的进程内。使用共享存储时，
+    后台线程定期检查本进程中正在执行的请求是否已被其他进程请求停止，并取消对应的令牌。
+    """
+
+    def __init__(self, store: Optional[StateStore] = None, poll_interval: float = Config.STATE_POLL_INTERVAL):
+        """
+        Args:
+            store: 请求状态存储，默认按 Config.STATE_BACKEND 创建
+            poll_interval: 使用共享存储时检查停止标志的间隔（秒）
+        """
+        self.store = store or create_state_store()
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._tokens: Dict[str, CancelToken] = {}
+        self._watcher: Optional[threading.Thread] = None
+        self._last_sync = time.time()
 
     def generate_request_id(self) -> str:
         """生成新的请求ID并初始化状态"""
         request_id = str(uuid.uuid4())
-        self.request_states[request_id] = {'stop': False}
+        self.register_request(request_id)
         return request_id
 
-    def stop_generation(self, request_id: str) -> str:
-        """停止特定请求的故事生成过程"""
-        if request_id in self.request_states:
-            self.request_states[request_id]['stop'] = True
+    def register_request(self, request_id: str) -> None:
+        """登记由外部指定的请求ID（如重启后恢复的任务），已存在时保持原状态"""
+        self.store.create(request_id)
+        with self._lock:
+            self._tokens.setdefault(request_id, CancelToken())
+            if self.store.shared and self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="state-watcher", daemon=True)
+                self._watcher.start()
+            sync = not self.store.shared and time.time() - self._last_sync >= PRUNE_INTERVAL
+        if sync:
+            self._sync_tokens()
+
+    def cancel_token(self, request_id: str) -> Optional[CancelToken]:
+        """请求的取消令牌，处理过程中的模型请求和页面渲染都绑定该令牌"""
+        with self._lock:
+            return self._tokens.get(request_id)
+
+    def is_stopped(self, request_id: str) -> bool:
+        """
+        检查请求是否已被停止
+
+        本进程中的请求只读取取消令牌，不访问存储（共享存储中的停止标志由后台线程同步到令牌）。
+        """
+        token = self.cancel_token(request_id)
+        if token is not None:
+            return token.cancelled
+        return bool(self.store.stopped([request_id]))
+
+    def stop(self, request_id: str) -> bool:
+        """
+        停止请求：正在进行的模型请求立即关闭，不再等到下一页
+
+        请求在其他进程中执行时（共享存储），由该进程在 poll_interval 内读到停止标志。
+
+        Returns:
+            bool: 是否找到该请求
+        """
+        found = self.store.request_stop(request_id)
+        token = self.cancel_token(request_id)
+        if token is not None:
+            token.cancel()
+        if found or token is not None:
             logger.info(f"用户请求停止故事生成 (请求ID: {request_id})")
-            return "正在停止生成过程..."
-        return "未找到对应的生成任务"
+            return True
+        return False
+
+    def stop_generation(self, request_id: str) -> str:
+        """停止特定请求的故事生成过程，返回界面提示"""
+        return "正在停止生成过程..." if self.stop(request_id) else "未找到对应的生成任务"
+
+    def update_progress(self, request_id: str, value: float, desc: str) -> None:
+        """记录请求的最近一次进度，供 progress() 查询"""
+        self.store.set_progress(request_id, value, desc)
+
+    def progress(self, request_id: str) -> Optional[Dict]:
+        """读取请求的进度快照（任意进程中的请求均可查询），请求不存在或已结束时为 None"""
+        return self.store.get(request_id)
 
     def cleanup_request(self, request_id: str) -> None:
         """清理请求状态"""
-        if request_id in self.request_states:
-            del self.request_states[request_id]
\ No newline at end of file
+        self.store.delete(request_id)
+        with self._lock:
+            self._tokens.pop(request_id, None)
+
+    def _sync_tokens(self) -> None:
+        """把其他进程写入存储的停止标志同步到本进程的取消令牌，并丢弃状态已过期的请求的令牌"""
+        with self._lock:
+            self._last_sync = time.time()
+            tokens = dict(self._tokens)
+        if not tokens:
+            return
+        for request_id in self.store.stopped(tokens):
+            if not tokens[request_id].cancelled:
+                logger.info(f"其他进程请求停止故事生成 (请求ID: {request_id})")
+                tokens[request_id].cancel()
+        existing = self.store.existing(tokens)
+        with self._lock:
+            for request_id in tokens.keys() - existing:
+                self._tokens.pop(request_id, None)
+
+    def _watch(self) -> None:
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self._sync_tokens()
+            except sqlite3.Error as e:
+                logger.error(f"读取共享请求状态出错: {e}")
@@ -1,59 +1,122 @@
 # 故事处理类
+import contextvars
 import datetime
+import itertools
+import os
 import tempfile
 import time
 import traceback
-from typing import Tuple, Optional, List, Union
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Tuple, Optional, List, Union, Iterable, Iterator, Dict, Generator
 from core import FileHandler
 from core import StateManager
-import gradio as gr
+from core.cache import BookCache, CaptionCache, SingleFlight, TranslationCache
+from core.checkpoint import PageCheckpoint
+from core.story_store import StoryStore
+from core.translate import ChunkedTranslator
 
 from core.config import Config
-from llm import generate_story, get_text_from_image
-from util import log_error, log_translation, pdf_convert_page_to_image
-from util.logger import logger, log_story_generation
+from llm import (STORY_MODEL, VL_MODEL, CompactionStats, caption_message, generate_story, get_limiter,
+                 get_text_from_image, limiter_stats, record_aborted_call, record_avoided_calls, record_usage)
+from util import ImagePolicy, PageFilter, log_error, log_translation, pdf_convert_page_to_image, pdf_iter_page_images, pdf_page_count, page_fingerprint
+from util.cancel import Cancelled, CancelToken, set_cancel_token
+from util.logger import current_request_id, logger, log_story_generation
+from util.metrics import metrics, set_request_id, span
 
 
 class StoryProcessor:
     """故事处理类，处理故事生成和翻译"""
 
-    def __init__(self, state_manager: StateManager, file_handler: FileHandler):
+    def __init__(self, state_manager: StateManager, file_handler: FileHandler,
+                 caption_cache: Optional[CaptionCache] = None, book_cache: Optional[BookCache] = None,
+                 checkpoint: Optional[PageCheckpoint] = None):
         self.state_manager = state_manager
         self.file_handler = file_handler
-
-    def _update_progress(self, progress: gr.Progress, value: float, desc: str) -> None:
+        if caption_cache is None and Config.CAPTION_CACHE_ENABLED:
+            caption_cache = CaptionCache(Config.CAPTION_CACHE_PATH, Config.CAPTION_CACHE_MAX_BYTES)
+        self.caption_cache = caption_cache
+        if book_cache is None and Config.BOOK_CACHE_ENABLED:
+            book_cache = BookCache(Config.BOOK_CACHE_PATH, Config.BOOK_CACHE_MAX_ENTRIES)
+        self.book_cache = book_cache
+        if checkpoint is None and Config.PAGE_CHECKPOINT_ENABLED:
+            checkpoint = PageCheckpoint(Config.PAGE_CHECKPOINT_PATH, Config.PAGE_CHECKPOINT_MAX_AGE_DAYS)
+        self.checkpoint = checkpoint
+        self.single_flight = SingleFlight()
+        translation_cache = None
+        if Config.TRANSLATION_CACHE_ENABLED:
+            translation_cache = TranslationCache(Config.TRANSLATION_CACHE_PATH, Config.TRANSLATION_CACHE_MAX_BYTES)
+        self.translator = ChunkedTranslator(translation_cache)
+
+    def _update_progress(self, progress, value: float, desc: str) -> None:
         """
-        更新进度条
+        更新进度条，并把进度记录到当前请求的状态中（供 StateManager.progress 查询）
 
         Args:
-            progress: Gradio进度条对象
+            progress: 进度回调（如 Gradio 进度条对象），None 表示不报告进度
             value: 进度值 (0-1)
             desc: 进度描述
         """
-
-        print("zq:", progress)
-
-        if isinstance(progress, gr.Progress):
+        request_id = current_request_id()
+        if request_id is not None:
+            self.state_manager.update_progress(request_id, value, desc)
+        if progress is not None:
             progress(value, desc=desc)
 
     def process_pdf(self, pdf_file: str, request_id: str,
                     vl_system_prompt: str = Config.DEFAULT_VL_SYSTEM_PROMPT,
                     story_system_prompt: str = Config.DEFAULT_STORY_SYSTEM_PROMPT,
-                    progress=gr.Progress()):
+                    image_policy: str = Config.DEFAULT_IMAGE_POLICY,
+                    retry_failed: bool = False,
+                    progress=None,
+                    pdf_hash: Optional[str] = None):
         """
         处理PDF文件并生成故事
 
+        同一本书（PDF内容、图片识别提示、模型和页面图片策略均相同）之前中断或失败时，
+        已识别的页面从断点读取，只识别尚未处理的页面。
+
         Args:
             pdf_file: PDF文件路径
             request_id: 请求ID
             vl_system_prompt: 图片识别系统提示
             story_system_prompt: 故事生成系统提示
-            progress: Gradio进度条对象
-
-        Returns:
-            Tuple[str, Optional[str], Optional[str]]: (故事内容, 中文文件路径)
+            image_policy: 页面图片策略名称，见 Config.IMAGE_POLICIES
+            retry_failed: 是否重新识别断点中记录为失败的页面；为 False 时失败页面保持缺失
+            progress: 进度回调，界面中为 Gradio 进度条对象；None 表示不报告进度
+            pdf_hash: 已知的PDF内容哈希（如任务调度器提交任务时已计算），None 表示保存PDF时计算
+
+        Yields:
+            Tuple[str, Optional[str]]: (故事内容, 中文文件路径)。故事生成过程中不断产出
+            当前已生成的部分故事（文件路径为None），最后一次产出完整故事及其文件路径
         """
+        # 流水线的每一步都在绑定了请求ID和取消令牌的上下文中执行，各阶段的耗时记录都带上该请求ID，
+        # 停止时正在进行的模型请求随令牌取消而关闭
+        yield from self._run_with_request_id(request_id, self._process_pdf(
+            pdf_file, request_id, vl_system_prompt, story_system_prompt, image_policy, retry_failed, progress,
+            pdf_hash
+        ), self.state_manager.cancel_token(request_id))
+
+    @staticmethod
+    def _run_with_request_id(request_id: str, generator: Generator, cancel_token: Optional[CancelToken] = None):
+        """在绑定了请求ID和取消令牌的独立上下文中逐步执行生成器"""
+        context = contextvars.copy_context()
+        context.run(set_request_id, request_id)
+        context.run(set_cancel_token, cancel_token)
+        try:
+            while True:
+                try:
+                    item = context.run(next, generator)
+                except StopIteration as stop:
+                    return stop.value
+                yield item
+        finally:
+            context.run(generator.close)
+
+    def _process_pdf(self, pdf_file: str, request_id: str, vl_system_prompt: str, story_system_prompt: str,
+                     image_policy: str, retry_failed: bool, progress, pdf_hash: Optional[str]):
+        """process_pdf 的实现"""
         start_time = time.time()
+        cancel_token = self.state_manager.cancel_token(request_id)
 
         try:
             # 初始化处理环境
@@ -61,47 +124,211 @@ class StoryProcessor:
 
             # 检查文件
             if not self._check_pdf_file(pdf_file):
-                return "错误：未上传PDF文件", None
+                yield "错误：未上传PDF文件", None
+                return
 
             # 处理PDF文件
-            with tempfile.TemporaryDirectory() as temp_dir:
+            with tempfile.TemporaryDirectory(dir=Config.TEMP_DIR) as temp_dir:
                 self._update_progress(progress, 0.1, "准备处理PDF文件...")
-                success, error_msg, temp_pdf_path = FileHandler.save_pdf_to_temp(pdf_file, temp_dir)
+                success, error_msg, temp_pdf_path, pdf_hash = FileHandler.save_pdf_to_temp(pdf_file, temp_dir, pdf_hash)
                 if not success:
-                    return error_msg, None
-
-                # 转换PDF为图片
-                self._update_progress(progress, 0.15, "转换PDF为图片...")
-                images_path = self._convert_pdf_to_images(temp_pdf_path)
-                if not images_path:
-                    return "无法从PDF提取页面，请确保PDF包含有效的页面内容", None
-
-                # 处理图片并生成故事
-                story = self._process_images_and_generate_story(
-                    images_path, request_id, vl_system_prompt, story_system_prompt,
-                    start_time, pdf_file, progress
-                )
+                    yield error_msg, None
+                    return
 
-                if isinstance(story, tuple):  # 错误情况
-                    return story
-
-                # 保存中文故事
-                self._update_progress(progress, 0.95, "保存生成的故事...")
-                chinese_path = self.file_handler.save_story(
-                    story, 'chinese',
-                    pdf_file if isinstance(pdf_file, str) else pdf_file.name
+                policy = ImagePolicy.from_config(
+                    Config.IMAGE_POLICIES.get(image_policy, Config.IMAGE_POLICIES[Config.DEFAULT_IMAGE_POLICY])
                 )
 
-                self._update_progress(progress, 1.0, "处理完成!")
-                return story, chinese_path
-
+                prompts_hash = StoryStore.make_prompts_hash(vl_system_prompt, story_system_prompt,
+                                                            VL_MODEL, STORY_MODEL, image_policy)
+                checkpoint_key = None
+                if self.checkpoint is not None:
+                    checkpoint_key = PageCheckpoint.make_key(pdf_hash, vl_system_prompt, VL_MODEL, image_policy)
+
+                if self.book_cache is None:
+                    result = yield from self._generate_story_from_pdf(
+                        temp_pdf_path, pdf_file, request_id, vl_system_prompt, story_system_prompt, policy,
+                        start_time, progress, checkpoint_key, retry_failed, pdf_hash, prompts_hash
+                    )
+                else:
+                    book_key = BookCache.make_key(pdf_hash, vl_system_prompt, story_system_prompt,
+                                                  VL_MODEL, STORY_MODEL, image_policy)
+                    result = yield from self._generate_story_deduplicated(
+                        book_key, temp_pdf_path, pdf_file, request_id, vl_system_prompt, story_system_prompt,
+                        policy, start_time, progress, checkpoint_key, retry_failed, pdf_hash, prompts_hash
+                    )
+                yield result
+
+        except Cancelled:
+            yield "处理已停止", None
         except Exception as e:
             error_msg = f"处理过程中出错: {str(e)}"
             error_trace = traceback.format_exc()
             log_error("ProcessingError", error_trace)
-            return error_msg, None
+            yield error_msg, None
         finally:
             self.state_manager.cleanup_request(request_id)
+            if cancel_token is not None and cancel_token.cancelled:
+                # 从用户停止到处理结束、工作线程空闲的时间
+                metrics.add_cancellation(requests=1)
+                metrics.observe("cancel_latency", time.monotonic() - cancel_token.cancelled_at, request_id)
+
+    def retry_failed_pages(self, pdf_file: str, request_id: str,
+                           vl_system_prompt: str = Config.DEFAULT_VL_SYSTEM_PROMPT,
+                           story_system_prompt: str = Config.DEFAULT_STORY_SYSTEM_PROMPT,
+                           image_policy: str = Config.DEFAULT_IMAGE_POLICY,
+                           progress=None):
+        """只重新识别断点中失败的页面并重新生成故事，已完成的页面不再重复识别"""
+        yield from self.process_pdf(pdf_file, request_id, vl_system_prompt, story_system_prompt, image_policy,
+                                    retry_failed=True, progress=progress)
+
+    def _generate_story_deduplicated(self, book_key: str, temp_pdf_path: str, pdf_file: str, request_id: str,
+                                     vl_system_prompt: str, story_system_prompt: str, policy: ImagePolicy,
+                                     start_time: float, progress, checkpoint_key: Optional[str] = None,
+                                     retry_failed: bool = False, pdf_hash: Optional[str] = None,
+                                     prompts_hash: Optional[str] = None
+                                     ) -> Generator[Tuple[str, Optional[str]], None, Tuple[str, Optional[str]]]:
+        """
+        带整本书缓存和相同任务合并的故事生成
+
+        已处理过的相同PDF（且提示词和模型相同）直接返回缓存结果；正在处理中的
+        相同任务只执行一次，其余请求等待其完成后读取缓存。执行方失败或被停止时，
+        等待者会自行接手处理。有页面识别失败的故事不写入缓存，以便之后重试失败页面。
+        """
+        while True:
+            cached = self.book_cache.get(book_key)
+            if cached is not None:
+                story, chinese_path = cached
+                if not chinese_path or not os.path.exists(chinese_path):
+                    chinese_path = self.file_handler.save_story(
+                        story, 'chinese',
+                        pdf_file if isinstance(pdf_file, str) else pdf_file.name,
+                        pdf_hash=pdf_hash, prompts_hash=prompts_hash, request_id=request_id
+                    )
+                logger.info(f"整本书缓存命中 (请求ID: {request_id})")
+                self._update_progress(progress, 1.0, "处理完成!")
+                return story, chinese_path
+
+            is_leader, done_event = self.single_flight.begin(book_key)
+            if is_leader:
+                try:
+                    story, chinese_path = yield from self._generate_story_from_pdf(
+                        temp_pdf_path, pdf_file, request_id, vl_system_prompt, story_system_prompt, policy,
+                        start_time, progress, checkpoint_key, retry_failed, pdf_hash, prompts_hash
+                    )
+                    if chinese_path is not None and not self._has_failed_pages(checkpoint_key):
+                        self.book_cache.put(book_key, story, chinese_path)
+                    return story, chinese_path
+                finally:
+                    self.single_flight.end(book_key)
+
+            logger.info(f"相同的PDF正在处理中，等待其完成 (请求ID: {request_id})")
+            self._update_progress(progress, 0.15, "相同的PDF正在处理中，等待结果...")
+            while not done_event.wait(0.5):
+                if self._is_stopped(request_id):
+                    return "处理已停止", None
+
+    def _generate_story_from_pdf(self, temp_pdf_path: str, pdf_file: str, request_id: str,
+                                 vl_system_prompt: str, story_system_prompt: str, policy: ImagePolicy,
+                                 start_time: float, progress, checkpoint_key: Optional[str] = None,
+                                 retry_failed: bool = False, pdf_hash: Optional[str] = None,
+                                 prompts_hash: Optional[str] = None
+                                 ) -> Generator[Tuple[str, Optional[str]], None, Tuple[str, Optional[str]]]:
+        """
+        渲染、识别PDF页面并生成和保存故事
+
+        生成故事时产出 (部分故事, None)，完成后返回 (故事内容或错误信息, 中文文件路径)。
+        断点中已完成的页面不再渲染和识别；全部页面成功且故事保存后删除断点。
+        """
+        captions, failed = self.checkpoint.load(checkpoint_key) if checkpoint_key else ({}, set())
+        # 边渲染边识别时由渲染线程顺带计算页面指纹，预筛选不必解码整页图片
+        fingerprints: Optional[Dict[int, Tuple[int, float]]] = {} if Config.PAGE_FILTER_ENABLED else None
+
+        # 转换PDF为图片
+        self._update_progress(progress, 0.15, "转换PDF为图片...")
+        if Config.STREAM_PDF_RENDER:
+            total_pages = self._count_pdf_pages(temp_pdf_path)
+            todo = self._pages_to_caption(total_pages, captions, failed, retry_failed)
+            images = pdf_iter_page_images(
+                temp_pdf_path,
+                dst_images_dir=Config.PAGE_IMAGES_DIR if Config.SAVE_PAGE_IMAGES else None,
+                prefetch=Config.RENDER_PREFETCH,
+                in_memory=True,
+                image_policy=policy,
+                page_numbers=todo,
+                processes=Config.RENDER_PROCESSES,
+                chunk_pages=Config.RENDER_CHUNK_PAGES,
+                fingerprints=fingerprints,
+            ) if todo else []
+            pages = self._numbered_pages(todo, images)
+        else:
+            images_path = self._convert_pdf_to_images(temp_pdf_path, policy)
+            total_pages = len(images_path) if images_path else 0
+            todo = self._pages_to_caption(total_pages, captions, failed, retry_failed)
+            pages = [(index, images_path[index]) for index in todo]
+        if not total_pages:
+            return "无法从PDF提取页面，请确保PDF包含有效的页面内容", None
+        if captions or failed:
+            logger.info(f"从断点继续 (请求ID: {request_id}): 已完成 {len(captions)} 页，"
+                        f"失败 {len(failed)} 页，本次识别 {len(todo)} 页")
+
+        # 处理图片并生成故事
+        story = yield from self._process_images_and_generate_story(
+            pages, total_pages, captions, checkpoint_key, request_id, vl_system_prompt, story_system_prompt,
+            start_time, pdf_file, progress, fingerprints
+        )
+
+        if isinstance(story, tuple):  # 错误情况
+            return story[0], None
+
+        # 保存中文故事
+        self._update_progress(progress, 0.95, "保存生成的故事...")
+        chinese_path = self.file_handler.save_story(
+            story, 'chinese',
+            pdf_file if isinstance(pdf_file, str) else pdf_file.name,
+            pdf_hash=pdf_hash, prompts_hash=prompts_hash, request_id=request_id
+        )
+
+        if checkpoint_key:
+            missing = total_pages - len(captions)
+            if missing:
+                logger.warning(f"{missing} 页未能识别，故事缺少这些页面，可使用“重试失败页面”补全 (请求ID: {request_id})")
+            else:
+                self.checkpoint.clear(checkpoint_key)
+
+        self._update_progress(progress, 1.0, "处理完成!")
+        return story, chinese_path
+
+    @staticmethod
+    def _pages_to_caption(total_pages: int, captions: Dict[int, str], failed: Iterable[int],
+                          retry_failed: bool) -> List[int]:
+        """返回本次需要识别的页码索引：断点中没有记录的页面，以及重试时之前失败的页面"""
+        return [index for index in range(total_pages)
+                if index not in captions and (retry_failed or index not in failed)]
+
+    @staticmethod
+    def _numbered_pages(indices: List[int], images: Iterable[Union[str, bytes]]
+                        ) -> Iterator[Tuple[int, Union[str, bytes]]]:
+        """把页码索引和按同样顺序渲染出的图片配对；关闭时一并关闭渲染生成器"""
+        try:
+            yield from zip(indices, images)
+        finally:
+            if hasattr(images, "close"):
+                images.close()
+
+    def _has_failed_pages(self, checkpoint_key: Optional[str]) -> bool:
+        """断点中是否还有识别失败的页面"""
+        return bool(checkpoint_key) and bool(self.checkpoint.load(checkpoint_key)[1])
+
+    def _checkpoint_page(self, checkpoint_key: Optional[str], index: int,
+                         caption: Optional[str] = None, error: Optional[str] = None) -> None:
+        """把一页的识别结果或失败原因写入断点"""
+        if not checkpoint_key:
+            return
+        if caption is not None:
+            self.checkpoint.save_page(checkpoint_key, index, caption)
+        else:
+            self.checkpoint.mark_failed(checkpoint_key, index, error or "")
 
     def translate_to_english(self, text: str) -> Tuple[str, Optional[str]]:
         """
@@ -118,23 +345,20 @@ class StoryProcessor:
             return "请先生成或输入故事内容", None
 
         try:
-            # 构建翻译提示
-            translation_prompt = f"""请将以下中文故事翻译成英文，保持故事的风格和内容不变，使其适合2-8岁的中国儿童阅读：
-{text}
-请直接输出翻译结果，不要添加任何解释或前言。"""
-
-            # 翻译故事
-            translated_text = generate_story(text, "", translation_prompt, stream=False)
+            # 分段并发翻译故事
+            translation_start = time.time()
+            with span("translation", source_length=len(text)):
+                translated_text = self.translator.translate(text)
 
             # 记录翻译信息
             log_translation(
                 source_length=len(text),
                 target_length=len(translated_text),
-                translation_time=f"{time.time() - time.time():.2f}s"
+                translation_time=f"{time.time() - translation_start:.2f}s"
             )
 
-            # 保存英文故事
-            english_path = self.file_handler.save_story(translated_text, 'english')
+            # 保存英文故事，已保存过的中文原文所属的书同时关联英文版本
+            english_path = self.file_handler.save_story(translated_text, 'english', source=text)
             if english_path:
                 logger.info(f"English story saved after translation: {english_path}")
 
@@ -155,10 +379,25 @@ class StoryProcessor:
             return False
         return True
 
-    def _convert_pdf_to_images(self, temp_pdf_path: str) -> Optional[List[str]]:
+    def _count_pdf_pages(self, temp_pdf_path: str) -> int:
+        """获取PDF页数，流式渲染时用于计算进度"""
+        try:
+            total_pages = pdf_page_count(temp_pdf_path)
+            if total_pages == 0:
+                logger.error("无法从PDF提取页面")
+            return total_pages
+        except Exception as e:
+            error_trace = traceback.format_exc()
+            logger.error(f"读取PDF页数时出错: {error_trace}")
+            return 0
+
+    def _convert_pdf_to_images(self, temp_pdf_path: str,
+                               policy: Optional[ImagePolicy] = None) -> Optional[List[str]]:
         """转换PDF为图片"""
         try:
-            images_path = pdf_convert_page_to_image(temp_pdf_path)
+            images_path = pdf_convert_page_to_image(temp_pdf_path, image_policy=policy,
+                                                    processes=Config.RENDER_PROCESSES,
+                                                    chunk_pages=Config.RENDER_CHUNK_PAGES)
             if not images_path or len(images_path) == 0:
                 logger.error("无法从PDF提取页面")
                 return None
@@ -169,37 +408,52 @@ class StoryProcessor:
             logger.error(f"转换PDF为页面时出错: {error_trace}")
             return None
 
-    def _process_images_and_generate_story(self, images_path: List[str], request_id: str,
-                                           vl_prompt: str, story_prompt: str,
-                                           start_time: float, pdf_file: str, progress
-                                           ) -> Union[str, Tuple[str, Optional[str], Optional[str]]]:
-        """处理图片并生成故事"""
-        conversation_history = [{"role": "system", "content": [{"type": "text", "text": vl_prompt}]}]
-        images_text = []
-        total_pages = len(images_path)
+    def _process_images_and_generate_story(self, pages: Iterable[Tuple[int, Union[str, bytes]]], total_pages: int,
+                                           captions: Dict[int, str], checkpoint_key: Optional[str],
+                                           request_id: str, vl_prompt: str, story_prompt: str,
+                                           start_time: float, pdf_file: str, progress,
+                                           fingerprints: Optional[Dict[int, Tuple[int, float]]] = None
+                                           ) -> Generator[Tuple[str, None], None,
+                                                          Union[str, Tuple[str, Optional[str], Optional[str]]]]:
+        """
+        处理图片并生成故事
+
+        开启 Config.STREAM_STORY 时逐段产出 (已生成的部分故事, None)，用户停止时立即关闭模型输出流。
 
+        pages 是需要识别的 (页码索引, 图片) 序列，图片可以是路径，也可以是边渲染边产出的
+        图片字节；停止或出错时会关闭生成器，使后台渲染随之结束。captions 是断点中已完成的
+        页面描述，识别结果会补充到其中，并逐页写入断点。fingerprints 是渲染时已计算的页面指纹。
+        """
         self._update_progress(progress, 0.2, f"开始处理 {total_pages} 张页面...")
 
-        for index, image_path in enumerate(images_path):
-            if self.state_manager.request_states[request_id]['stop']:
-                return "处理已停止", None, None
+        blanks: List[int] = []
+        duplicates: Dict[int, int] = {}
+        if Config.PAGE_FILTER_ENABLED:
+            pages = self._filter_pages(pages, captions, blanks, duplicates, checkpoint_key, fingerprints)
 
-            current_page = index + 1
+        try:
+            if Config.VL_PARALLEL:
+                result = self._caption_pages_parallel(pages, total_pages, captions, checkpoint_key,
+                                                      request_id, vl_prompt, progress)
+            else:
+                result = self._caption_pages_serial(pages, total_pages, captions, checkpoint_key,
+                                                    request_id, vl_prompt, progress)
+        finally:
+            if hasattr(pages, "close"):
+                pages.close()
 
-            # 计算进度百分比 (20% - 70%)
-            progress_value = 0.2 + (0.5 * (index / total_pages))
-            self._update_progress(progress, progress_value,
-                                  f"处理页面 {current_page}/{total_pages} ({int(progress_value * 100)}%)")
+        if result is None:
+            self._record_cancellation(request_id, total_pages - len(captions))
+            return "处理已停止", None, None
+        captions = result
+        self._fill_duplicate_captions(captions, blanks, duplicates, checkpoint_key, request_id)
 
-            try:
-                output, conversation_history = get_text_from_image(image_path, index, conversation_history)
-                images_text.append(output)
-                logger.info(f"页面 {current_page} 处理完成: {output}")
-            except Exception as e:
-                error_trace = traceback.format_exc()
-                logger.error(f"处理页面 {current_page} 时出错: {error_trace}")
-                continue
+        if self.caption_cache is not None:
+            logger.info(f"页面描述缓存统计: {self.caption_cache.stats()}")
+        logger.info(f"模型限流统计: {limiter_stats()}")
 
+        # 空白页的描述为空字符串，不参与故事生成
+        images_text = [captions[index] for index in sorted(captions) if captions[index]]
         if not images_text:
             return "无法处理PDF中的页面，请尝试使用其他PDF文件", None, None
 
@@ -208,8 +462,17 @@ class StoryProcessor:
 
         self._update_progress(progress, 0.7, "开始生成完整故事...")
 
+        story_start = time.monotonic()
         try:
-            story = generate_story(combined_text, story_prompt, stream=False)
+            with span("story_generation", api_name=STORY_MODEL, stream=Config.STREAM_STORY) as attrs:
+                if Config.STREAM_STORY:
+                    story = yield from self._stream_story(combined_text, story_prompt, request_id)
+                    if story is None:
+                        self._record_cancellation(request_id, 0, time.monotonic() - story_start)
+                        return "处理已停止", None, None
+                else:
+                    story = generate_story(combined_text, story_prompt, stream=False)
+                attrs["story_length"] = len(story)
 
             # 记录故事生成信息
             generation_time = time.time() - start_time
@@ -226,8 +489,317 @@ class StoryProcessor:
 
             return story
 
+        except Cancelled:
+            self._record_cancellation(request_id, 0, time.monotonic() - story_start)
+            return "处理已停止", None, None
         except Exception as e:
             error_msg = f"生成故事时出错: {str(e)}"
             error_trace = traceback.format_exc()
             log_error("StoryGenerationError", error_trace)
-            return error_msg, None, None
\ No newline at end of file
+            return error_msg, None, None
+
+    def _filter_pages(self, pages: Iterable[Tuple[int, Union[str, bytes]]], captions: Dict[int, str],
+                      blanks: List[int], duplicates: Dict[int, int], checkpoint_key: Optional[str],
+                      fingerprints: Optional[Dict[int, Tuple[int, float]]] = None
+                      ) -> Iterator[Tuple[int, Union[str, bytes]]]:
+        """
+        页面预筛选，只产出需要交给视觉模型识别的页面
+
+        空白页的描述记为空字符串并写入断点，页码记入 blanks；与之前页面近似重复的页面记入
+        duplicates（页码索引 -> 原页面的页码索引），识别完成后复用原页面的描述。需要识别的页面的
+        指纹写入断点，从断点继续时先载入已识别页面的指纹，与之重复的页面不再交给视觉模型。
+        指纹优先取渲染时已计算的 fingerprints，没有时（如图片来自文件）才解码图片计算。
+        关闭时一并关闭页面来源，使后台渲染随之结束。
+        """
+        page_filter = PageFilter(Config.PAGE_DUPLICATE_MAX_DISTANCE, Config.PAGE_BLANK_INK_RATIO,
+                                 Config.PAGE_DUPLICATE_MAX_INK_DELTA)
+        if checkpoint_key:
+            for index, (phash, ink) in sorted(self.checkpoint.load_fingerprints(checkpoint_key).items()):
+                if captions.get(index):
+                    page_filter.add(index, phash, ink)
+        try:
+            for index, image in pages:
+                try:
+                    with span("page_filter", page=index + 1) as attrs:
+                        fingerprint = fingerprints.pop(index, None) if fingerprints is not None else None
+                        phash, ink = fingerprint or page_fingerprint(image)
+                        verdict, original = page_filter.classify(index, phash, ink)
+                        attrs["result"] = verdict
+                except Exception as e:
+                    logger.warning(f"页面 {index + 1} 预筛选失败，照常识别: {e}")
+                    verdict, original = "unique", None
+                if verdict == "blank":
+                    logger.info(f"页面 {index + 1} 为空白页，跳过识别")
+                    blanks.append(index)
+                    captions[index] = ""
+                    self._checkpoint_page(checkpoint_key, index, caption="")
+                elif verdict == "duplicate":
+                    logger.info(f"页面 {index + 1} 与页面 {original + 1} 重复，复用其描述")
+                    duplicates[index] = original
+                else:
+                    if checkpoint_key and verdict == "unique":
+                        self.checkpoint.save_fingerprint(checkpoint_key, index, phash, ink)
+                    yield index, image
+        finally:
+            if hasattr(pages, "close"):
+                pages.close()
+
+    def _fill_duplicate_captions(self, captions: Dict[int, str], blanks: List[int], duplicates: Dict[int, int],
+                                 checkpoint_key: Optional[str], request_id: str) -> None:
+        """重复页面复用原页面的描述，并记录预筛选省去的视觉模型调用次数"""
+        reused = 0
+        for index, original in duplicates.items():
+            # 原页面识别失败时重复页面同样缺失，不计入省去的调用，重试失败页面时会再次筛选和识别
+            if original in captions:
+                captions[index] = captions[original]
+                self._checkpoint_page(checkpoint_key, index, caption=captions[original])
+                reused += 1
+        avoided = len(blanks) + reused
+        if avoided:
+            metrics.add_filtered_pages(blank=len(blanks), duplicate=reused)
+            record_avoided_calls(avoided)
+            logger.info(f"页面预筛选: 空白 {len(blanks)} 页，重复 {reused} 页，"
+                        f"省去 {avoided} 次视觉模型调用 (请求ID: {request_id})")
+
+    def _stream_story(self, combined_text: str, story_prompt: str,
+                      request_id: str) -> Generator[Tuple[str, None], None, Optional[str]]:
+        """
+        流式生成故事，每收到一段输出就产出当前已生成的全部内容
+
+        Returns:
+            Optional[str]: 完整故事，用户停止时返回None
+        """
+        stream = generate_story(combined_text, story_prompt, stream=True)
+        started = time.monotonic()
+        story = ""
+        try:
+            for chunk in stream:
+                if self._is_stopped(request_id):
+                    logger.info(f"故事生成过程中被停止 (请求ID: {request_id})")
+                    return None
+                if chunk.usage is not None:
+                    record_usage(chunk.usage, STORY_MODEL)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    story += chunk.choices[0].delta.content
+                    yield story, None
+        except Exception:
+            # 停止时取消令牌直接关闭了数据流的连接，读取以连接错误结束
+            if not self._is_stopped(request_id):
+                raise
+            record_aborted_call(started)
+            logger.info(f"故事生成过程中被停止 (请求ID: {request_id})")
+            return None
+        finally:
+            stream.close()
+        logger.debug(f"输出文本长度: {len(story)} 字符")
+        return story
+
+    def _is_stopped(self, request_id: str) -> bool:
+        """检查请求是否已被用户停止"""
+        return self.state_manager.is_stopped(request_id)
+
+    @staticmethod
+    def _record_cancellation(request_id: str, pages_skipped: int, story_elapsed: Optional[float] = None) -> None:
+        """
+        记录停止请求节省的工作量
+
+        节省的时间按各阶段的平均耗时估计：跳过的页面各计一次视觉模型请求，故事尚未生成完时
+        再计入故事生成的剩余时间。
+        """
+        saved = pages_skipped * (metrics.stage_mean("vl_request") or 0.0)
+        story_mean = metrics.stage_mean("story_generation") or 0.0
+        saved += story_mean if story_elapsed is None else max(0.0, story_mean - story_elapsed)
+        metrics.add_cancellation(pages_skipped=pages_skipped, saved_seconds=saved)
+        logger.info(f"请求已停止，跳过 {pages_skipped} 页，估计节省 {saved:.1f} 秒模型调用 (请求ID: {request_id})")
+
+    def _update_page_progress(self, progress, finished: int, total_pages: int) -> None:
+        """更新页面识别阶段的进度 (20% - 70%)，模型限流排队时一并显示排队情况"""
+        progress_value = 0.2 + (0.5 * (finished / total_pages))
+        desc = f"处理页面 {min(finished + 1, total_pages)}/{total_pages} ({int(progress_value * 100)}%)"
+        queue = get_limiter(VL_MODEL).stats()
+        if queue["waiting"]:
+            desc += f"，限流排队中 {queue['waiting']} 个请求（平均等待 {queue['avg_wait_s']:.1f}s）"
+        self._update_progress(progress, progress_value, desc)
+
+    @staticmethod
+    def _append_caption_history(messages: List[Dict], index: int, caption: str) -> None:
+        """
+        把已有的页面描述以纯文字形式追加到对话历史中，不再上传页面图片；空白页不追加。
+        形式与 Config.VL_HISTORY_COMPACTION 压缩后的历史一致
+        """
+        if not caption:
+            return
+        if Config.VL_HISTORY_COMPACTION == "caption":
+            messages.append(caption_message(f"图片:{index}", caption))
+            return
+        messages.append({"role": "user", "content": [{"type": "text", "text": f"图片:{index}"}]})
+        messages.append({"role": "assistant", "content": caption})
+
+    def _caption_page(self, image: Union[str, bytes], index: int, messages: List[Dict],
+                      vl_prompt: str, compaction_stats: Optional[CompactionStats] = None
+                      ) -> Tuple[str, List[Dict]]:
+        """
+        识别单个页面，优先使用页面描述缓存
+
+        缓存命中时不调用视觉模型，只把页面的文字描述追加到对话历史中，
+        使后续页面仍能获得上下文。image 可以是图片路径或内存中的图片字节。
+        识别完成后按 Config.VL_HISTORY_COMPACTION 压缩对话历史中的页面图片。
+
+        Returns:
+            Tuple[str, List[Dict]]: (页面描述, 更新后的对话历史)
+        """
+        if self.caption_cache is None:
+            return get_text_from_image(image, index, messages, compaction=Config.VL_HISTORY_COMPACTION,
+                                       compaction_stats=compaction_stats)
+
+        if isinstance(image, bytes):
+            key = CaptionCache.make_key(image, vl_prompt, VL_MODEL)
+        else:
+            with open(image, "rb") as f:
+                key = CaptionCache.make_key(f.read(), vl_prompt, VL_MODEL)
+
+        output = self.caption_cache.get(key)
+        if output is not None:
+            logger.info(f"页面 {index + 1} 命中描述缓存")
+            self._append_caption_history(messages, index, output)
+            return output, messages
+
+        output, messages = get_text_from_image(image, index, messages, compaction=Config.VL_HISTORY_COMPACTION,
+                                               compaction_stats=compaction_stats)
+        self.caption_cache.put(key, output)
+        return output, messages
+
+    def _caption_pages_serial(self, pages: Iterable[Tuple[int, Union[str, bytes]]], total_pages: int,
+                              captions: Dict[int, str], checkpoint_key: Optional[str], request_id: str,
+                              vl_prompt: str, progress) -> Optional[Dict[int, str]]:
+        """
+        逐页识别图片，每页都带上之前页面的对话历史
+
+        断点中已完成的页面以文字描述的形式放入对话历史，从断点继续时上下文与完整运行一致。
+
+        Returns:
+            Optional[Dict[int, str]]: 页码索引 -> 页面描述（含断点中已完成的页面），用户停止时返回None
+        """
+        conversation_history = [{"role": "system", "content": [{"type": "text", "text": vl_prompt}]}]
+        compaction_stats = CompactionStats()
+        resumed = sorted(captions)
+        position = 0
+        finished = len(captions)
+
+        for index, image in pages:
+            if self._is_stopped(request_id):
+                return None
+
+            # 补上当前页之前、断点中已完成页面的描述
+            while position < len(resumed) and resumed[position] < index:
+                self._append_caption_history(conversation_history, resumed[position], captions[resumed[position]])
+                position += 1
+
+            current_page = index + 1
+            self._update_page_progress(progress, finished, total_pages)
+            finished += 1
+
+            try:
+                output, conversation_history = self._caption_page(image, index, conversation_history,
+                                                                  vl_prompt, compaction_stats)
+                captions[index] = output
+                self._checkpoint_page(checkpoint_key, index, caption=output)
+                logger.info(f"页面 {current_page} 处理完成 ({len(output)} 字)")
+                logger.debug(f"页面 {current_page} 描述: {output}")
+            except Cancelled:
+                return None
+            except Exception as e:
+                error_trace = traceback.format_exc()
+                logger.error(f"处理页面 {current_page} 时出错: {error_trace}")
+                self._checkpoint_page(checkpoint_key, index, error=str(e))
+                continue
+
+        logger.info(f"对话历史压缩 ({Config.VL_HISTORY_COMPACTION}) 统计: {compaction_stats.summary()}")
+        return captions
+
+    def _caption_pages_parallel(self, pages: Iterable[Tuple[int, Union[str, bytes]]], total_pages: int,
+                                captions: Dict[int, str], checkpoint_key: Optional[str], request_id: str,
+                                vl_prompt: str, progress) -> Optional[Dict[int, str]]:
+        """
+        并发识别图片，最多同时进行 Config.VL_CONCURRENCY 个请求
+
+        封面先单独识别（断点中已有时直接使用），其描述作为全书上下文附加到其余每一页的请求中，
+        代替串行模式下不断增长的对话历史。
+
+        Returns:
+            Optional[Dict[int, str]]: 页码索引 -> 页面描述（含断点中已完成的页面），用户停止时返回None
+        """
+        book_context = [{"role": "system", "content": [{"type": "text", "text": vl_prompt}]}]
+        pages = iter(pages)
+        finished = len(captions)
+
+        first = next(pages, None)
+        if first is not None and first[0] == 0:
+            if self._is_stopped(request_id):
+                return None
+            self._update_page_progress(progress, finished, total_pages)
+            finished += 1
+            try:
+                cover_text, _ = self._caption_page(first[1], 0, list(book_context), vl_prompt)
+                captions[0] = cover_text
+                self._checkpoint_page(checkpoint_key, 0, caption=cover_text)
+                logger.info(f"页面 1 处理完成 ({len(cover_text)} 字)")
+                logger.debug(f"页面 1 描述: {cover_text}")
+            except Cancelled:
+                return None
+            except Exception as e:
+                error_trace = traceback.format_exc()
+                logger.error(f"处理页面 1 时出错: {error_trace}")
+                self._checkpoint_page(checkpoint_key, 0, error=str(e))
+        elif first is not None:
+            pages = itertools.chain([first], pages)
+        if 0 in captions:
+            self._append_caption_history(book_context, 0, captions[0])
+
+        concurrency = max(1, Config.VL_CONCURRENCY)
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="vl-caption")
+        pending = {}
+        exhausted = False
+        try:
+            while True:
+                # 补充任务直到达到并发上限，生成器形式的页面来源也只会按需渲染
+                while not exhausted and len(pending) < concurrency:
+                    if self._is_stopped(request_id):
+                        return None
+                    page = next(pages, None)
+                    if page is None:
+                        exhausted = True
+                        break
+                    index, image = page
+                    # 复制当前上下文，使线程中的调用计入同一个用量统计
+                    future = executor.submit(contextvars.copy_context().run, self._caption_page, image,
+                                             index, list(book_context), vl_prompt)
+                    pending[future] = index
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    finished += 1
+                    try:
+                        output, _ = future.result()
+                        captions[index] = output
+                        self._checkpoint_page(checkpoint_key, index, caption=output)
+                        logger.info(f"页面 {index + 1} 处理完成 ({len(output)} 字)")
+                        logger.debug(f"页面 {index + 1} 描述: {output}")
+                    except Cancelled:
+                        return None
+                    except Exception as e:
+                        error_trace = traceback.format_exc()
+                        logger.error(f"处理页面 {index + 1} 时出错: {error_trace}")
+                        self._checkpoint_page(checkpoint_key, index, error=str(e))
+
+                self._update_page_progress(progress, finished, total_pages)
+                if self._is_stopped(request_id):
+                    return None
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return captions
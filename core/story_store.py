@@ -0,0 +1,272 @@
+import datetime
+import gzip
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from core.cache import _hash_parts
+
+# 正文压缩方式对应的文件扩展名
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+# 分页列表每页的最大条数
+MAX_PAGE_SIZE = 200
+
+_STORY_COLUMNS = ("s.story_id, s.book_id, s.request_id, s.language, s.path, s.compression, s.size, s.content_hash, "
+                  "s.created_at, b.pdf_hash, b.prompts_hash, b.pdf_name")
+
+
+def _compress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression is None:
+        return data
+    if compression == "gzip":
+        return gzip.compress(data)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"未知的压缩方式: {compression}")
+
+
+def _decompress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression is None:
+        return data
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"未知的压缩方式: {compression}")
+
+
+# 故事存储
+class StoryStore:
+    """
+    故事存储类：故事正文按日期分目录保存，SQLite索引记录每个故事所属的书、请求、语言和时间
+
+    同一本书（PDF内容和提示词均相同）的中文故事和翻译出的英文故事关联到同一条书籍记录。
+    正文先写入临时文件再原子替换，文件名带随机后缀，同一秒内的多次保存不会互相覆盖。
+    按书、请求ID、内容或故事ID查找都走索引，列表按 (创建时间, 故事ID) 游标分页。
+    """
+
+    def __init__(self, root: Union[str, Path], index_path: Union[str, Path], compression: Optional[str] = None):
+        """
+        Args:
+            root: 故事正文的根目录
+            index_path: SQLite索引文件路径
+            compression: 正文压缩方式：None、"gzip" 或 "zstd"（需要安装 zstandard）
+        """
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"未知的压缩方式: {compression}")
+        if compression == "zstd":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                raise ImportError("使用 zstd 压缩故事需要安装 zstandard：pip install zstandard") from None
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.compression = compression
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(index_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS books (
+                book_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pdf_hash TEXT,
+                prompts_hash TEXT,
+                pdf_name TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_books_pdf_prompts ON books (pdf_hash, prompts_hash);
+            CREATE INDEX IF NOT EXISTS idx_books_prompts_hash ON books (prompts_hash);
+            CREATE TABLE IF NOT EXISTS stories (
+                story_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                book_id INTEGER NOT NULL REFERENCES books (book_id),
+                request_id TEXT,
+                language TEXT NOT NULL,
+                path TEXT NOT NULL UNIQUE,
+                compression TEXT,
+                size INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_stories_book ON stories (book_id, language, created_at);
+            CREATE INDEX IF NOT EXISTS idx_stories_request_id ON stories (request_id);
+            CREATE INDEX IF NOT EXISTS idx_stories_content_hash ON stories (content_hash);
+            CREATE INDEX IF NOT EXISTS idx_stories_created_at ON stories (created_at, story_id);
+        """)
+        self._conn.commit()
+
+    @staticmethod
+    def make_prompts_hash(vl_system_prompt: str, story_system_prompt: str, vl_model: str, story_model: str,
+                          image_policy: str = "") -> str:
+        """根据两个系统提示、模型名和页面图片策略生成提示词哈希，与PDF哈希一起确定一本书"""
+        return _hash_parts(vl_system_prompt, story_system_prompt, vl_model, story_model, image_policy)
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def save(self, content: str, language: str, pdf_name: Optional[str] = None, pdf_hash: Optional[str] = None,
+             prompts_hash: Optional[str] = None, request_id: Optional[str] = None,
+             book_id: Optional[int] = None) -> Dict:
+        """
+        保存故事正文并写入索引
+
+        Args:
+            content: 故事内容
+            language: 语言 ('chinese' 或 'english')
+            pdf_name: PDF文件名，用于生成文件名
+            pdf_hash: PDF内容哈希，与 prompts_hash 一起确定所属的书
+            prompts_hash: 提示词哈希，见 make_prompts_hash
+            request_id: 生成该故事的请求ID
+            book_id: 所属的书，指定时忽略 pdf_hash 和 prompts_hash（如翻译关联到原故事的书）
+
+        Returns:
+            Dict: 故事记录（story_id、book_id、path 等）
+        """
+        now = time.time()
+        stem = os.path.splitext(os.path.basename(pdf_name))[0] if pdf_name else "story"
+        day_dir = self.root / datetime.datetime.fromtimestamp(now).strftime("%Y/%m/%d")
+        day_dir.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.datetime.fromtimestamp(now).strftime("%Y%m%d_%H%M%S")
+        filename = f"{stem}_{language}_{timestamp}_{uuid.uuid4().hex[:8]}.txt{COMPRESSION_SUFFIXES[self.compression]}"
+        path = day_dir / filename
+
+        data = _compress(content.encode("utf-8"), self.compression)
+        fd, temp_path = tempfile.mkstemp(dir=day_dir, prefix=".tmp_", suffix=".txt")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        try:
+            with self._lock:
+                if book_id is None:
+                    book_id = self._book_id(pdf_hash, prompts_hash, pdf_name, now)
+                cursor = self._conn.execute(
+                    "INSERT INTO stories (book_id, request_id, language, path, compression, size, content_hash, "
+                    "created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (book_id, request_id, language, str(path), self.compression, len(data),
+                     self.content_hash(content), now)
+                )
+                self._conn.commit()
+                story_id = cursor.lastrowid
+        except BaseException:
+            os.remove(path)
+            raise
+        return self.get(story_id)
+
+    def _book_id(self, pdf_hash: Optional[str], prompts_hash: Optional[str], pdf_name: Optional[str],
+                 now: float) -> int:
+        """找到或创建书籍记录（调用方需持有 self._lock）；没有PDF哈希的故事各自单独成书"""
+        if pdf_hash is not None:
+            row = self._conn.execute(
+                "SELECT book_id FROM books WHERE pdf_hash = ? AND prompts_hash IS ?", (pdf_hash, prompts_hash)
+            ).fetchone()
+            if row is not None:
+                return row[0]
+        cursor = self._conn.execute(
+            "INSERT INTO books (pdf_hash, prompts_hash, pdf_name, created_at) VALUES (?, ?, ?, ?)",
+            (pdf_hash, prompts_hash, os.path.basename(pdf_name) if pdf_name else None, now)
+        )
+        return cursor.lastrowid
+
+    def _select(self, where: str, params: Tuple, suffix: str = "") -> List[Dict]:
+        with self._lock:
+            cursor = self._conn.execute(
+                f"SELECT {_STORY_COLUMNS} FROM stories s JOIN books b ON b.book_id = s.book_id "
+                f"WHERE {where} {suffix}", params
+            )
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def get(self, story_id: int) -> Optional[Dict]:
+        rows = self._select("s.story_id = ?", (story_id,))
+        return rows[0] if rows else None
+
+    def find_by_path(self, path: str) -> Optional[Dict]:
+        rows = self._select("s.path = ?", (str(path),))
+        return rows[0] if rows else None
+
+    def find_by_content(self, content: str, language: Optional[str] = None) -> Optional[Dict]:
+        """按正文内容查找最近保存的故事（如翻译时找到原文所属的书）"""
+        rows = self._select("s.content_hash = ? AND (? IS NULL OR s.language = ?)",
+                            (self.content_hash(content), language, language),
+                            "ORDER BY s.created_at DESC LIMIT 1")
+        return rows[0] if rows else None
+
+    def by_request(self, request_id: str) -> List[Dict]:
+        """某个请求保存的所有故事"""
+        return self._select("s.request_id = ?", (request_id,), "ORDER BY s.created_at")
+
+    def latest(self, pdf_hash: str, language: str = "chinese", prompts_hash: Optional[str] = None) -> Optional[Dict]:
+        """某本书（可再按提示词区分）最近保存的故事"""
+        rows = self._select("b.pdf_hash = ? AND (? IS NULL OR b.prompts_hash = ?) AND s.language = ?",
+                            (pdf_hash, prompts_hash, prompts_hash, language),
+                            "ORDER BY s.created_at DESC LIMIT 1")
+        return rows[0] if rows else None
+
+    def versions(self, book_id: int) -> List[Dict]:
+        """同一本书的所有故事（各语言、各次生成），按时间排序"""
+        return self._select("s.book_id = ?", (book_id,), "ORDER BY s.created_at")
+
+    def list(self, limit: int = 50, cursor: Optional[str] = None, language: Optional[str] = None,
+             pdf_hash: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """
+        按时间倒序分页列出故事
+
+        Args:
+            limit: 每页条数（不超过 MAX_PAGE_SIZE）
+            cursor: 上一页返回的游标，None 表示第一页
+            language: 只列出该语言的故事
+            pdf_hash: 只列出该PDF的故事
+
+        Returns:
+            Tuple[List[Dict], Optional[str]]: (本页的故事记录, 下一页的游标，没有更多时为 None)
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        where, params = ["1"], []
+        if cursor:
+            created_at, story_id = cursor.split(":")
+            where.append("(s.created_at, s.story_id) < (?, ?)")
+            params += [float(created_at), int(story_id)]
+        if language:
+            where.append("s.language = ?")
+            params.append(language)
+        if pdf_hash:
+            where.append("b.pdf_hash = ?")
+            params.append(pdf_hash)
+        rows = self._select(" AND ".join(where), tuple(params),
+                            f"ORDER BY s.created_at DESC, s.story_id DESC LIMIT {limit + 1}")
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1]['created_at']!r}:{rows[-1]['story_id']}"
+        return rows, next_cursor
+
+    def read(self, story: Union[int, Dict]) -> str:
+        """读取故事正文"""
+        if not isinstance(story, dict):
+            story = self.get(story)
+            if story is None:
+                raise KeyError("故事不存在")
+        with open(story["path"], "rb") as f:
+            return _decompress(f.read(), story["compression"]).decode("utf-8")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            books, stories, size = self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM books), COUNT(*), COALESCE(SUM(size), 0) FROM stories"
+            ).fetchone()
+        return {"books": books, "stories": stories, "bytes": size}
@@ -0,0 +1,170 @@
+import contextvars
+import re
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from core.cache import TranslationCache
+from core.config import Config
+from llm import STORY_MODEL, generate_story
+from util.logger import logger
+
+# 段落分隔（保留分隔符本身，重组时原样放回）
+PARAGRAPH_SEPARATOR = re.compile(r"(\n\s*\n|\n)")
+# 句子和对话边界：句末标点或右引号之后
+SENTENCE_BOUNDARY = re.compile(r"(?<=[。！？!?…；;”」』])")
+
+
+# 分段翻译类
+class ChunkedTranslator:
+    """分段翻译类，按段落和对话边界切分故事，并发翻译后按原顺序重组"""
+
+    def __init__(self, cache: Optional[TranslationCache] = None,
+                 max_workers: int = Config.TRANSLATION_CONCURRENCY,
+                 chunk_chars: int = Config.TRANSLATION_CHUNK_CHARS):
+        """
+        Args:
+            cache: 翻译缓存，按片段内容缓存，编辑一个段落只会重新翻译该段落
+            max_workers: 同时翻译的最大片段数
+            chunk_chars: 单个片段的最大字符数，超长段落按句子和对话边界继续切分
+        """
+        self.cache = cache
+        self.max_workers = max(1, max_workers)
+        self.chunk_chars = chunk_chars
+
+    def split(self, text: str) -> List[Tuple[List[str], str]]:
+        """
+        切分故事
+
+        Returns:
+            List[Tuple[List[str], str]]: 每个段落的 (片段列表, 段落后的分隔符)。只含空白的段落片段列表为空，
+            其空白内容并入分隔符，重组时原样放回
+        """
+        parts = PARAGRAPH_SEPARATOR.split(text)
+        paragraphs = []
+        for i in range(0, len(parts), 2):
+            paragraph = parts[i]
+            separator = parts[i + 1] if i + 1 < len(parts) else ""
+            if paragraph.strip():
+                paragraphs.append((self._split_paragraph(paragraph), separator))
+            else:
+                paragraphs.append(([], paragraph + separator))
+        return paragraphs
+
+    def _split_paragraph(self, paragraph: str) -> List[str]:
+        """把超长段落按句子和对话边界切成不超过 chunk_chars 的片段"""
+        if len(paragraph) <= self.chunk_chars:
+            return [paragraph]
+        chunks, current = [], ""
+        for sentence in SENTENCE_BOUNDARY.split(paragraph):
+            if current and len(current) + len(sentence) > self.chunk_chars:
+                chunks.append(current)
+                current = ""
+            current += sentence
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def build_glossary(self, chunks: List[str]) -> str:
+        """
+        提取各片段中的人物名称及其英文译名，合并为各片段共享的对照表
+
+        每个片段的提取结果按片段内容单独缓存，编辑一个段落只会重新提取该段落。同一名称在多个片段中
+        出现时使用最先出现的译名。提取失败的片段记录日志后跳过，不影响翻译。
+        """
+        keys = [self._cache_key(chunk, Config.GLOSSARY_PROMPT) for chunk in chunks]
+        glossaries = [self.cache.get(key) if self.cache is not None else None for key in keys]
+        missing = [i for i, glossary in enumerate(glossaries) if glossary is None]
+        results = self._call_all([chunks[i] for i in missing], Config.GLOSSARY_PROMPT, "故事内容如下:",
+                                 [keys[i] for i in missing], "提取人物名称")
+        for i, result in zip(missing, results):
+            glossaries[i] = result
+
+        entries = {}
+        for glossary in glossaries:
+            for line in (glossary or "").splitlines():
+                name, arrow, english = line.partition("=>")
+                if arrow and name.strip() and english.strip():
+                    entries.setdefault(name.strip(), english.strip())
+        return "\n".join(f"{name} => {english}" for name, english in entries.items())
+
+    def translate(self, text: str) -> str:
+        """
+        翻译整篇故事
+
+        失败的片段不会影响其他片段，成功的片段已写入缓存，重试时只会重新翻译失败的片段。
+
+        Raises:
+            RuntimeError: 有片段在重试后仍然翻译失败
+        """
+        paragraphs = self.split(text)
+        chunks = [chunk for paragraph_chunks, _ in paragraphs for chunk in paragraph_chunks]
+        if not chunks:
+            return text
+
+        # 片段缓存只按原文和基础翻译提示计键，人名对照表只用于保持译名一致，
+        # 避免对照表措辞的变化让所有片段缓存失效
+        keys = [self._cache_key(chunk, Config.TRANSLATION_PROMPT) for chunk in chunks]
+        translated = [self.cache.get(key) if self.cache is not None else None for key in keys]
+        missing = [i for i, result in enumerate(translated) if result is None]
+        if missing:
+            logger.info(f"翻译共 {len(chunks)} 个片段，其中 {len(missing)} 个需要调用模型")
+            prompt = Config.TRANSLATION_PROMPT
+            try:
+                glossary = self.build_glossary(chunks) if len(chunks) > 1 else ""
+            except Exception:
+                # 对照表只用于统一译名，提取失败时不使用对照表继续翻译
+                logger.warning(f"提取人物名称对照表失败，不使用对照表继续翻译: {traceback.format_exc()}")
+                glossary = ""
+            if glossary:
+                prompt = f"{prompt}\n\n人物名称对照表（请严格使用以下译名）：\n{glossary}"
+
+            results = self._call_all([chunks[i] for i in missing], prompt, "请翻译以下内容:",
+                                     [keys[i] for i in missing], "翻译片段")
+            for i, result in zip(missing, results):
+                translated[i] = result
+            failed = sum(result is None for result in results)
+            if failed:
+                raise RuntimeError(f"{failed}/{len(chunks)} 个片段翻译失败，已完成的片段已缓存，重试时只会重新翻译失败的片段")
+
+        # 按原顺序重组，同一段落内的片段以空格连接，段落间保留原分隔符
+        results = iter(translated)
+        output = []
+        for paragraph_chunks, separator in paragraphs:
+            output.append(" ".join(next(results).strip() for _ in paragraph_chunks))
+            output.append(separator)
+        return "".join(output)
+
+    def _call_all(self, texts: List[str], system_prompt: str, user_prompt: str, keys: List[str],
+                  description: str) -> List[Optional[str]]:
+        """
+        并发调用模型处理多个片段
+
+        Returns:
+            List[Optional[str]]: 按输入顺序的结果，失败的片段为 None（错误已记录日志）
+        """
+        if not texts:
+            return []
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="translate") as executor:
+            futures = [executor.submit(contextvars.copy_context().run, self._call, text, system_prompt,
+                                       user_prompt, key)
+                       for text, key in zip(texts, keys)]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception:
+                logger.error(f"{description}时出错: {traceback.format_exc()}")
+                results.append(None)
+        return results
+
+    @staticmethod
+    def _cache_key(text: str, prompt: str) -> str:
+        return TranslationCache.make_key(text, prompt, STORY_MODEL)
+
+    def _call(self, text: str, system_prompt: str, user_prompt: str, cache_key: str) -> str:
+        """调用模型并把结果写入缓存"""
+        result = generate_story(text, system_prompt, user_prompt, stream=False)
+        if self.cache is not None:
+            self.cache.put(cache_key, result)
+        return result
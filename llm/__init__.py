@@ -1,3 +1,6 @@
-
-from .qwen_vl import encode_image, get_text_from_image
-from .qwen2 import generate_story
+from .client import get_client, get_async_client, call_with_retry, async_call_with_retry, record_aborted_call
+from .limiter import MODEL_RATE_LIMITS, ModelLimiter, get_limiter, limiter_stats, set_rate_limit
+from .prompt import HISTORY_COMPACTION_STRATEGIES, CompactionStats, PromptBudgetError, caption_message, estimate_image_tokens, estimate_messages_tokens, estimate_text_tokens
+from .qwen_vl import VL_MODEL, encode_image, encode_image_bytes, get_text_from_image
+from .qwen2 import STORY_MODEL, generate_story
+from .usage import UsageTracker, record_avoided_calls, record_queue_wait, record_usage, track_usage
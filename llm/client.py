@@ -0,0 +1,404 @@
+import asyncio
+import os
+import random
+import socket
+import threading
+import time
+import weakref
+from typing import TYPE_CHECKING
+
+from util.cancel import Cancelled, cancellable_sleep, current_cancel_token
+from util.logger import logger
+from util.metrics import metrics
+
+from .limiter import get_limiter, is_throttled, retry_after
+from .usage import record_queue_wait
+
+if TYPE_CHECKING:
+    import httpx
+    from openai import AsyncOpenAI, OpenAI
+
+# openai 和 httpx 在首次创建客户端或请求时才导入，导入 llm 包不会拖慢不调用模型的进程启动
+
+# DashScope 兼容 OpenAI 的接口地址，可通过 DASHSCOPE_BASE_URL 环境变量覆盖（在首次创建客户端时读取）
+DEFAULT_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+
+# 连接池配置：同一进程内所有调用共享 keep-alive 连接，避免每页重新握手
+POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20"))
+POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "10"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "60"))
+
+# 默认超时（秒）：连接超时较短，读取超时需要覆盖长文本生成
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+DEFAULT_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+
+# 重试配置：指数退避加随机抖动
+RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "20.0"))
+# 被限流（429/5xx）时的最多尝试次数，不占用普通错误的重试次数
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("LLM_RATE_LIMIT_MAX_RETRIES", "6"))
+
+_lock = threading.Lock()
+_client = None
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def request_timeout(timeout: float = None) -> "httpx.Timeout":
+    """构造单次调用的超时设置，未指定时使用默认读取超时"""
+    import httpx
+    return httpx.Timeout(timeout or DEFAULT_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+
+def _limits() -> "httpx.Limits":
+    import httpx
+    return httpx.Limits(
+        max_connections=POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=POOL_MAX_KEEPALIVE,
+        keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+    )
+
+
+class CancellableStream:
+    """
+    包装连接池中的网络连接：读写期间登记到当前上下文的取消令牌，取消时关闭底层 socket，
+    阻塞中的读取立即以连接错误返回（该连接随之被连接池丢弃）
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def _abort(self) -> None:
+        sock = self._stream.get_extra_info("socket")
+        if sock is not None:
+            try:
+                # 直接关闭底层 TCP 连接，TLS 连接也不做关闭握手
+                socket.socket.shutdown(sock, socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def read(self, max_bytes: int, timeout: float = None) -> bytes:
+        token = current_cancel_token()
+        if token is None:
+            return self._stream.read(max_bytes, timeout)
+        with token.on_cancel(self._abort):
+            return self._stream.read(max_bytes, timeout)
+
+    def write(self, buffer: bytes, timeout: float = None) -> None:
+        token = current_cancel_token()
+        if token is None:
+            return self._stream.write(buffer, timeout)
+        with token.on_cancel(self._abort):
+            return self._stream.write(buffer, timeout)
+
+    def start_tls(self, *args, **kwargs) -> "CancellableStream":
+        return CancellableStream(self._stream.start_tls(*args, **kwargs))
+
+    def close(self) -> None:
+        self._stream.close()
+
+    def get_extra_info(self, info: str):
+        return self._stream.get_extra_info(info)
+
+
+class CancellableBackend:
+    """httpcore 网络后端的包装：新建的连接都可被取消令牌关闭"""
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def connect_tcp(self, *args, **kwargs) -> CancellableStream:
+        token = current_cancel_token()
+        if token is not None:
+            token.raise_if_cancelled()
+        return CancellableStream(self._backend.connect_tcp(*args, **kwargs))
+
+    def connect_unix_socket(self, *args, **kwargs) -> CancellableStream:
+        return CancellableStream(self._backend.connect_unix_socket(*args, **kwargs))
+
+    def sleep(self, seconds: float) -> None:
+        self._backend.sleep(seconds)
+
+
+def _map_transport_error(exc: Exception) -> Exception:
+    """把 httpcore 的异常换成同名的 httpx 异常（openai SDK 按 httpx 异常区分超时和连接错误）"""
+    import httpx
+    for cls in type(exc).__mro__:
+        mapped = getattr(httpx, cls.__name__, None)
+        if isinstance(mapped, type) and issubclass(mapped, httpx.TransportError):
+            return mapped(str(exc))
+    return httpx.TransportError(str(exc))
+
+
+def _cancellable_transport() -> "httpx.BaseTransport":
+    """
+    创建网络连接可被取消令牌关闭的 httpx 传输层
+
+    传输层自己持有一个以 CancellableBackend 为网络后端的 httpcore 连接池，只使用 httpx 和
+    httpcore 的公开接口。环境变量配置的代理仍由 httpx 自带的传输层处理，经代理的请求
+    只在两次尝试之间响应取消。
+    """
+    import httpcore
+    import httpx
+
+    errors = (httpcore.TimeoutException, httpcore.NetworkError, httpcore.ProtocolError, httpcore.ProxyError,
+              httpcore.UnsupportedProtocol)
+
+    class ResponseStream(httpx.SyncByteStream):
+        def __init__(self, stream):
+            self._stream = stream
+
+        def __iter__(self):
+            try:
+                yield from self._stream
+            except errors as e:
+                raise _map_transport_error(e) from e
+
+        def close(self) -> None:
+            if hasattr(self._stream, "close"):
+                self._stream.close()
+
+    class CancellableTransport(httpx.BaseTransport):
+        def __init__(self, limits: "httpx.Limits"):
+            self.pool = httpcore.ConnectionPool(
+                ssl_context=httpx.create_ssl_context(),
+                max_connections=limits.max_connections,
+                max_keepalive_connections=limits.max_keepalive_connections,
+                keepalive_expiry=limits.keepalive_expiry,
+                network_backend=CancellableBackend(httpcore.SyncBackend()),
+            )
+
+        def handle_request(self, request: "httpx.Request") -> "httpx.Response":
+            core_request = httpcore.Request(
+                method=request.method,
+                url=httpcore.URL(scheme=request.url.raw_scheme, host=request.url.raw_host,
+                                 port=request.url.port, target=request.url.raw_path),
+                headers=request.headers.raw,
+                content=request.stream,
+                extensions=request.extensions,
+            )
+            try:
+                response = self.pool.handle_request(core_request)
+            except errors as e:
+                raise _map_transport_error(e) from e
+            return httpx.Response(status_code=response.status, headers=response.headers,
+                                  stream=ResponseStream(response.stream), extensions=response.extensions)
+
+        def close(self) -> None:
+            self.pool.close()
+
+    return CancellableTransport(_limits())
+
+
+def get_client() -> "OpenAI":
+    """
+    获取进程内共享的同步客户端
+
+    客户端在首次调用时创建，之后所有请求复用同一个连接池。
+    SDK 自带的重试被关闭，统一由 call_with_retry 处理。请求期间当前上下文的取消令牌
+    被取消时（见 util.cancel），正在进行的请求和数据流立即关闭。
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                import httpx
+                from openai import OpenAI
+                _client = OpenAI(
+                    api_key=os.getenv("DASHSCOPE_API_KEY"),
+                    base_url=os.getenv("DASHSCOPE_BASE_URL", DEFAULT_BASE_URL),
+                    max_retries=0,
+                    timeout=request_timeout(),
+                    http_client=httpx.Client(transport=_cancellable_transport(), timeout=request_timeout()),
+                )
+    return _client
+
+
+def get_async_client() -> "AsyncOpenAI":
+    """
+    获取当前事件循环共享的异步客户端
+
+    异步连接池与事件循环绑定，因此每个事件循环各持有一个客户端，
+    事件循环被回收后对应的客户端也随之释放。
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        import httpx
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(
+            api_key=os.getenv("DASHSCOPE_API_KEY"),
+            base_url=os.getenv("DASHSCOPE_BASE_URL", DEFAULT_BASE_URL),
+            max_retries=0,
+            timeout=request_timeout(),
+            http_client=httpx.AsyncClient(limits=_limits(), timeout=request_timeout()),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def backoff_delay(attempt: int) -> float:
+    """第 attempt 次重试前的等待时间（full jitter 指数退避）"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """重试前的等待时间，服务端给出 Retry-After 时以其为准"""
+    delay = retry_after(error)
+    return min(RETRY_MAX_DELAY, delay) if delay is not None else backoff_delay(attempt)
+
+
+def _adjust_tokens(limiter, estimated_tokens: int, result) -> None:
+    """非流式响应带有实际用量时修正限流额度"""
+    usage = getattr(result, "usage", None)
+    if usage is not None:
+        limiter.adjust_tokens(estimated_tokens, getattr(usage, "total_tokens", 0) or 0)
+
+
+def record_aborted_call(started: float) -> None:
+    """记录一次被取消令牌中途关闭的模型请求"""
+    metrics.add_cancellation(aborted_llm_calls=1, aborted_call_seconds=time.monotonic() - started)
+
+
+class LimitedStream:
+    """
+    流式响应的包装：数据流读完、读取出错或被关闭时才归还限流器的并发名额，
+    故事流式生成的整个输出期间都计入模型的并发上限
+    """
+
+    def __init__(self, stream, limiter, estimated_tokens: int = 0, cancel=None):
+        self._stream = stream
+        self._limiter = limiter
+        self._estimated_tokens = estimated_tokens
+        self._cancel = cancel
+        self._usage = None
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                if getattr(chunk, "usage", None) is not None:
+                    self._usage = chunk.usage
+                yield chunk
+        except Exception as e:
+            cancelled = self._cancel is not None and self._cancel.cancelled
+            self._release(throttled=not cancelled and is_throttled(e), cancelled=cancelled)
+            raise
+        self._release()
+
+    def _release(self, throttled: bool = False, cancelled: bool = False) -> None:
+        """归还并发名额（只归还一次），正常读完时按实际用量修正 token 额度"""
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._limiter.release(throttled=throttled, cancelled=cancelled)
+        if not throttled and not cancelled and self._usage is not None:
+            self._limiter.adjust_tokens(self._estimated_tokens, getattr(self._usage, "total_tokens", 0) or 0)
+
+    def close(self) -> None:
+        """关闭数据流；没有读完就关闭时只归还名额，不调整并发上限"""
+        try:
+            self._stream.close()
+        finally:
+            self._release(cancelled=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        # 调用方没有关闭也没有读完的数据流在回收时归还名额，避免并发名额泄漏
+        if not self.__dict__.get("_released", True):
+            self._release(cancelled=True)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._stream, name)
+
+
+def call_with_retry(func, *args, max_retries: int = 2, description: str = "LLM request",
+                    estimated_tokens: int = 0, **kwargs):
+    """
+    经过模型限流器调用 func，失败时按指数退避重试
+
+    每次尝试前在 kwargs["model"] 对应的进程级限流器中排队，等待请求数和 token 额度
+    以及并发名额。被限流（429/5xx）时降低该模型的并发并另行重试，最多
+    RATE_LIMIT_MAX_RETRIES 次，不消耗 max_retries。流式调用（stream=True）返回 LimitedStream，
+    数据流读完或关闭时才归还并发名额。
+    当前上下文的取消令牌被取消时，排队、退避和进行中的请求都立即结束并抛出 Cancelled。
+
+    Args:
+        func: 要调用的函数
+        max_retries: 普通错误的最多尝试次数
+        description: 日志中使用的调用描述
+        estimated_tokens: 本次请求估计的 token 数，用于 tpm 限额
+
+    Returns:
+        func 的返回值，最后一次仍失败时抛出异常
+    """
+    limiter = get_limiter(kwargs.get("model"))
+    token = current_cancel_token()
+    attempt = throttled_attempt = 0
+    while True:
+        record_queue_wait(limiter.acquire(estimated_tokens, cancel=token))
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if token is not None and token.cancelled:
+                limiter.release(cancelled=True)
+                record_aborted_call(started)
+                logger.debug(f"{description} cancelled")
+                raise Cancelled() from e
+            throttled = is_throttled(e)
+            limiter.release(throttled=throttled)
+            logger.warning(f"{description} attempt {attempt + throttled_attempt + 1} failed: {e}")
+            if throttled:
+                throttled_attempt += 1
+                if throttled_attempt >= RATE_LIMIT_MAX_RETRIES:
+                    raise
+                cancellable_sleep(_retry_delay(e, throttled_attempt - 1))
+            else:
+                attempt += 1
+                if attempt >= max_retries:
+                    raise
+                cancellable_sleep(backoff_delay(attempt - 1))
+            continue
+        if kwargs.get("stream"):
+            return LimitedStream(result, limiter, estimated_tokens, token)
+        limiter.release()
+        _adjust_tokens(limiter, estimated_tokens, result)
+        return result
+
+
+async def async_call_with_retry(func, *args, max_retries: int = 2, description: str = "LLM request",
+                                estimated_tokens: int = 0, **kwargs):
+    """call_with_retry 的异步版本，func 需返回 awaitable"""
+    limiter = get_limiter(kwargs.get("model"))
+    attempt = throttled_attempt = 0
+    while True:
+        record_queue_wait(await limiter.acquire_async(estimated_tokens))
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            throttled = is_throttled(e)
+            limiter.release(throttled=throttled)
+            logger.warning(f"{description} attempt {attempt + throttled_attempt + 1} failed: {e}")
+            if throttled:
+                throttled_attempt += 1
+                if throttled_attempt >= RATE_LIMIT_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(_retry_delay(e, throttled_attempt - 1))
+            else:
+                attempt += 1
+                if attempt >= max_retries:
+                    raise
+                await asyncio.sleep(backoff_delay(attempt - 1))
+            continue
+        limiter.release()
+        _adjust_tokens(limiter, estimated_tokens, result)
+        return result
@@ -0,0 +1,233 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from util.cancel import CancelToken
+
+# 各模型每分钟请求数 (rpm) 和每分钟 token 数 (tpm) 的限额，按 DashScope 账号默认限流设置，
+# 可通过 set_rate_limit 调整；未列出的模型使用 DEFAULT_RATE_LIMIT
+MODEL_RATE_LIMITS = {
+    "qwen-max": {"rpm": 600, "tpm": 1000000},
+    "qwen2.5-vl-32b-instruct": {"rpm": 1200, "tpm": 1000000},
+    "qwen-vl-max-2025-01-25": {"rpm": 1200, "tpm": 1000000},
+}
+DEFAULT_RATE_LIMIT = {"rpm": 300, "tpm": 500000}
+
+# 自适应并发：成功时加性增加，遇到 429/5xx 时乘性减少
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+MIN_CONCURRENCY = int(os.getenv("LLM_MIN_CONCURRENCY", "1"))
+BACKOFF_FACTOR = 0.5
+# 同一波并发请求同时被限流时只减少一次并发
+DECREASE_COOLDOWN = 1.0
+
+
+class TokenBucket:
+    """令牌桶：容量为一分钟的额度，按每秒 capacity/60 的速度补充（调用方负责加锁）"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """取出 amount 还需等待的秒数，0 表示现在即可取出"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        """取出额度；允许为负，用于按实际用量补扣"""
+        self.level -= min(amount, self.capacity)
+
+
+class ModelLimiter:
+    """单个模型的限流器：请求数和 token 数两个令牌桶，加上按 AIMD 调整的并发上限"""
+
+    def __init__(self, model: str, rpm: int, tpm: int,
+                 max_concurrency: int = MAX_CONCURRENCY, min_concurrency: int = MIN_CONCURRENCY):
+        self.model = model
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.concurrency = float(self.max_concurrency)
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._last_decrease = 0.0
+        self.in_flight = 0
+        self.waiting = 0
+        self.throttled = 0
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.last_wait = 0.0
+
+    def try_acquire(self, tokens: int) -> Tuple[bool, float]:
+        """
+        尝试占用一个并发名额和对应额度（调用方需持有 self._cond）
+
+        Returns:
+            Tuple[bool, float]: (是否成功, 失败时建议的等待秒数)
+        """
+        if self.in_flight >= int(self.concurrency):
+            return False, 0.05
+        now = time.monotonic()
+        delay = max(self._requests.wait_time(1, now), self._tokens.wait_time(tokens, now))
+        if delay > 0:
+            return False, delay
+        self._requests.take(1)
+        self._tokens.take(tokens)
+        self.in_flight += 1
+        return True, 0.0
+
+    def acquire(self, tokens: int = 0, cancel: Optional[CancelToken] = None) -> float:
+        """
+        阻塞直到可以发出请求
+
+        Args:
+            tokens: 本次请求估计的 token 数
+            cancel: 取消令牌，排队期间被取消时立即抛出 Cancelled
+
+        Returns:
+            float: 排队等待的秒数
+        """
+        start = time.monotonic()
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    if cancel is not None:
+                        cancel.raise_if_cancelled()
+                    ok, delay = self.try_acquire(tokens)
+                    if ok:
+                        break
+                    if cancel is None:
+                        self._cond.wait(delay)
+                    else:
+                        with cancel.on_cancel(self._wake):
+                            self._cond.wait(delay)
+            finally:
+                self.waiting -= 1
+            return self._record_wait(time.monotonic() - start)
+
+    def _wake(self) -> None:
+        with self._cond:
+            self._cond.notify_all()
+
+    async def acquire_async(self, tokens: int = 0) -> float:
+        """acquire 的异步版本，等待时不阻塞事件循环"""
+        start = time.monotonic()
+        with self._cond:
+            self.waiting += 1
+        try:
+            while True:
+                with self._cond:
+                    ok, delay = self.try_acquire(tokens)
+                    if ok:
+                        return self._record_wait(time.monotonic() - start)
+                await asyncio.sleep(delay)
+        finally:
+            with self._cond:
+                self.waiting -= 1
+
+    def _record_wait(self, waited: float) -> float:
+        self.acquired += 1
+        self.total_wait += waited
+        self.last_wait = waited
+        return waited
+
+    def release(self, throttled: bool = False, cancelled: bool = False) -> None:
+        """
+        归还并发名额并调整并发上限
+
+        Args:
+            throttled: 请求是否被服务端限流或过载（HTTP 429/5xx）
+            cancelled: 请求被调用方取消，只归还名额，不调整并发上限
+        """
+        with self._cond:
+            self.in_flight = max(0, self.in_flight - 1)
+            now = time.monotonic()
+            if throttled:
+                self.throttled += 1
+                if now - self._last_decrease >= DECREASE_COOLDOWN:
+                    self.concurrency = max(self.min_concurrency, self.concurrency * BACKOFF_FACTOR)
+                    self._last_decrease = now
+            elif not cancelled:
+                # 每个并发窗口全部成功约增加 1
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+            self._cond.notify_all()
+
+    def adjust_tokens(self, estimated: int, actual: int) -> None:
+        """按响应中的实际 token 用量修正额度"""
+        if not actual:
+            return
+        with self._cond:
+            self._tokens.take(actual - estimated)
+
+    def stats(self) -> Dict:
+        """返回限流状态，供界面展示排队情况"""
+        with self._cond:
+            return {
+                "model": self.model,
+                "concurrency_limit": int(self.concurrency),
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "throttled": self.throttled,
+                "last_wait_s": round(self.last_wait, 3),
+                "avg_wait_s": round(self.total_wait / self.acquired, 3) if self.acquired else 0.0,
+            }
+
+
+_lock = threading.Lock()
+_limiters: Dict[str, ModelLimiter] = {}
+
+
+def get_limiter(model: Optional[str]) -> ModelLimiter:
+    """获取进程内共享的模型限流器，首次使用时按 MODEL_RATE_LIMITS 创建"""
+    model = model or "default"
+    limiter = _limiters.get(model)
+    if limiter is None:
+        with _lock:
+            limiter = _limiters.get(model)
+            if limiter is None:
+                limits = MODEL_RATE_LIMITS.get(model, DEFAULT_RATE_LIMIT)
+                limiter = ModelLimiter(model, limits["rpm"], limits["tpm"])
+                _limiters[model] = limiter
+    return limiter
+
+
+def set_rate_limit(model: str, rpm: int, tpm: int, max_concurrency: int = MAX_CONCURRENCY) -> None:
+    """调整模型的限额，替换已有的限流器（正在等待的请求仍使用旧限流器）"""
+    with _lock:
+        MODEL_RATE_LIMITS[model] = {"rpm": rpm, "tpm": tpm}
+        _limiters[model] = ModelLimiter(model, rpm, tpm, max_concurrency=max_concurrency)
+
+
+def limiter_stats() -> Dict[str, Dict]:
+    """返回所有已使用模型的限流状态"""
+    with _lock:
+        limiters = list(_limiters.values())
+    return {limiter.model: limiter.stats() for limiter in limiters}
+
+
+def is_throttled(error: Exception) -> bool:
+    """判断异常是否为服务端限流或过载（HTTP 429 或 5xx）"""
+    status = getattr(error, "status_code", None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """读取响应中的 Retry-After 秒数"""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
@@ -0,0 +1,289 @@
+import base64
+import io
+import math
+import os
+import re
+from typing import List, Dict, Tuple, Union, Optional
+
+from util.logger import logger
+
+# 每个模型单次请求允许的输入 token 上限（留出输出空间后的预算）
+MODEL_INPUT_BUDGETS = {
+    "qwen-max": 30720,
+    "qwen2.5-vl-32b-instruct": 129024,
+    "qwen-vl-max-2025-01-25": 129024,
+}
+DEFAULT_INPUT_BUDGET = 30000
+
+# 视觉模型对话历史（不含当前页面）的 token 预算和消息条数上限
+VL_HISTORY_TOKEN_BUDGET = int(os.getenv("VL_HISTORY_TOKEN_BUDGET", "16000"))
+VL_HISTORY_MAX_MESSAGES = 8
+
+# 视觉模型对话历史压缩策略：
+#   none      保留历史中的全部页面图片
+#   caption   页面识别完成后，该页的图片和助手描述合并为一条只含描述文字的用户消息，
+#             后续页面以文字形式看到前文，且不重复发送同一段描述
+#   stub      页面识别完成后，历史中的图片替换为简短文字占位（页面内容由随后的助手描述提供）
+#   keep_last 只保留最近一页的图片，更早的图片替换为文字占位
+HISTORY_COMPACTION_STRATEGIES = ("none", "caption", "stub", "keep_last")
+
+# 通义千问视觉模型约每 28x28 像素计为一个图片 token，另有少量起止标记
+IMAGE_PATCH = 28
+IMAGE_EXTRA_TOKENS = 2
+
+# 输入文本超出预算时代替被省略的最早几行
+OMITTED_LINES_NOTE = "（前面部分页面的描述因长度限制已省略）"
+
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+class PromptBudgetError(ValueError):
+    """请求的估计 token 数超出模型预算"""
+
+
+def estimate_text_tokens(text: str) -> int:
+    """估计文本 token 数：中日韩字符约一字一个 token，其余字符约四个一个 token"""
+    if not text:
+        return 0
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def estimate_image_tokens(image: Union[bytes, str]) -> int:
+    """
+    根据图片尺寸估计图片 token 数
+
+    Args:
+        image: 图片字节，或 data:image/...;base64, 形式的 data URL
+    """
+    from PIL import Image
+
+    candidates = [image]
+    if isinstance(image, str):
+        encoded = image.split(",", 1)[-1]
+        # 图片尺寸通常位于文件头部，先只解码开头一段，失败时再解码完整内容
+        head = encoded[:65536]
+        candidates = [base64.b64decode(head[:len(head) - len(head) % 4]), encoded]
+    for candidate in candidates:
+        try:
+            data = base64.b64decode(candidate) if isinstance(candidate, str) else candidate
+            width, height = Image.open(io.BytesIO(data)).size
+            break
+        except Exception:
+            continue
+    else:
+        return 0
+    return math.ceil(width / IMAGE_PATCH) * math.ceil(height / IMAGE_PATCH) + IMAGE_EXTRA_TOKENS
+
+
+def estimate_message_tokens(message: Dict) -> int:
+    """估计单条消息的 token 数（含少量角色标记开销）"""
+    content = message.get("content")
+    tokens = 4
+    if isinstance(content, str):
+        return tokens + estimate_text_tokens(content)
+    for part in content or []:
+        if part.get("type") == "text":
+            tokens += estimate_text_tokens(part.get("text", ""))
+        elif part.get("type") == "image_url":
+            tokens += estimate_image_tokens(part["image_url"]["url"])
+    return tokens
+
+
+def estimate_messages_tokens(messages: List[Dict]) -> int:
+    """估计整组消息的 token 数"""
+    return sum(estimate_message_tokens(message) for message in messages)
+
+
+def input_budget(model: str) -> int:
+    """返回模型的输入 token 预算"""
+    return MODEL_INPUT_BUDGETS.get(model, DEFAULT_INPUT_BUDGET)
+
+
+def check_budget(messages: List[Dict], model: str) -> int:
+    """
+    检查请求是否在模型预算内
+
+    Returns:
+        int: 估计的输入 token 数
+
+    Raises:
+        PromptBudgetError: 超出预算
+    """
+    tokens = estimate_messages_tokens(messages)
+    budget = input_budget(model)
+    if tokens > budget:
+        raise PromptBudgetError(f"请求估计 {tokens} tokens，超出模型 {model} 的输入预算 {budget}")
+    return tokens
+
+
+def trim_history(messages: List[Dict], token_budget: int,
+                 max_messages: Optional[int] = None) -> List[Dict]:
+    """
+    按 token 预算裁剪对话历史
+
+    保留全部系统消息，从最早的非系统消息开始丢弃，直到非系统消息条数不超过
+    max_messages 且总 token 数不超过 token_budget；裁剪后不会以助手消息开头。
+    """
+    system_messages = [msg for msg in messages if msg["role"] == "system"]
+    history = [msg for msg in messages if msg["role"] != "system"]
+    if max_messages is not None and len(history) > max_messages:
+        history = history[-max_messages:]
+
+    tokens = [estimate_message_tokens(msg) for msg in history]
+    total = estimate_messages_tokens(system_messages) + sum(tokens)
+    start = 0
+    while start < len(history) and (total > token_budget or history[start]["role"] == "assistant"):
+        total -= tokens[start]
+        start += 1
+    return system_messages + history[start:]
+
+
+def trim_input_lines(text: str, token_budget: int, keep_first: int = 0) -> Tuple[str, int]:
+    """
+    从最早的行开始省略，直到文本的估计 token 数不超过 token_budget
+
+    Args:
+        text: 按行组织的输入文本（如每页一行的页面描述）
+        token_budget: 文本的 token 预算
+        keep_first: 开头始终保留的行数
+
+    Returns:
+        Tuple[str, int]: (裁剪后的文本, 省略的行数)。省略的行由 OMITTED_LINES_NOTE 代替
+    """
+    lines = text.split("\n")
+    tokens = [estimate_text_tokens(line) + 1 for line in lines]
+    total = sum(tokens)
+    if total <= token_budget:
+        return text, 0
+    total += estimate_text_tokens(OMITTED_LINES_NOTE) + 1
+    start = min(keep_first, len(lines))
+    end = start
+    while end < len(lines) and total > token_budget:
+        total -= tokens[end]
+        end += 1
+    return "\n".join(lines[:start] + [OMITTED_LINES_NOTE] + lines[end:]), end - start
+
+
+def _text_messages(system_prompt: str, user_prompt: str, input_text: str) -> List[Dict]:
+    parts = [part for part in (user_prompt, input_text) if part]
+    return [
+        {'role': 'system', 'content': system_prompt},
+        {'role': 'user', 'content': "\n\n".join(parts)},
+    ]
+
+
+def build_text_messages(system_prompt: str, user_prompt: str, input_text: str,
+                        model: str, keep_first_lines: int = 0) -> Tuple[List[Dict], int]:
+    """
+    组装纯文本对话请求
+
+    超出模型预算时从 input_text 最早的行开始省略（开头 keep_first_lines 行始终保留），
+    长书的故事生成不会因页面描述过多而失败。
+
+    Returns:
+        Tuple[List[Dict], int]: (消息列表, 估计的输入 token 数)
+
+    Raises:
+        PromptBudgetError: 省略后仍超出模型预算（提示本身过长）
+    """
+    messages = _text_messages(system_prompt, user_prompt, input_text)
+    budget = input_budget(model)
+    if input_text and estimate_messages_tokens(messages) > budget:
+        overhead = estimate_messages_tokens(_text_messages(system_prompt, user_prompt, "")) + 1
+        input_text, omitted = trim_input_lines(input_text, budget - overhead, keep_first_lines)
+        logger.warning(f"输入超出模型 {model} 的预算 {budget} tokens，省略了最早的 {omitted} 行")
+        messages = _text_messages(system_prompt, user_prompt, input_text)
+    return messages, check_budget(messages, model)
+
+
+class CompactionStats:
+    """统计一本书的对话历史压缩在后续请求中实际节省的字节数和 token 数"""
+
+    def __init__(self):
+        self.images_compacted = 0
+        self.saved_bytes = 0
+        self.saved_tokens = 0
+        self._stubs: Dict[str, Tuple[int, int]] = {}
+
+    def record(self, stub_text: str, saved_bytes: int, saved_tokens: int) -> None:
+        """登记一条被压缩的图片消息"""
+        self.images_compacted += 1
+        self._stubs[stub_text] = (saved_bytes, saved_tokens)
+
+    def count_request(self, messages: List[Dict]) -> None:
+        """累加一次请求中因占位消息代替原图而少发送的字节数和 token 数"""
+        for message in messages:
+            content = message.get("content")
+            if message["role"] != "user" or not isinstance(content, list) or len(content) != 1:
+                continue
+            saved = self._stubs.get(content[0].get("text", ""))
+            if saved is not None:
+                self.saved_bytes += saved[0]
+                self.saved_tokens += saved[1]
+
+    def summary(self) -> Dict[str, int]:
+        return {"images_compacted": self.images_compacted,
+                "saved_bytes": self.saved_bytes, "saved_tokens": self.saved_tokens}
+
+
+def compact_history(messages: List[Dict], strategy: str, stats: Optional[CompactionStats] = None) -> None:
+    """
+    压缩对话历史中已识别页面的图片
+
+    被压缩的用户消息会整体替换为新的字典，不会修改可能被其他对话共享的原消息。
+
+    Args:
+        messages: 对话历史，原地替换其中的消息
+        strategy: 压缩策略，见 HISTORY_COMPACTION_STRATEGIES
+        stats: 可选的压缩统计
+    """
+    if strategy not in HISTORY_COMPACTION_STRATEGIES:
+        raise ValueError(f"Unknown history compaction strategy: {strategy}")
+    if strategy == "none":
+        return
+
+    image_positions = [
+        i for i, msg in enumerate(messages)
+        if msg["role"] == "user" and isinstance(msg["content"], list)
+        and any(part.get("type") == "image_url" for part in msg["content"])
+    ]
+    if strategy == "caption":
+        _caption_history(messages, image_positions, stats)
+        return
+    if strategy == "keep_last":
+        image_positions = image_positions[:-1]
+
+    for i in image_positions:
+        message = messages[i]
+        texts = [part.get("text", "") for part in message["content"] if part.get("type") == "text"]
+        stub_text = " ".join(texts) + "（图片已识别，内容见后续描述）"
+        stub = {"role": "user", "content": [{"type": "text", "text": stub_text}]}
+        if stats is not None:
+            saved_bytes = sum(len(part["image_url"]["url"]) for part in message["content"]
+                              if part.get("type") == "image_url")
+            stats.record(stub_text, saved_bytes, estimate_message_tokens(message) - estimate_message_tokens(stub))
+        messages[i] = stub
+
+
+def caption_message(page_prompt: str, caption: str) -> Dict:
+    """"caption" 策略下代替一页图片和其描述的用户消息"""
+    return {"role": "user", "content": [{"type": "text", "text": f"{page_prompt} 页面内容：{caption}"}]}
+
+
+def _caption_history(messages: List[Dict], image_positions: List[int], stats: Optional[CompactionStats]) -> None:
+    """把每条图片消息和紧随其后的助手描述合并为一条文字用户消息；还没有描述的图片保持不变"""
+    for i in reversed(image_positions):
+        if i + 1 >= len(messages) or messages[i + 1]["role"] != "assistant":
+            continue
+        message, reply = messages[i], messages[i + 1]
+        texts = [part.get("text", "") for part in message["content"] if part.get("type") == "text"]
+        caption = caption_message(" ".join(texts), reply["content"])
+        caption_text = caption["content"][0]["text"]
+        if stats is not None:
+            saved_bytes = sum(len(part["image_url"]["url"]) for part in message["content"]
+                              if part.get("type") == "image_url")
+            saved_tokens = (estimate_message_tokens(message) + estimate_message_tokens(reply)
+                            - estimate_message_tokens(caption))
+            stats.record(caption_text, saved_bytes, saved_tokens)
+        messages[i:i + 2] = [caption]
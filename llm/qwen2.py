@@ -1,10 +1,16 @@
-import os
-from openai import OpenAI
+from util.logger import logger
+
+from .client import get_client, call_with_retry, request_timeout
+from .prompt import build_text_messages
+from .usage import record_usage
+
+STORY_MODEL = "qwen-max"
 
 user_prompt = """图片的描述如下:"""
 
 
-def generate_story(input_text: str, system_prompt: str, story_user_prompt: str = user_prompt, stream=False):
+def generate_story(input_text: str, system_prompt: str, story_user_prompt: str = user_prompt, stream=False,
+                   timeout: float = None):
     """
     根据多张图片的描述生成一个连贯的儿童故事
     
@@ -17,30 +23,30 @@ def generate_story(input_text: str, system_prompt: str, story_user_prompt: str =
         :param stream:
         :param input_text:
         :param system_prompt:
+        :param timeout: 本次调用的超时时间（秒），默认使用客户端配置
     """
 
-    # 打印输入文本的长度，用于调试
-    print(f"输入文本长度: {len(input_text)} 字符")
-
-    # 创建OpenAI客户端
-    client = OpenAI(
-        api_key=os.getenv("DASHSCOPE_API_KEY"),
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    )
+    # 组装请求并检查 token 预算；页面描述过多时省略最早的页面，第一行（封面的主题和人物）始终保留
+    messages, prompt_tokens = build_text_messages(system_prompt, story_user_prompt, input_text, STORY_MODEL,
+                                                  keep_first_lines=1)
+    logger.debug(f"输入文本长度: {len(input_text)} 字符, 估计输入 {prompt_tokens} tokens")
 
-    user_prompt2 = story_user_prompt + "\n\n" + input_text
+    # 流式输出时在最后一个数据块中返回 token 用量
+    stream_options = {"stream_options": {"include_usage": True}} if stream else {}
 
     # 调用模型生成故事
-    completion = client.chat.completions.create(
-        model="qwen-max",
+    completion = call_with_retry(
+        get_client().chat.completions.create,
+        model=STORY_MODEL,
         extra_body={
             "enable_search": True
         },
-        messages=[
-            {'role': 'system', 'content': system_prompt},
-            {'role': 'user', 'content': user_prompt2},
-        ],
-        stream=stream
+        messages=messages,
+        stream=stream,
+        **stream_options,
+        timeout=request_timeout(timeout),
+        description="Story generation",
+        estimated_tokens=prompt_tokens,
     )
 
     if stream:
@@ -49,5 +55,6 @@ def generate_story(input_text: str, system_prompt: str, story_user_prompt: str =
     else:
         # 非流式输出
         result = completion.choices[0].message.content
-        print(f"输出文本长度: {len(result)} 字符")
+        record_usage(completion.usage, STORY_MODEL)
+        logger.debug(f"输出文本长度: {len(result)} 字符")
         return result
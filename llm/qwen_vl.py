@@ -1,75 +1,112 @@
-import time
-
-from openai import OpenAI
-import os
 import base64
+import os
+from typing import Optional, Union
 
+from util.cancel import Cancelled
+from util.logger import logger
+from util.metrics import span
 
+from .client import get_client, call_with_retry, request_timeout
+from .usage import record_usage
+from .prompt import (VL_HISTORY_MAX_MESSAGES, VL_HISTORY_TOKEN_BUDGET, CompactionStats, check_budget,
+                     compact_history, trim_history)
 
-
+# VL_MODEL = "qwen-vl-max-2025-01-25"
+VL_MODEL = "qwen2.5-vl-32b-instruct"
 
 #  base 64 编码格式
 def encode_image(image_path):
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode("utf-8")
 
-def get_text_from_image(image_path: str, index: int, messages):
+def encode_image_bytes(image_bytes: bytes):
+    return base64.b64encode(image_bytes).decode("utf-8")
+
+def image_mime_type(image: Union[str, bytes]) -> str:
+    """根据文件头（字节）或扩展名（路径）判断图片的 MIME 类型"""
+    if isinstance(image, bytes):
+        if image[:3] == b"\xff\xd8\xff":
+            return "image/jpeg"
+        if image[:4] == b"RIFF" and image[8:12] == b"WEBP":
+            return "image/webp"
+        return "image/png"
+    extension = os.path.splitext(image)[1].lower()
+    return {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}.get(extension, "image/png")
+
+def get_text_from_image(image: Union[str, bytes], index: int, messages, timeout: float = None,
+                        compaction: str = "none", compaction_stats: Optional[CompactionStats] = None):
+    """
+    识别单张页面图片
+
+    Args:
+        image: 图片路径，或已在内存中编码好的图片字节（不再读写磁盘）
+        index: 页码索引
+        messages: 对话历史
+        timeout: 本次调用的超时时间（秒）
+        compaction: 识别完成后对话历史中图片的压缩策略，见 HISTORY_COMPACTION_STRATEGIES
+        compaction_stats: 可选的压缩统计，记录本书因压缩少发送的字节数和 token 数
+
+    Returns:
+        Tuple[str, list]: (页面描述, 更新后的对话历史)
+    """
     max_retries = 2
-    retries = 0
-    
-    # 保留系统提示和最近的对话历史，限制上下文长度
-    if len(messages) > 10:
-        # 保留系统提示
-        system_messages = [msg for msg in messages if msg["role"] == "system"]
-        # 获取最近的非系统消息
-        recent_messages = [msg for msg in messages if msg["role"] != "system"][-8:]
-        # 重建消息列表
-        messages = system_messages + recent_messages
-    
-    print(f"Processing image {index} with {len(messages)} messages in context")
-    
-    while retries < max_retries:
-        try:
-            user_prompt = f"图片:{index}"
-            base64_image = encode_image(image_path)
-            client = OpenAI(
-                api_key=os.getenv('DASHSCOPE_API_KEY'),
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-            )
 
-            # 添加用户消息到上下文
-            user_message = {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{base64_image}"},
-                    },
-                    {"type": "text", "text": user_prompt},
-                ],
-            }
-            messages.append(user_message)
-
-            completion = client.chat.completions.create(
-                # model="qwen-vl-max-2025-01-25",
-                model="qwen2.5-vl-32b-instruct",
-                messages=messages,
+    user_prompt = f"图片:{index}"
+    with span("image_encode", page=index + 1):
+        base64_image = encode_image_bytes(image) if isinstance(image, bytes) else encode_image(image)
+
+        # 用户消息只在请求成功后加入上下文，重试时不会重复追加
+        user_message = {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:{image_mime_type(image)};base64,{base64_image}"},
+                },
+                {"type": "text", "text": user_prompt},
+            ],
+        }
+
+    # 保留系统提示和最近的对话历史，按 token 预算裁剪上下文
+    messages = trim_history(messages, VL_HISTORY_TOKEN_BUDGET, max_messages=VL_HISTORY_MAX_MESSAGES)
+    request_messages = messages + [user_message]
+    prompt_tokens = check_budget(request_messages, VL_MODEL)
+    if compaction_stats is not None:
+        compaction_stats.count_request(messages)
+    logger.debug(f"Processing image {index} with {len(messages)} messages in context, ~{prompt_tokens} input tokens")
+
+    try:
+        with span("vl_request", api_name=VL_MODEL, page=index + 1) as attrs:
+            completion = call_with_retry(
+                get_client().chat.completions.create,
+                model=VL_MODEL,
+                messages=request_messages,
+                timeout=request_timeout(timeout),
+                max_retries=max_retries,
+                description=f"Image [{index}]",
+                estimated_tokens=prompt_tokens,
             )
-            
-            # 获取助手回复
-            assistant_message = completion.choices[0].message
-            content = assistant_message.content
-            
-            # 将助手回复添加到上下文
-            messages.append({
-                "role": "assistant",
-                "content": content
-            })
-            
-            return content, messages
-        except Exception as e:
-            retries += 1
-            print(f"Attempt {retries} failed: {e}")
-            if retries == max_retries:
-                print(f"Failed to infer image [{index}] after {max_retries} attempts.")
-                raise e
+            if completion.usage is not None:
+                attrs.update(prompt_tokens=completion.usage.prompt_tokens,
+                             completion_tokens=completion.usage.completion_tokens)
+    except Cancelled:
+        raise
+    except Exception:
+        logger.warning(f"Failed to infer image [{index}] after {max_retries} attempts.")
+        raise
+
+    # 获取助手回复
+    content = completion.choices[0].message.content
+    record_usage(completion.usage, VL_MODEL)
+
+    # 将用户消息和助手回复添加到上下文
+    messages.append(user_message)
+    messages.append({
+        "role": "assistant",
+        "content": content
+    })
+
+    # 压缩已识别页面的图片，后续页面的请求不再重复上传
+    compact_history(messages, compaction, compaction_stats)
+
+    return content, messages
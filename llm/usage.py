@@ -0,0 +1,88 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from util.metrics import metrics
+
+
+class UsageTracker:
+    """累计一组模型调用的 token 用量，可在多个线程间共享"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.queue_wait = 0.0
+        self.avoided_calls = 0
+
+    def add(self, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens or 0
+            self.completion_tokens += completion_tokens or 0
+
+    def add_queue_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.queue_wait += seconds
+
+    def add_avoided_calls(self, count: int) -> None:
+        with self._lock:
+            self.avoided_calls += count
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            return {"llm_calls": self.calls, "prompt_tokens": self.prompt_tokens,
+                    "completion_tokens": self.completion_tokens, "queue_wait_s": round(self.queue_wait, 3),
+                    "vl_calls_avoided": self.avoided_calls}
+
+
+_current_tracker: contextvars.ContextVar = contextvars.ContextVar("usage_tracker", default=None)
+
+
+@contextmanager
+def track_usage(tracker: Optional[UsageTracker] = None):
+    """
+    在当前上下文中统计模型调用的 token 用量
+
+    线程池中的任务需要通过 contextvars.copy_context().run 提交才能计入同一个 tracker。
+    """
+    tracker = tracker or UsageTracker()
+    token = _current_tracker.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _current_tracker.reset(token)
+
+
+def record_usage(usage, model: Optional[str] = None) -> None:
+    """
+    把一次调用响应中的 usage 计入进程级 token 统计和当前上下文的 tracker（没有 usage 时忽略）
+
+    Args:
+        usage: 响应中的 usage
+        model: 模型名，用于按模型统计
+    """
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0)
+    completion_tokens = getattr(usage, "completion_tokens", 0)
+    metrics.add_tokens(model, prompt_tokens, completion_tokens)
+    tracker = _current_tracker.get()
+    if tracker is not None:
+        tracker.add(prompt_tokens, completion_tokens)
+
+
+def record_avoided_calls(count: int) -> None:
+    """把页面预筛选省去的视觉模型调用次数计入当前上下文的 tracker"""
+    tracker = _current_tracker.get()
+    if tracker is not None and count:
+        tracker.add_avoided_calls(count)
+
+
+def record_queue_wait(seconds: float) -> None:
+    """把一次调用在限流器中的排队时间计入当前上下文的 tracker"""
+    tracker = _current_tracker.get()
+    if tracker is not None and seconds:
+        tracker.add_queue_wait(seconds)
@@ -1,16 +1,59 @@
+import argparse
+import json
 import os
 import traceback
 
 from core.config import Config
 from util import logger
-from app import create_interface
+from util.auth import check_credentials
 
 
 def user_login(username, password):
-    if username == "admin" and password == "admin":
-        return True
-    else:
-        return False
+    return check_credentials(username, password, Config.AUTH_USERNAME, Config.AUTH_PASSWORD)
+
+def run_batch(args):
+    """无界面批量处理目录中的PDF"""
+    from core import BatchRunner, FileHandler, StateManager, StoryProcessor
+
+    os.environ["DASHSCOPE_API_KEY"] = Config.API_KEY
+    story_processor = StoryProcessor(StateManager(), FileHandler())
+    runner = BatchRunner(story_processor, args.output, workers=args.workers,
+                         image_policy=args.image_policy)
+    summary = runner.run(args.input_dir)
+    print(json.dumps(summary, ensure_ascii=False))
+
+
+def run_api(args):
+    """只启动 HTTP 接口（不启动界面）"""
+    import uvicorn
+    from api import create_api
+    from core import FileHandler, JobScheduler, StateManager, StoryProcessor
+
+    os.environ["DASHSCOPE_API_KEY"] = Config.API_KEY
+    if Config.METRICS_ENABLED:
+        from util.metrics import start_metrics_server
+        start_metrics_server(Config.METRICS_PORT, Config.METRICS_HOST, Config.API_TOKEN)
+    scheduler = JobScheduler(StoryProcessor(StateManager(), FileHandler())).start()
+    uvicorn.run(create_api(scheduler), host=args.host, port=args.port, log_level="warning")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="儿童故事生成器")
+    subparsers = parser.add_subparsers(dest="command")
+
+    batch_parser = subparsers.add_parser("batch", help="无界面批量处理目录中的PDF")
+    batch_parser.add_argument("input_dir", help="PDF所在目录（递归查找）")
+    batch_parser.add_argument("-o", "--output", default="batch_results.jsonl",
+                              help="JSONL结果文件，同时作为断点记录，重新运行时跳过已成功的书")
+    batch_parser.add_argument("-w", "--workers", type=int, default=2, help="同时处理的书本数")
+    batch_parser.add_argument("--image-policy", default=Config.DEFAULT_IMAGE_POLICY,
+                              choices=list(Config.IMAGE_POLICIES.keys()), help="页面图片策略")
+
+    serve_parser = subparsers.add_parser("serve", help="只启动 HTTP 接口（不启动界面）")
+    serve_parser.add_argument("--host", default=Config.API_HOST)
+    serve_parser.add_argument("--port", type=int, default=Config.API_PORT)
+    return parser.parse_args(argv)
+
 
 def main():
     """主函数"""
@@ -18,13 +61,24 @@ def main():
         # 设置API密钥
         os.environ["DASHSCOPE_API_KEY"] = Config.API_KEY
         logger.info("Using DASHSCOPE_API_KEY from environment variables")
+        # 界面上传文件放到缓存目录所在的文件系统（须在导入 gradio 之前设置），已设置时保持不变
+        os.environ.setdefault("GRADIO_TEMP_DIR", str(Config.UPLOAD_TEMP_DIR.resolve()))
+
+        # 启动性能统计接口
+        if Config.METRICS_ENABLED:
+            from util.metrics import start_metrics_server
+            start_metrics_server(Config.METRICS_PORT, Config.METRICS_HOST, Config.API_TOKEN)
 
-        # 检查python命令
-        python_cmd = "python3" if os.system("python3 --version > /dev/null 2>&1") == 0 else "python"
-        logger.info(f"Using Python command: {python_cmd}")
+        # 界面和 HTTP 接口的任务由同一个调度器排队执行，共享执行名额、缓存、断点和请求状态
+        from core import FileHandler, JobScheduler, StateManager, StoryProcessor
+        scheduler = JobScheduler(StoryProcessor(StateManager(), FileHandler())).start()
+        if Config.API_ENABLED:
+            from api import start_api_server
+            start_api_server(scheduler)
 
         # 创建并启动Gradio界面
-        demo = create_interface()
+        from app import create_interface
+        demo = create_interface(scheduler)
         logger.info("Starting Gradio interface...")
         demo.launch(share=True, server_name="0.0.0.0", server_port=8000, auth=user_login)
 
@@ -42,4 +96,10 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.command == "batch":
+        run_batch(args)
+    elif args.command == "serve":
+        run_api(args)
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+# 测试从仓库根目录导入 core、llm、util
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True, scope="session")
+def log_dir(tmp_path_factory):
+    """测试产生的日志写到临时目录，不写入仓库中的 util/logs（子进程通过环境变量 LOG_DIR 继承）"""
+    from util.logger import file_handler
+
+    path = tmp_path_factory.mktemp("logs") / "story_generator.log"
+    os.environ["LOG_DIR"] = str(path.parent)
+    file_handler.acquire()
+    try:
+        if file_handler.stream is not None:
+            file_handler.stream.close()
+            file_handler.stream = None
+        file_handler.baseFilename = str(path)
+    finally:
+        file_handler.release()
+    return path.parent
@@ -0,0 +1,72 @@
+import types
+import urllib.error
+import urllib.request
+
+import pytest
+
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient
+
+from api import create_api
+from core.scheduler import JobScheduler
+from util.metrics import start_metrics_server
+
+from test_scheduler import RecordingProcessor, _scheduler, _wait_finished, pdf_factory  # noqa: F401
+
+TOKEN = "secret-token"
+AUTH = {"Authorization": f"Bearer {TOKEN}"}
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    processor = RecordingProcessor()
+    processor.file_handler = types.SimpleNamespace(story_store=None)
+    return _scheduler(processor, tmp_path).start()
+
+
+def test_requests_without_the_token_are_rejected(scheduler):
+    client = TestClient(create_api(scheduler, token=TOKEN))
+    assert client.get("/healthz").status_code == 401
+    assert client.get("/healthz", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get("/stories", headers={"Authorization": TOKEN}).status_code == 401
+    assert client.get("/healthz", headers=AUTH).status_code == 200
+
+
+def test_empty_token_rejects_every_request(scheduler):
+    client = TestClient(create_api(scheduler, token=""))
+    assert client.get("/healthz", headers={"Authorization": "Bearer "}).status_code == 401
+
+
+def test_client_priority_is_capped(scheduler, pdf_factory):
+    client = TestClient(create_api(scheduler, token=TOKEN, max_priority=0))
+    with open(pdf_factory(1), "rb") as f:
+        response = client.post("/jobs", files={"file": ("book.pdf", f, "application/pdf")},
+                               data={"priority": "99"}, headers=AUTH)
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    _wait_finished(scheduler, [job_id])
+    assert scheduler.get(job_id)["priority"] == 0
+
+
+def _get_status(url, headers=None):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}), timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_metrics_server_requires_token_when_set():
+    server = start_metrics_server(0, token=TOKEN)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        assert _get_status(url) == 401
+        assert _get_status(url, AUTH) == 200
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_metrics_server_refuses_public_address_without_token():
+    with pytest.raises(ValueError):
+        start_metrics_server(0, host="0.0.0.0")
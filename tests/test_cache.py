@@ -0,0 +1,133 @@
+import threading
+
+import pytest
+
+import core.cache as cache_module
+from core.cache import BookCache, SingleFlight, TextCache
+from core.config import Config
+from core.state import MemoryStateStore, StateManager
+
+
+class Clock:
+    """每次调用前进一秒，使 last_access 严格递增"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, "time", clock)
+    return clock
+
+
+def _keys(cache):
+    return {row[0] for row in cache._conn.execute(f"SELECT key FROM {cache.TABLE}")}
+
+
+def test_text_cache_evicts_least_recently_used_by_bytes(tmp_path, clock):
+    cache = TextCache(tmp_path / "text.sqlite3", max_bytes=10)
+    cache.put("a", "aaaa")
+    cache.put("b", "bbbb")
+    assert cache.get("a") == "aaaa"
+    # 超出上限，最久未使用的 b 被淘汰，刚读过的 a 保留
+    cache.put("c", "cc")
+    cache.put("d", "dd")
+    assert _keys(cache) == {"a", "c", "d"}
+    assert cache.stats()["bytes"] == 8
+    assert cache.get("b") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_text_cache_size_counts_utf8_bytes_and_replacements(tmp_path, clock):
+    cache = TextCache(tmp_path / "text.sqlite3", max_bytes=12)
+    cache.put("a", "熊")
+    cache.put("a", "小熊")
+    assert cache.stats()["bytes"] == 6
+    cache.put("b", "醒了")
+    assert _keys(cache) == {"a", "b"}
+    cache.put("c", "x")
+    assert _keys(cache) == {"b", "c"}
+    assert cache.stats()["bytes"] == 7
+
+
+def test_text_cache_total_survives_reopen(tmp_path, clock):
+    path = tmp_path / "text.sqlite3"
+    TextCache(path, max_bytes=10).put("a", "aaaaaa")
+    cache = TextCache(path, max_bytes=10)
+    assert cache.stats()["bytes"] == 6
+    cache.put("b", "bbbbbb")
+    assert _keys(cache) == {"b"}
+
+
+def test_book_cache_max_entries(tmp_path, clock):
+    cache = BookCache(tmp_path / "books.sqlite3", max_entries=2)
+    cache.put("a", "story a", "/stories/a.txt")
+    cache.put("b", "story b", None)
+    assert cache.get("a") == ("story a", "/stories/a.txt")
+    cache.put("c", "story c", "/stories/c.txt")
+    assert cache.get("b") is None
+    assert cache.get("a") == ("story a", "/stories/a.txt")
+    assert cache.stats() == {"hits": 2, "misses": 1, "entries": 2}
+
+
+def test_single_flight_shares_one_result(tmp_path, monkeypatch):
+    """相同的书同时提交多次时只生成一次，其余请求等待后读取同一份缓存结果"""
+    from core.storyProcess import StoryProcessor
+
+    monkeypatch.setattr(Config, "TRANSLATION_CACHE_ENABLED", False)
+    story_path = tmp_path / "story.txt"
+    story_path.write_text("story", encoding="utf-8")
+    processor = StoryProcessor(StateManager(MemoryStateStore()), None, caption_cache=None,
+                               book_cache=BookCache(tmp_path / "books.sqlite3", 10), checkpoint=None)
+    calls = []
+    release = threading.Event()
+
+    def generate(*args):
+        calls.append(args[2])
+        release.wait(10)
+        return "story", str(story_path)
+        yield
+
+    monkeypatch.setattr(processor, "_generate_story_from_pdf", generate)
+    begun = []
+    begin = processor.single_flight.begin
+    monkeypatch.setattr(processor.single_flight, "begin", lambda key: begun.append(key) or begin(key))
+    results = {}
+
+    def run(request_id):
+        processor.state_manager.register_request(request_id)
+        gen = processor._generate_story_deduplicated("book", "book.pdf", "book.pdf", request_id, "", "", None,
+                                                     0.0, None)
+        try:
+            while True:
+                next(gen)
+        except StopIteration as stop:
+            results[request_id] = stop.value
+
+    threads = [threading.Thread(target=run, args=(f"r{i}",)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    # 三个请求都登记后（一个执行、两个等待）才让生成结束
+    while len(begun) < 3:
+        release.wait(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+    assert len(calls) == 1
+    assert results == {f"r{i}": ("story", str(story_path)) for i in range(3)}
+
+
+def test_single_flight_begin_end():
+    flights = SingleFlight()
+    leader, event = flights.begin("key")
+    follower, same_event = flights.begin("key")
+    assert leader and not follower and same_event is event
+    flights.end("key")
+    assert event.is_set()
+    assert flights.begin("key")[0]
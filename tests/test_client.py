@@ -0,0 +1,148 @@
+import contextvars
+import socket
+import threading
+import time
+
+import pytest
+
+import llm.client as client
+from llm.client import call_with_retry
+from util.cancel import CancelToken, Cancelled, set_cancel_token
+from util.metrics import metrics
+
+
+def _run_with_token(token, func, *args, **kwargs):
+    """在绑定了取消令牌的独立上下文中执行"""
+    def run():
+        set_cancel_token(token)
+        return func(*args, **kwargs)
+    return contextvars.copy_context().run(run)
+
+
+def test_cancel_during_call_raises_cancelled():
+    token = CancelToken()
+    calls = []
+
+    def request(**kwargs):
+        calls.append(kwargs)
+        token.cancel()
+        raise ConnectionError("connection closed")
+
+    aborted = metrics.cancellation_totals().get("aborted_llm_calls", 0)
+    with pytest.raises(Cancelled):
+        _run_with_token(token, call_with_retry, request, model="test-cancel", max_retries=3)
+    assert len(calls) == 1
+    assert metrics.cancellation_totals()["aborted_llm_calls"] == aborted + 1
+
+
+def test_cancel_during_backoff_stops_retrying(monkeypatch):
+    monkeypatch.setattr(client, "backoff_delay", lambda attempt: 30.0)
+    token = CancelToken()
+    calls = []
+
+    def request(**kwargs):
+        calls.append(kwargs)
+        threading.Timer(0.1, token.cancel).start()
+        raise ConnectionError("temporary failure")
+
+    started = time.monotonic()
+    with pytest.raises(Cancelled):
+        _run_with_token(token, call_with_retry, request, model="test-cancel", max_retries=3)
+    assert time.monotonic() - started < 5
+    assert len(calls) == 1
+
+
+def test_already_cancelled_does_not_call():
+    token = CancelToken()
+    token.cancel()
+    calls = []
+    with pytest.raises(Cancelled):
+        _run_with_token(token, call_with_retry, lambda **kwargs: calls.append(kwargs), model="test-cancel")
+    assert calls == []
+
+
+def test_errors_without_cancel_are_retried_then_raised(monkeypatch):
+    monkeypatch.setattr(client, "backoff_delay", lambda attempt: 0.0)
+    calls = []
+
+    def request(**kwargs):
+        calls.append(kwargs)
+        raise ConnectionError("temporary failure")
+
+    with pytest.raises(ConnectionError):
+        _run_with_token(CancelToken(), call_with_retry, request, model="test-cancel", max_retries=2)
+    assert len(calls) == 2
+
+
+@pytest.fixture
+def silent_server():
+    """接受连接但从不响应的服务器，模拟长时间没有输出的模型请求"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    connections = []
+
+    def accept():
+        while True:
+            try:
+                connections.append(server.accept()[0])
+            except OSError:
+                return
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield f"http://127.0.0.1:{server.getsockname()[1]}/v1"
+    server.close()
+    for connection in connections:
+        connection.close()
+
+
+def test_cancel_closes_in_flight_request(monkeypatch, silent_server):
+    pytest.importorskip("openai")
+    monkeypatch.setenv("DASHSCOPE_API_KEY", "test")
+    monkeypatch.setenv("DASHSCOPE_BASE_URL", silent_server)
+    monkeypatch.setattr(client, "_client", None)
+    token = CancelToken()
+    threading.Timer(0.3, token.cancel).start()
+
+    started = time.monotonic()
+    with pytest.raises(Cancelled):
+        _run_with_token(token, call_with_retry, client.get_client().chat.completions.create,
+                        model="test-cancel", messages=[{"role": "user", "content": "你好"}],
+                        timeout=client.request_timeout(30))
+    assert time.monotonic() - started < 5
+
+
+class _FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def test_stream_holds_concurrency_slot_until_exhausted():
+    limiter = client.get_limiter("test-stream-exhaust")
+    stream = call_with_retry(lambda **kwargs: _FakeStream(["a", "b"]), model="test-stream-exhaust", stream=True)
+    assert limiter.in_flight == 1
+    assert list(stream) == ["a", "b"]
+    assert limiter.in_flight == 0
+    # 读完后再关闭不会重复归还
+    stream.close()
+    assert limiter.in_flight == 0
+
+
+def test_stream_releases_slot_on_close():
+    limiter = client.get_limiter("test-stream-close")
+    concurrency = limiter.concurrency
+    stream = call_with_retry(lambda **kwargs: _FakeStream(["a", "b"]), model="test-stream-close", stream=True)
+    next(iter(stream))
+    assert limiter.in_flight == 1
+    stream.close()
+    assert stream.closed
+    assert limiter.in_flight == 0
+    # 中途关闭不视为成功，不增加并发上限
+    assert limiter.concurrency == concurrency
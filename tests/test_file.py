@@ -0,0 +1,124 @@
+import errno
+import hashlib
+import io
+import os
+
+import pytest
+
+import core.file as file_module
+from core.file import FileHandler, copy_file
+
+CONTENT = os.urandom(3 * 1024 * 1024 + 17)
+CONTENT_HASH = hashlib.sha256(CONTENT).hexdigest()
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "book.pdf"
+    path.write_bytes(CONTENT)
+    return str(path)
+
+
+@pytest.fixture
+def no_hashing(monkeypatch):
+    """已知哈希时不应再读取文件计算"""
+    def fail(*args, **kwargs):
+        raise AssertionError("hash_file should not be called")
+    monkeypatch.setattr(file_module, "hash_file", fail)
+
+
+@pytest.fixture
+def no_link(monkeypatch):
+    def fail(src, dst):
+        raise OSError(errno.EXDEV, "cross-device link")
+    monkeypatch.setattr(file_module.os, "link", fail)
+
+
+def _unsupported(*args):
+    raise OSError(errno.ENOSYS, "not supported")
+
+
+def test_link_same_filesystem(tmp_path, source):
+    dst = tmp_path / "linked.pdf"
+    assert FileHandler.link_or_copy(source, str(dst)) == (CONTENT_HASH, "link")
+    assert os.stat(source).st_ino == dst.stat().st_ino
+
+
+def test_link_with_known_hash_does_not_read(tmp_path, source, no_hashing):
+    assert FileHandler.link_or_copy(source, str(tmp_path / "linked.pdf"), "known") == ("known", "link")
+
+
+def test_copy_across_filesystems(tmp_path, source, no_link):
+    dst = tmp_path / "copied.pdf"
+    assert FileHandler.link_or_copy(source, str(dst)) == (CONTENT_HASH, "copy")
+    assert dst.read_bytes() == CONTENT
+    assert os.stat(source).st_ino != dst.stat().st_ino
+
+
+def test_copy_with_known_hash_does_not_read(tmp_path, source, no_link, no_hashing):
+    dst = tmp_path / "copied.pdf"
+    assert FileHandler.link_or_copy(source, str(dst), "known") == ("known", "copy")
+    assert dst.read_bytes() == CONTENT
+
+
+def test_copy_refuses_existing_destination(tmp_path, source, no_link):
+    dst = tmp_path / "existing.pdf"
+    dst.write_bytes(b"old")
+    with pytest.raises(FileExistsError):
+        FileHandler.link_or_copy(source, str(dst))
+    assert dst.read_bytes() == b"old"
+
+
+@pytest.mark.parametrize("unsupported", [["copy_file_range"], ["copy_file_range", "sendfile"]])
+def test_copy_file_falls_back(tmp_path, source, monkeypatch, unsupported):
+    for name in unsupported:
+        monkeypatch.setattr(file_module.os, name, _unsupported, raising=False)
+    dst = tmp_path / "copied.pdf"
+    with open(source, "rb") as src_file, open(dst, "wb") as dest_file:
+        copy_file(src_file, dest_file)
+    assert dst.read_bytes() == CONTENT
+
+
+def test_copy_file_does_not_restart_after_partial_copy(tmp_path, source, monkeypatch):
+    if not hasattr(os, "copy_file_range"):
+        pytest.skip("copy_file_range is not available")
+    real_copy = os.copy_file_range
+    calls = []
+
+    def flaky(src_fd, dest_fd, count):
+        calls.append(count)
+        if len(calls) > 1:
+            raise OSError(errno.EINVAL, "invalid")
+        return real_copy(src_fd, dest_fd, 1024)
+
+    monkeypatch.setattr(file_module.os, "copy_file_range", flaky)
+    with open(source, "rb") as src_file, open(tmp_path / "copied.pdf", "wb") as dest_file:
+        with pytest.raises(OSError):
+            copy_file(src_file, dest_file)
+
+
+def test_save_stream_hashes_while_copying(tmp_path):
+    dst = tmp_path / "upload.pdf"
+    assert FileHandler.save_stream(io.BytesIO(CONTENT), str(dst)) == CONTENT_HASH
+    assert dst.read_bytes() == CONTENT
+
+
+def test_save_pdf_to_temp(tmp_path, source, no_hashing):
+    temp_dir = tmp_path / "temp"
+    temp_dir.mkdir()
+    success, error, path, pdf_hash = FileHandler.save_pdf_to_temp(source, str(temp_dir), "known")
+    assert (success, error, pdf_hash) == (True, "", "known")
+    assert path == str(temp_dir / "book.pdf")
+    assert os.stat(path).st_ino == os.stat(source).st_ino
+
+
+def test_save_pdf_bytes_to_temp(tmp_path):
+    success, _, path, pdf_hash = FileHandler.save_pdf_to_temp(CONTENT, str(tmp_path))
+    assert success and pdf_hash == CONTENT_HASH
+    assert os.path.basename(path) == "uploaded.pdf"
+    assert open(path, "rb").read() == CONTENT
+
+
+def test_save_pdf_to_temp_missing_file(tmp_path):
+    success, error, _, _ = FileHandler.save_pdf_to_temp(str(tmp_path / "missing.pdf"), str(tmp_path))
+    assert not success and "missing.pdf" in error
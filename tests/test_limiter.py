@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+import llm.limiter as limiter_module
+from llm.limiter import BACKOFF_FACTOR, DECREASE_COOLDOWN, ModelLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(limiter_module.time, "monotonic", clock)
+    return clock
+
+
+def test_token_bucket_refills_at_capacity_per_minute(clock):
+    bucket = TokenBucket(60)
+    bucket.take(60)
+    assert bucket.wait_time(1, clock()) == pytest.approx(1.0)
+    clock.now += 30
+    assert bucket.wait_time(30, clock()) == 0.0
+    assert bucket.wait_time(31, clock()) == pytest.approx(1.0)
+    # 补充不超过容量
+    clock.now += 3600
+    bucket.wait_time(0, clock())
+    assert bucket.level == 60
+
+
+def test_token_bucket_allows_negative_level_for_usage_correction(clock):
+    bucket = TokenBucket(60)
+    bucket.take(60)
+    bucket.take(30)
+    assert bucket.wait_time(1, clock()) == pytest.approx(31.0)
+
+
+def test_requests_wait_for_rpm_and_tpm(clock):
+    limiter = ModelLimiter("test", rpm=2, tpm=100, max_concurrency=8)
+    assert limiter.try_acquire(10) == (True, 0.0)
+    assert limiter.try_acquire(10) == (True, 0.0)
+    ok, delay = limiter.try_acquire(10)
+    assert not ok and delay == pytest.approx(30.0)
+    clock.now += 30
+    assert limiter.try_acquire(10)[0]
+    # token 额度不足时按 tpm 的补充速度等待
+    limiter = ModelLimiter("test", rpm=1000, tpm=100, max_concurrency=8)
+    assert limiter.try_acquire(70)[0]
+    ok, delay = limiter.try_acquire(60)
+    assert not ok and delay == pytest.approx((60 - 30) * 60 / 100)
+
+
+def test_throttled_release_halves_concurrency_once_per_cooldown(clock):
+    limiter = ModelLimiter("test", rpm=1000, tpm=10 ** 6, max_concurrency=8, min_concurrency=1)
+    for _ in range(3):
+        assert limiter.try_acquire(0)[0]
+    limiter.release(throttled=True)
+    assert limiter.concurrency == 8 * BACKOFF_FACTOR
+    # 同一波请求一起被限流只减少一次
+    limiter.release(throttled=True)
+    assert limiter.concurrency == 8 * BACKOFF_FACTOR
+    clock.now += DECREASE_COOLDOWN
+    limiter.release(throttled=True)
+    assert limiter.concurrency == 8 * BACKOFF_FACTOR ** 2
+    assert limiter.throttled == 3
+    assert limiter.in_flight == 0
+
+
+def test_concurrency_never_drops_below_minimum(clock):
+    limiter = ModelLimiter("test", rpm=1000, tpm=10 ** 6, max_concurrency=4, min_concurrency=2)
+    for _ in range(5):
+        limiter.try_acquire(0)
+        limiter.release(throttled=True)
+        clock.now += DECREASE_COOLDOWN
+    assert limiter.concurrency == 2
+
+
+def test_successes_increase_concurrency_additively_up_to_max(clock):
+    limiter = ModelLimiter("test", rpm=1000, tpm=10 ** 6, max_concurrency=4, min_concurrency=1)
+    limiter.concurrency = 2.0
+    # 一个并发窗口（2 个请求）全部成功约增加 1
+    for _ in range(2):
+        limiter.try_acquire(0)
+        limiter.release()
+    assert limiter.concurrency == pytest.approx(2 + 1 / 2 + 1 / 2.5)
+    for _ in range(20):
+        limiter.try_acquire(0)
+        limiter.release()
+    assert limiter.concurrency == 4
+
+
+def test_cancelled_release_does_not_change_concurrency(clock):
+    limiter = ModelLimiter("test", rpm=1000, tpm=10 ** 6, max_concurrency=4)
+    limiter.concurrency = 2.0
+    limiter.try_acquire(0)
+    limiter.release(cancelled=True)
+    assert limiter.concurrency == 2.0
+    assert limiter.in_flight == 0
+
+
+def test_in_flight_is_capped_by_concurrency(clock):
+    limiter = ModelLimiter("test", rpm=1000, tpm=10 ** 6, max_concurrency=2)
+    assert limiter.try_acquire(0)[0] and limiter.try_acquire(0)[0]
+    assert limiter.try_acquire(0)[0] is False
+    limiter.release()
+    assert limiter.try_acquire(0)[0]
+
+
+def test_acquire_async_waits_for_refill_without_blocking(clock, monkeypatch):
+    limiter = ModelLimiter("test", rpm=60, tpm=10 ** 6, max_concurrency=100)
+    for _ in range(60):
+        limiter.try_acquire(0)
+    sleeps = []
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+        clock.now += delay
+
+    monkeypatch.setattr(limiter_module.asyncio, "sleep", fake_sleep)
+    waited = asyncio.run(limiter.acquire_async())
+    assert sleeps == [pytest.approx(1.0)]
+    assert waited == pytest.approx(1.0)
+    assert limiter.waiting == 0
+    assert limiter.in_flight == 61
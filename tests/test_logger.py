@@ -0,0 +1,77 @@
+import os
+
+from util.logger import read_log
+
+REQUEST_ID = "3f2b6c1e-8d4a-4c5e-9b7a-1a2b3c4d5e6f"
+
+
+def _line(level, request_id, message, second=0):
+    return f"2026-10-18 10:00:{second:02d} - story_agent - {level} - {request_id} - {message}\n"
+
+
+def _write(path, text, mode="a"):
+    with open(path, mode, encoding="utf-8") as f:
+        f.write(text)
+
+
+def test_tail_keeps_multiline_records_and_filters(tmp_path):
+    path = str(tmp_path / "app.log")
+    _write(path, _line("INFO", REQUEST_ID, "开始")
+           + _line("ERROR", REQUEST_ID, "出错") + "Traceback (most recent call last):\n  boom\n"
+           + _line("INFO", "-", "其他请求"))
+    text, _ = read_log(10, request_id=REQUEST_ID, level="WARNING", path=path)
+    assert text == _line("ERROR", REQUEST_ID, "出错") + "Traceback (most recent call last):\n  boom\n"
+
+
+def test_non_uuid_request_ids_are_parsed(tmp_path):
+    path = str(tmp_path / "app.log")
+    _write(path, _line("INFO", "batch-7", "第一本") + _line("INFO", "job_42", "第二本")
+           + _line("DEBUG", "batch-7", "细节"))
+    text, _ = read_log(10, request_id="batch-7", path=path)
+    assert text == _line("INFO", "batch-7", "第一本") + _line("DEBUG", "batch-7", "细节")
+    text, _ = read_log(10, level="INFO", path=path)
+    assert "细节" not in text and "第二本" in text
+
+
+def test_partial_last_line_is_read_once_complete(tmp_path):
+    path = str(tmp_path / "app.log")
+    first = _line("INFO", REQUEST_ID, "第一条")
+    second = _line("INFO", REQUEST_ID, "第二条", second=1)
+    _write(path, first + second[:20])
+    text, offset = read_log(10, path=path)
+    assert text == first
+    _write(path, second[20:])
+    text, offset = read_log(10, offset, path=path)
+    assert text == second
+    text, _ = read_log(10, offset, path=path)
+    assert text == ""
+
+
+def test_offset_resumes_across_rotation(tmp_path):
+    path = str(tmp_path / "app.log")
+    old = _line("INFO", REQUEST_ID, "轮转前")
+    _write(path, old)
+    _, offset = read_log(10, path=path)
+    # 轮转前又写了一条，随后文件改名为 .1，新文件比原偏移更长
+    missed = _line("INFO", REQUEST_ID, "轮转前最后一条", second=1)
+    _write(path, missed)
+    os.replace(path, path + ".1")
+    new = "".join(_line("INFO", REQUEST_ID, f"轮转后 {i}", second=2) for i in range(3))
+    _write(path, new, mode="w")
+    text, offset = read_log(10, offset, path=path)
+    assert text == missed + new
+    assert read_log(10, offset, path=path)[0] == ""
+
+
+def test_offset_falls_back_to_tail_when_rotated_file_is_gone(tmp_path):
+    path = str(tmp_path / "app.log")
+    _write(path, _line("INFO", REQUEST_ID, "旧文件"))
+    _, offset = read_log(10, path=path)
+    # 新文件替换旧文件（轮转出的文件已被清理）
+    _write(path + ".new", _line("INFO", REQUEST_ID, "新文件"))
+    os.replace(path + ".new", path)
+    assert read_log(10, offset, path=path)[0] == _line("INFO", REQUEST_ID, "新文件")
+
+
+def test_missing_file(tmp_path):
+    assert read_log(10, path=str(tmp_path / "missing.log")) == ("", None)
@@ -0,0 +1,135 @@
+import io
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+
+from core.checkpoint import PageCheckpoint
+from util.page_filter import PageFilter, page_fingerprint
+
+PAGE_SIZE = (842, 595)
+
+
+def _encode(image, fmt="PNG", **kwargs):
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **kwargs)
+    return buffer.getvalue()
+
+
+def _picture_page(seed, text="The bear wakes up."):
+    """整页插图加一行文字"""
+    rng = random.Random(seed)
+    tile = Image.frombytes("RGB", (40, 40), bytes(rng.getrandbits(8) for _ in range(40 * 40 * 3)))
+    page = Image.new("RGB", PAGE_SIZE, "white")
+    page.paste(tile.resize((760, 400), Image.NEAREST), (40, 40))
+    ImageDraw.Draw(page).text((50, 480), text, fill="black", font_size=24)
+    return page
+
+
+def _blank_page(noise_seed=0):
+    """带轻微扫描噪点的空白页"""
+    rng = random.Random(noise_seed)
+    page = Image.new("L", PAGE_SIZE, 245)
+    page.putdata([245 + rng.randint(-6, 6) for _ in range(PAGE_SIZE[0] * PAGE_SIZE[1])])
+    return page.convert("RGB")
+
+
+def _copyright_page():
+    page = Image.new("RGB", PAGE_SIZE, "white")
+    ImageDraw.Draw(page).text((260, 520), "Copyright 2020 Example Press. All rights reserved.",
+                              fill="black", font_size=12)
+    return page
+
+
+def test_blank_pages():
+    page_filter = PageFilter()
+    assert page_filter.check(0, _encode(Image.new("RGB", PAGE_SIZE, "white"))) == ("blank", None)
+    assert page_filter.check(1, _encode(_blank_page(), "JPEG", quality=60)) == ("blank", None)
+
+
+def test_copyright_page_is_not_blank():
+    page_filter = PageFilter()
+    assert page_filter.check(0, _encode(_copyright_page())) == ("unique", None)
+
+
+def test_duplicate_pages():
+    page_filter = PageFilter()
+    original = _picture_page(1)
+    assert page_filter.check(0, _encode(original)) == ("unique", None)
+    assert page_filter.check(1, _encode(_picture_page(2, "Something else."))) == ("unique", None)
+    # 同一页重复出现，以及缩放后重新以 JPEG 编码（重复扫描）
+    assert page_filter.check(2, _encode(original)) == ("duplicate", 0)
+    rescanned = original.resize((int(PAGE_SIZE[0] * 0.7), int(PAGE_SIZE[1] * 0.7)), Image.BILINEAR)
+    assert page_filter.check(3, _encode(rescanned, "JPEG", quality=40)) == ("duplicate", 0)
+
+
+def test_same_picture_with_more_text_is_not_duplicate():
+    page_filter = PageFilter()
+    page_filter.check(0, _encode(_picture_page(1)))
+    longer = _picture_page(1, "The bear goes outside and plays in the snow with friends all day long.")
+    draw = ImageDraw.Draw(longer)
+    draw.text((50, 520), "Then they build a snowman and have hot cocoa by the fire.", fill="black", font_size=24)
+    assert page_filter.check(1, _encode(longer)) == ("unique", None)
+
+
+def test_seeded_fingerprints_from_checkpoint(tmp_path):
+    checkpoint = PageCheckpoint(tmp_path / "checkpoints.sqlite3", max_age_days=1)
+    page = _encode(_picture_page(3))
+    phash, ink = page_fingerprint(page)
+    checkpoint.save_fingerprint("book", 4, phash, ink)
+    # 超出SQLite有符号整数范围的哈希也能原样读回
+    checkpoint.save_fingerprint("other", 0, 2 ** 64 - 1, 0.5)
+    assert checkpoint.load_fingerprints("book") == {4: (phash, pytest.approx(ink))}
+    assert checkpoint.load_fingerprints("other") == {0: (2 ** 64 - 1, 0.5)}
+
+    page_filter = PageFilter()
+    for index, (saved_hash, saved_ink) in checkpoint.load_fingerprints("book").items():
+        page_filter.add(index, saved_hash, saved_ink)
+    assert page_filter.check(9, page) == ("duplicate", 4)
+
+    checkpoint.clear("book")
+    assert checkpoint.load_fingerprints("book") == {}
+
+
+def test_fingerprint_accepts_path(tmp_path):
+    path = tmp_path / "page.png"
+    _picture_page(5).save(path)
+    assert page_fingerprint(str(path)) == page_fingerprint(path.read_bytes())
+
+
+def _pdf_with_pages(tmp_path, images):
+    fitz = pytest.importorskip("fitz")
+    document = fitz.open()
+    for image in images:
+        page = document.new_page(width=PAGE_SIZE[0], height=PAGE_SIZE[1])
+        if image is not None:
+            page.insert_image(page.rect, stream=_encode(image))
+    path = tmp_path / "book.pdf"
+    document.save(str(path))
+    return str(path)
+
+
+def test_pdf_page_fingerprint_matches_rendered_image(tmp_path):
+    fitz = pytest.importorskip("fitz")
+    from util.page_filter import pdf_page_fingerprint
+
+    path = _pdf_with_pages(tmp_path, [None, _picture_page(1), _picture_page(1), _picture_page(2, "Else.")])
+    page_filter = PageFilter()
+    with fitz.open(path) as document:
+        verdicts = [page_filter.classify(i, *pdf_page_fingerprint(document[i])) for i in range(4)]
+        rendered = document[1].get_pixmap(matrix=fitz.Matrix(2, 2)).tobytes("png")
+        assert bin(pdf_page_fingerprint(document[1])[0] ^ page_fingerprint(rendered)[0]).count("1") <= 4
+    assert verdicts == [("blank", None), ("unique", None), ("duplicate", 1), ("unique", None)]
+
+
+@pytest.mark.parametrize("processes", [0, 2])
+def test_render_records_fingerprints_before_yielding(tmp_path, processes):
+    from util.pdf_convert_image import pdf_iter_page_images
+
+    path = _pdf_with_pages(tmp_path, [_picture_page(1), None, _picture_page(2)])
+    fingerprints = {}
+    for index, _ in enumerate(pdf_iter_page_images(path, None, in_memory=True, processes=processes,
+                                                   chunk_pages=2, fingerprints=fingerprints)):
+        assert index in fingerprints
+    assert sorted(fingerprints) == [0, 1, 2]
+    assert fingerprints[1][1] < PageFilter().blank_ink_ratio
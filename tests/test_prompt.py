@@ -0,0 +1,136 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+import llm.prompt as prompt
+from llm.prompt import (OMITTED_LINES_NOTE, CompactionStats, build_text_messages, compact_history,
+                        estimate_message_tokens, estimate_messages_tokens, estimate_text_tokens, trim_history,
+                        trim_input_lines)
+
+
+def _image_url(size=(280, 280)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "white").save(buffer, "PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def _page(index, caption):
+    """一页的识别对话：带图片的用户消息和助手描述"""
+    return [
+        {"role": "user", "content": [{"type": "image_url", "image_url": {"url": _image_url()}},
+                                     {"type": "text", "text": f"图片:{index}"}]},
+        {"role": "assistant", "content": caption},
+    ]
+
+
+def _book(pages):
+    messages = [{"role": "system", "content": "描述每一页"}]
+    for index in range(pages):
+        messages += _page(index, f"第{index}页，小熊在雪地里玩耍。")
+    return messages
+
+
+def test_input_already_in_prompt_is_still_sent():
+    messages, _ = build_text_messages("请根据描述写故事：小熊", "图片的描述如下:", "小熊", "qwen-max")
+    assert messages[1]["content"] == "图片的描述如下:\n\n小熊"
+
+
+def test_trim_input_lines_drops_oldest_lines_and_keeps_head():
+    lines = [f"第{i}页：" + "字" * 20 for i in range(10)]
+    text = "\n".join(lines)
+    trimmed, omitted = trim_input_lines(text, 100, keep_first=1)
+    kept = trimmed.split("\n")
+    assert omitted > 0
+    assert kept[0] == lines[0]
+    assert kept[1] == OMITTED_LINES_NOTE
+    assert kept[2:] == lines[1 + omitted:]
+    assert sum(estimate_text_tokens(line) + 1 for line in kept) <= 100
+
+
+def test_trim_input_lines_leaves_text_within_budget_unchanged():
+    assert trim_input_lines("第一页\n第二页", 100) == ("第一页\n第二页", 0)
+
+
+def test_long_book_is_trimmed_to_budget_instead_of_failing(monkeypatch):
+    monkeypatch.setitem(prompt.MODEL_INPUT_BUDGETS, "test-model", 200)
+    captions = "\n".join(["封面：小熊和小兔"] + [f"第{i}页：" + "雪" * 30 for i in range(2, 40)])
+    messages, tokens = build_text_messages("写一个故事", "图片的描述如下:", captions, "test-model",
+                                           keep_first_lines=1)
+    assert tokens <= 200
+    assert tokens == estimate_messages_tokens(messages)
+    content = messages[1]["content"]
+    assert "封面：小熊和小兔" in content
+    assert OMITTED_LINES_NOTE in content
+    assert content.endswith("第39页：" + "雪" * 30)
+
+
+def test_image_tokens_follow_patch_grid():
+    message = _page(0, "")[0]
+    # 280x280 像素为 10x10 个图块，另加起止标记、文字和角色开销
+    assert estimate_message_tokens(message) == 4 + 100 + prompt.IMAGE_EXTRA_TOKENS + estimate_text_tokens("图片:0")
+
+
+def test_trim_history_keeps_system_and_fits_budget():
+    messages = _book(4)
+    page_tokens = estimate_messages_tokens(messages[1:3])
+    budget = estimate_messages_tokens(messages[:1]) + 2 * page_tokens
+    trimmed = trim_history(messages, budget)
+    assert trimmed == messages[:1] + messages[-4:]
+    assert estimate_messages_tokens(trimmed) <= budget
+
+
+def test_trim_history_never_starts_with_assistant():
+    messages = _book(3)
+    trimmed = trim_history(messages, 10 ** 6, max_messages=3)
+    assert [msg["role"] for msg in trimmed] == ["system", "user", "assistant"]
+    assert trimmed[1:] == messages[-2:]
+
+
+@pytest.mark.parametrize("strategy", ["stub", "keep_last", "caption"])
+def test_compaction_removes_images_and_counts_savings(strategy):
+    messages = _book(3)
+    original = [dict(msg) for msg in messages]
+    stats = CompactionStats()
+    compact_history(messages, strategy, stats)
+    images = [msg for msg in messages if isinstance(msg["content"], list)
+              and any(part["type"] == "image_url" for part in msg["content"])]
+    assert len(images) == (1 if strategy == "keep_last" else 0)
+    assert stats.images_compacted == 3 - len(images)
+    saved = estimate_messages_tokens(original) - estimate_messages_tokens(messages)
+    assert saved > 0
+
+    # 下一次请求发送压缩后的历史，统计的节省量与实际少发送的 token 数一致
+    stats.count_request(messages)
+    assert stats.saved_tokens == saved
+    assert stats.saved_bytes == sum(len(_image_url()) for _ in range(stats.images_compacted))
+
+
+def test_caption_compaction_replaces_image_with_caption():
+    messages = _book(2) + [_page(2, "")[0]]
+    compact_history(messages, "caption")
+    assert [msg["role"] for msg in messages] == ["system", "user", "user", "user"]
+    assert messages[1]["content"] == [{"type": "text", "text": "图片:0 页面内容：第0页，小熊在雪地里玩耍。"}]
+    # 还没有描述的当前页面保留图片
+    assert messages[3]["content"][0]["type"] == "image_url"
+    # 描述只出现一次
+    assert sum("第1页" in str(msg["content"]) for msg in messages) == 1
+
+
+def test_caption_compaction_saves_more_than_stub():
+    stub, caption = _book(3), _book(3)
+    compact_history(stub, "stub")
+    compact_history(caption, "caption")
+    assert estimate_messages_tokens(caption) < estimate_messages_tokens(stub)
+
+
+def test_compaction_does_not_modify_shared_messages():
+    messages = _book(1)
+    shared = messages[1]
+    compact_history(messages, "caption")
+    assert shared["content"][0]["type"] == "image_url"
+    compact_history(messages, "none")
+    with pytest.raises(ValueError):
+        compact_history(messages, "unknown")
+
@@ -0,0 +1,192 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from core.scheduler import JobScheduler
+from core.state import MemoryStateStore, StateManager
+
+
+class RecordingProcessor:
+    """按执行顺序记录任务的故事处理器，每个任务立即产出完整故事"""
+
+    def __init__(self):
+        self.state_manager = StateManager(MemoryStateStore())
+        self.order = []
+        self.pdf_hashes = {}
+        self.release = threading.Event()
+        self.release.set()
+
+    def process_pdf(self, pdf_file, request_id, vl_system_prompt, story_system_prompt, image_policy,
+                    retry_failed=False, progress=None, pdf_hash=None):
+        self.release.wait(10)
+        self.order.append(request_id)
+        self.pdf_hashes[request_id] = pdf_hash
+        yield f"故事 {request_id}", f"/stories/{request_id}.txt"
+
+
+@pytest.fixture
+def pdf_factory(tmp_path):
+    fitz = pytest.importorskip("fitz")
+
+    def make(pages, name=None):
+        document = fitz.open()
+        for number in range(pages):
+            document.new_page().insert_text((72, 72), f"page {number + 1}")
+        path = tmp_path / (name or f"book_{pages}.pdf")
+        document.save(str(path))
+        return str(path)
+
+    return make
+
+
+def _scheduler(processor, tmp_path, **kwargs):
+    kwargs.setdefault("aging_seconds_per_page", 1e9)
+    return JobScheduler(processor, db_path=tmp_path / "jobs.sqlite3", upload_dir=tmp_path / "uploads", **kwargs)
+
+
+def _wait_finished(scheduler, job_ids, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        jobs = [scheduler.get(job_id) for job_id in job_ids]
+        if all(job["status"] in JobScheduler.FINISHED_STATUSES for job in jobs):
+            return jobs
+        time.sleep(0.02)
+    raise AssertionError("任务没有在限定时间内结束")
+
+
+def _job(job_id, user, pages=1, priority=0, created_at=0.0):
+    return {"job_id": job_id, "user": user, "pages": pages, "priority": priority, "created_at": created_at}
+
+
+def test_choose_prefers_priority_then_fair_user_then_short_book(tmp_path):
+    scheduler = _scheduler(RecordingProcessor(), tmp_path)
+    queued = [_job("a-long", "a", pages=30), _job("a-short", "a", pages=5), _job("b", "b", pages=50),
+              _job("urgent", "c", pages=100, priority=1)]
+    assert scheduler._choose(queued, {}, {}, now=0.0)["job_id"] == "urgent"
+    queued.pop()
+    # a 已有任务在执行，轮到 b
+    assert scheduler._choose(queued, {"a": 1}, {}, now=0.0)["job_id"] == "b"
+    # 都没有执行中的任务时，最久没有被调度的用户优先，其任务中页数少的优先
+    assert scheduler._choose(queued, {}, {"a": 1.0, "b": 2.0}, now=3.0)["job_id"] == "a-short"
+
+
+def test_choose_ages_long_waiting_books(tmp_path):
+    scheduler = _scheduler(RecordingProcessor(), tmp_path, aging_seconds_per_page=1.0)
+    # 每等待1秒视为少一页：长书等待10秒时短书仍优先，等待100秒后长书优先
+    for waited, expected in ((10.0, "new-short"), (100.0, "old-long")):
+        queued = [_job("old-long", "a", pages=30, created_at=0.0), _job("new-short", "a", pages=5, created_at=waited)]
+        assert scheduler._choose(queued, {}, {}, now=waited)["job_id"] == expected
+
+
+def test_users_take_turns(tmp_path, pdf_factory):
+    processor = RecordingProcessor()
+    scheduler = _scheduler(processor, tmp_path, workers=1)
+    jobs = [scheduler.submit(pdf_factory(pages), user="a")["job_id"] for pages in (3, 1, 2)]
+    jobs.append(scheduler.submit(pdf_factory(4), user="b")["job_id"])
+    scheduler.start()
+    try:
+        _wait_finished(scheduler, jobs)
+    finally:
+        scheduler.shutdown(5)
+    users = ["b" if job_id == jobs[3] else "a" for job_id in processor.order]
+    assert users.index("b") <= 1
+    # 同一用户的书按页数从少到多执行
+    assert [job_id for job_id in processor.order if job_id != jobs[3]] == [jobs[1], jobs[2], jobs[0]]
+
+
+def test_restart_requeues_unfinished_jobs(tmp_path, pdf_factory):
+    first = _scheduler(RecordingProcessor(), tmp_path)
+    running = first.submit(pdf_factory(2, "running.pdf"), user="a")
+    queued = first.submit(pdf_factory(1, "queued.pdf"), user="b")
+    # 模拟进程在执行第一个任务时退出
+    with sqlite3.connect(str(tmp_path / "jobs.sqlite3")) as conn:
+        conn.execute("UPDATE jobs SET status = ?, started_at = ? WHERE job_id = ?",
+                     (JobScheduler.STATUS_RUNNING, time.time(), running["job_id"]))
+
+    processor = RecordingProcessor()
+    restarted = _scheduler(processor, tmp_path)
+    job_ids = [running["job_id"], queued["job_id"]]
+    assert [restarted.get(job_id)["status"] for job_id in job_ids] == [JobScheduler.STATUS_QUEUED] * 2
+    restarted.start()
+    try:
+        jobs = _wait_finished(restarted, job_ids)
+    finally:
+        restarted.shutdown(5)
+    assert [job["status"] for job in jobs] == [JobScheduler.STATUS_SUCCEEDED] * 2
+    assert jobs[0]["story_path"] == f"/stories/{running['job_id']}.txt"
+    # 提交时计算的PDF哈希随任务保存，重启后仍传给处理器
+    assert processor.pdf_hashes[running["job_id"]] == running["pdf_hash"]
+
+
+class PartialStoryProcessor(RecordingProcessor):
+    """先产出两段部分故事，等待 release 后按取消令牌结束或产出完整故事"""
+
+    def process_pdf(self, pdf_file, request_id, vl_system_prompt, story_system_prompt, image_policy,
+                    retry_failed=False, progress=None, pdf_hash=None):
+        yield "从前", None
+        yield "从前有", None
+        self.release.wait(10)
+        if self.state_manager.cancel_token(request_id).cancelled:
+            yield "处理已停止", None
+            return
+        yield "从前有一只小熊。", f"/stories/{request_id}.txt"
+
+
+@pytest.mark.parametrize("cancel_on_close, expected", [(True, JobScheduler.STATUS_CANCELLED),
+                                                       (False, JobScheduler.STATUS_SUCCEEDED)])
+def test_closing_stream(tmp_path, pdf_factory, cancel_on_close, expected):
+    processor = PartialStoryProcessor()
+    processor.release.clear()
+    scheduler = _scheduler(processor, tmp_path).start()
+    try:
+        stream = scheduler.stream(cancel_on_close=cancel_on_close, pdf_file=pdf_factory(1), user="a")
+        assert next(stream) == ("从前", None)
+        job_id = next(iter(scheduler._jobs))
+        stream.close()
+        processor.release.set()
+        job = _wait_finished(scheduler, [job_id])[0]
+    finally:
+        processor.release.set()
+        scheduler.shutdown(5)
+    assert job["status"] == expected
+
+
+def test_partial_story_is_forwarded_immediately(tmp_path, pdf_factory):
+    processor = PartialStoryProcessor()
+    processor.release.clear()
+    scheduler = _scheduler(processor, tmp_path).start()
+    try:
+        stream = scheduler.stream(pdf_file=pdf_factory(1), user="a")
+        # 处理器还在等待时，已产出的两段部分故事都已收到
+        assert next(stream) == ("从前", None)
+        assert next(stream) == ("从前有", None)
+        job_id = next(iter(scheduler._jobs))
+        processor.release.set()
+        assert list(stream) == [("从前有一只小熊。", f"/stories/{job_id}.txt")]
+    finally:
+        processor.release.set()
+        scheduler.shutdown(5)
+
+
+def test_queue_estimate_is_cached_until_queue_changes(tmp_path, pdf_factory, monkeypatch):
+    processor = RecordingProcessor()
+    scheduler = _scheduler(processor, tmp_path, workers=1, default_seconds_per_page=10.0)
+    simulations = []
+    simulate = scheduler._simulate
+    monkeypatch.setattr(scheduler, "_simulate", lambda now: simulations.append(now) or simulate(now))
+    first = scheduler.submit(pdf_factory(2), user="a")
+    second = scheduler.submit(pdf_factory(3), user="a")
+    assert len(simulations) == 2
+    for _ in range(5):
+        assert scheduler.get(first["job_id"])["position"] == 0
+        info = scheduler.get(second["job_id"])
+        assert info["position"] == 1 and 0 < info["estimated_wait_s"] <= 20.0
+    assert len(simulations) == 2
+    third = scheduler.submit(pdf_factory(5), user="a")
+    assert len(simulations) == 3
+    assert third["position"] == 2
+    scheduler.cancel(first["job_id"])
+    assert scheduler.get(second["job_id"])["position"] == 0
+    assert len(simulations) == 4
@@ -0,0 +1,89 @@
+import pytest
+
+import core.state as state
+from core.state import MemoryStateStore, SqliteStateStore, StateManager, StateStore
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(state.time, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path, clock):
+    if request.param == "memory":
+        return MemoryStateStore(ttl=60)
+    return SqliteStateStore(tmp_path / "states.sqlite3", ttl=60)
+
+
+def test_prune_evicts_after_ttl(store, clock):
+    store.create("idle")
+    store.create("active")
+    clock.now += 45
+    store.set_progress("active", 0.5, "识别第 3 页")
+    clock.now += 30
+    assert store.prune() == 1
+    assert store.get("idle") is None
+    assert store.get("active")["desc"] == "识别第 3 页"
+    assert store.existing(["idle", "active"]) == {"active"}
+
+
+def test_stop_refreshes_ttl(store, clock):
+    store.create("r")
+    clock.now += 50
+    assert store.request_stop("r")
+    clock.now += 50
+    assert store.prune() == 0
+    assert store.stopped(["r", "missing"]) == {"r"}
+    assert not store.request_stop("missing")
+
+
+def test_create_prunes_periodically(clock):
+    store = MemoryStateStore(ttl=60)
+    store.create("old")
+    clock.now += 30
+    store.create("new")
+    assert store.get("old") is not None
+    clock.now += state.PRUNE_INTERVAL
+    store.create("newer")
+    assert store.get("old") is None
+    assert store.get("newer") is not None
+
+
+def test_sqlite_batches_large_lookups(tmp_path, clock):
+    store = SqliteStateStore(tmp_path / "states.sqlite3", ttl=60)
+    request_ids = [f"r{i}" for i in range(state.SQL_BATCH_SIZE * 2 + 7)]
+    for request_id in request_ids[::3]:
+        store.create(request_id)
+    store.request_stop("r0")
+    assert store.existing(request_ids) == set(request_ids[::3])
+    assert store.stopped(request_ids) == {"r0"}
+
+
+def test_manager_drops_tokens_of_expired_requests(clock):
+    manager = StateManager(MemoryStateStore(ttl=60))
+    request_id = manager.generate_request_id()
+    assert manager.cancel_token(request_id) is not None
+    clock.now += 61
+    manager.store.prune()
+    manager._sync_tokens()
+    assert manager.cancel_token(request_id) is None
+
+
+def test_state_store_is_abstract():
+    class Incomplete(StateStore):
+        def create(self, request_id):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,85 @@
+import gzip
+import os
+
+import pytest
+
+from core.file import FileHandler
+from core.story_store import StoryStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return StoryStore(tmp_path / "stories", tmp_path / "index.sqlite3")
+
+
+def test_save_and_read(store):
+    story = store.save("从前有一只小熊。", "chinese", pdf_name="/tmp/bear.pdf", pdf_hash="p1",
+                       prompts_hash="h1", request_id="r1")
+    assert os.path.basename(story["path"]).startswith("bear_chinese_")
+    assert store.read(story["story_id"]) == "从前有一只小熊。"
+    assert store.find_by_path(story["path"])["story_id"] == story["story_id"]
+    assert [s["story_id"] for s in store.by_request("r1")] == [story["story_id"]]
+    assert not [name for name in os.listdir(os.path.dirname(story["path"])) if name.startswith(".tmp_")]
+
+
+def test_gzip_compression(tmp_path):
+    store = StoryStore(tmp_path / "stories", tmp_path / "index.sqlite3", compression="gzip")
+    story = store.save("小兔" * 100, "chinese")
+    assert story["path"].endswith(".txt.gz")
+    with open(story["path"], "rb") as f:
+        assert gzip.decompress(f.read()).decode("utf-8") == "小兔" * 100
+    assert store.read(story) == "小兔" * 100
+
+
+def test_same_book_links_versions(store):
+    first = store.save("故事一", "chinese", pdf_hash="p1", prompts_hash="h1")
+    second = store.save("故事二", "chinese", pdf_hash="p1", prompts_hash="h1")
+    other_prompts = store.save("故事三", "chinese", pdf_hash="p1", prompts_hash="h2")
+    unhashed = store.save("故事四", "chinese")
+    assert first["book_id"] == second["book_id"]
+    assert other_prompts["book_id"] != first["book_id"]
+    assert unhashed["book_id"] not in (first["book_id"], other_prompts["book_id"])
+    assert [s["story_id"] for s in store.versions(first["book_id"])] == [first["story_id"], second["story_id"]]
+    assert store.latest("p1", prompts_hash="h1")["story_id"] == second["story_id"]
+
+
+def test_translation_links_to_source_book(tmp_path, store):
+    handler = FileHandler(story_store=store)
+    chinese_path = handler.save_story("小熊醒了。", "chinese", "bear.pdf", pdf_hash="p1", prompts_hash="h1")
+    english_path = handler.save_story("The bear woke up.", "english", source="小熊醒了。")
+    chinese, english = store.find_by_path(chinese_path), store.find_by_path(english_path)
+    assert english["book_id"] == chinese["book_id"]
+    assert english["pdf_name"] == "bear.pdf"
+    assert {s["language"] for s in store.versions(chinese["book_id"])} == {"chinese", "english"}
+
+
+def test_list_pagination(store):
+    saved = [store.save(f"故事{i}", "chinese" if i % 2 else "english", pdf_hash=f"p{i % 3}")
+             for i in range(7)]
+    pages, cursor = [], None
+    while True:
+        items, cursor = store.list(limit=3, cursor=cursor)
+        pages.append([item["story_id"] for item in items])
+        if cursor is None:
+            break
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert sum(pages, []) == [story["story_id"] for story in reversed(saved)]
+
+    chinese, cursor = store.list(limit=10, language="chinese")
+    assert cursor is None
+    assert [item["story_id"] for item in chinese] == [s["story_id"] for s in reversed(saved) if s["language"] == "chinese"]
+    by_pdf, _ = store.list(pdf_hash="p0")
+    assert {item["pdf_hash"] for item in by_pdf} == {"p0"}
+
+
+def test_list_rejects_bad_cursor(store):
+    store.save("故事", "chinese")
+    with pytest.raises(ValueError):
+        store.list(cursor="not-a-cursor")
+
+
+def test_stats(store):
+    store.save("一", "chinese", pdf_hash="p1")
+    store.save("二", "english", pdf_hash="p1")
+    stats = store.stats()
+    assert stats["books"] == 1 and stats["stories"] == 2 and stats["bytes"] > 0
@@ -0,0 +1,98 @@
+import pytest
+
+import core.translate as translate
+from core.translate import ChunkedTranslator
+
+STORY = ("  \n小熊醒了。它推开门，看见外面下雪了！\n\n"
+         "“我们去玩吧！”小兔说。\n \t\n"
+         "它们在雪地里跑了一整天，直到太阳落山。小熊说：“明天还来。”\n  ")
+
+
+def _reassemble(paragraphs):
+    return "".join("".join(chunks) + separator for chunks, separator in paragraphs)
+
+
+@pytest.mark.parametrize("chunk_chars", [8, 20, 1000])
+def test_split_round_trip(chunk_chars):
+    paragraphs = ChunkedTranslator(chunk_chars=chunk_chars).split(STORY)
+    assert _reassemble(paragraphs) == STORY
+    for chunks, _ in paragraphs:
+        assert all(chunk.strip() for chunk in chunks)
+
+
+def test_split_whitespace_only():
+    translator = ChunkedTranslator()
+    for text in ["", "\n\n", " \n\t\n "]:
+        paragraphs = translator.split(text)
+        assert _reassemble(paragraphs) == text
+        assert all(not chunks for chunks, _ in paragraphs)
+
+
+def test_split_long_paragraph_at_sentence_boundaries():
+    paragraph = "小熊醒了。它推开门。外面下雪了！"
+    chunks = ChunkedTranslator(chunk_chars=8).split(paragraph)[0][0]
+    assert chunks == ["小熊醒了。", "它推开门。", "外面下雪了！"]
+
+
+def test_translate_keeps_order_and_separators(monkeypatch):
+    def fake_generate_story(text, system_prompt, user_prompt, stream=False):
+        if system_prompt == translate.Config.GLOSSARY_PROMPT:
+            return "无"
+        return f" <{text}> "
+
+    monkeypatch.setattr(translate, "generate_story", fake_generate_story)
+    translator = ChunkedTranslator(max_workers=4, chunk_chars=8)
+    result = translator.translate(STORY)
+
+    expected = []
+    for chunks, separator in translator.split(STORY):
+        expected.append(" ".join(f"<{chunk}>" for chunk in chunks))
+        expected.append(separator)
+    assert result == "".join(expected)
+    assert result.startswith("  \n<") and result.endswith("\n  ")
+
+
+class FakeModel:
+    """记录调用的模型：对照表请求按片段返回其中出现的人名，翻译请求返回带标记的原文"""
+
+    def __init__(self, glossary_error=False):
+        self.glossary_error = glossary_error
+        self.glossary_calls = []
+        self.translation_prompts = []
+
+    def __call__(self, text, system_prompt, user_prompt, stream=False):
+        if system_prompt == translate.Config.GLOSSARY_PROMPT:
+            self.glossary_calls.append(text)
+            if self.glossary_error:
+                raise ConnectionError("glossary request failed")
+            names = [f"{name} => {english}" for name, english in (("小熊", "Bear"), ("小兔", "Bunny"))
+                     if name in text]
+            return "\n".join(names) or "无"
+        self.translation_prompts.append(system_prompt)
+        return f"<{text}>"
+
+
+def test_glossary_failure_does_not_abort_translation(monkeypatch):
+    model = FakeModel(glossary_error=True)
+    monkeypatch.setattr(translate, "generate_story", model)
+    result = ChunkedTranslator(chunk_chars=8).translate(STORY)
+    assert "<小熊醒了。>" in result
+    assert all("人物名称对照表" not in prompt for prompt in model.translation_prompts)
+
+
+def test_glossary_is_merged_and_cached_per_chunk(monkeypatch, tmp_path):
+    model = FakeModel()
+    monkeypatch.setattr(translate, "generate_story", model)
+    translator = ChunkedTranslator(translate.TranslationCache(tmp_path / "cache.sqlite3", 10 ** 6))
+    translator.translate(STORY)
+    chunk_count = sum(len(chunks) for chunks, _ in translator.split(STORY))
+    assert len(model.glossary_calls) == chunk_count
+    # 同一名称只出现一次
+    assert model.translation_prompts[0].count("小熊 => Bear") == 1
+    assert "小兔 => Bunny" in model.translation_prompts[0]
+
+    # 只修改一个段落时只为该段落重新提取人名
+    model.glossary_calls.clear()
+    translator.translate(STORY.replace("直到太阳落山", "直到月亮升起"))
+    assert len(model.glossary_calls) == 1
+    assert "月亮" in model.glossary_calls[0]
@@ -1,2 +1,5 @@
-from .pdf_convert_image import pdf_convert_images, pdf_convert_page_to_image
-from .logger import log_story_generation, log_translation, log_error, log_api_call, get_log_contents,logger
\ No newline at end of file
+from .pdf_convert_image import ImagePolicy, get_render_pool, pdf_convert_images, pdf_convert_page_to_image, pdf_iter_page_images, pdf_page_count
+from .logger import log_story_generation, log_translation, log_error, log_api_call, get_log_contents, read_log, logger
+from .metrics import metrics, set_request_id, span, start_metrics_server
+from .cancel import CancelToken, Cancelled, cancellable_sleep, check_cancelled, current_cancel_token, set_cancel_token
+from .page_filter import PageFilter, page_fingerprint, pdf_page_fingerprint
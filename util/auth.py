@@ -0,0 +1,34 @@
+import hmac
+import ipaddress
+from typing import Optional
+
+
+def check_credentials(username: str, password: str, expected_username: str, expected_password: str) -> bool:
+    """比较登录账号和密码（常数时间比较，不因前缀匹配长度泄露信息）"""
+    username_ok = hmac.compare_digest(username.encode("utf-8"), expected_username.encode("utf-8"))
+    password_ok = hmac.compare_digest(password.encode("utf-8"), expected_password.encode("utf-8"))
+    return username_ok and password_ok
+
+
+def check_bearer_token(authorization: Optional[str], token: str) -> bool:
+    """
+    校验请求头 Authorization: Bearer <令牌>
+
+    token 为空时拒绝所有请求，未配置令牌的接口不会对外开放。
+    """
+    if not token or not authorization:
+        return False
+    scheme, _, value = authorization.partition(" ")
+    if scheme.lower() != "bearer":
+        return False
+    return hmac.compare_digest(value.strip().encode("utf-8"), token.encode("utf-8"))
+
+
+def is_loopback_host(host: str) -> bool:
+    """监听地址是否只接受本机连接"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
@@ -0,0 +1,95 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+
+class Cancelled(Exception):
+    """请求已被取消"""
+
+
+class CancelToken:
+    """
+    取消令牌：一个请求的所有步骤共享同一个令牌
+
+    cancel() 之后，正在等待的步骤（限流排队、重试退避）立即返回，正在进行的模型请求
+    通过注册的回调关闭连接。回调在调用 cancel() 的线程中执行。
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self.cancelled_at: Optional[float] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        """取消请求并执行所有已注册的回调（重复调用无效）"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.cancelled_at = time.monotonic()
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise Cancelled()
+
+    def wait(self, timeout: float) -> bool:
+        """等待至多 timeout 秒，期间被取消时提前返回 True"""
+        return self._event.wait(timeout)
+
+    @contextmanager
+    def on_cancel(self, callback: Callable[[], None]):
+        """在代码块执行期间注册取消回调；已取消时立即执行回调"""
+        with self._lock:
+            registered = not self._event.is_set()
+            if registered:
+                self._callbacks.append(callback)
+        if not registered:
+            callback()
+        try:
+            yield
+        finally:
+            if registered:
+                with self._lock:
+                    if callback in self._callbacks:
+                        self._callbacks.remove(callback)
+
+
+_cancel_token: contextvars.ContextVar = contextvars.ContextVar("cancel_token", default=None)
+
+
+def set_cancel_token(token: Optional[CancelToken]) -> None:
+    """为当前上下文绑定取消令牌，之后在该上下文（及复制它的线程）中发起的模型请求都可被取消"""
+    _cancel_token.set(token)
+
+
+def current_cancel_token() -> Optional[CancelToken]:
+    return _cancel_token.get()
+
+
+def check_cancelled() -> None:
+    """当前上下文的请求已被取消时抛出 Cancelled"""
+    token = _cancel_token.get()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def cancellable_sleep(seconds: float) -> None:
+    """等待 seconds 秒，当前上下文的请求被取消时立即抛出 Cancelled"""
+    token = _cancel_token.get()
+    if token is None:
+        time.sleep(seconds)
+    elif token.wait(seconds):
+        raise Cancelled()
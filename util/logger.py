@@ -1,23 +1,99 @@
+import atexit
+import contextvars
+import json
 import logging
 import os
-from datetime import datetime
-from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
+import queue
+import re
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import List, Optional, Tuple
 
-# 创建日志目录
-LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
-if not os.path.exists(LOG_DIR):
-    os.makedirs(LOG_DIR)
+# 日志目录（首次写入日志时才创建），可由环境变量 LOG_DIR 指定
+LOG_DIR = os.getenv("LOG_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
 
 # 日志文件路径
 LOG_FILE = os.path.join(LOG_DIR, 'story_generator.log')
 
+# 日志文件格式：text 为普通文本，json 为每行一个 JSON 对象（便于日志系统采集）
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# 日志队列长度，队列满时丢弃新记录而不阻塞请求线程
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+# 日志查看器每次向前读取的块大小，以及单次查看最多扫描的字节数
+TAIL_BLOCK_SIZE = 64 * 1024
+TAIL_MAX_SCAN_BYTES = 4 * 1024 * 1024
+
+# 当前请求ID，日志记录和计时记录默认带上它
+_request_id: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+
+
+def set_request_id(request_id: Optional[str]) -> None:
+    """设置当前上下文的请求ID，之后在该上下文（及复制出的线程上下文）中的日志和计时都带上此ID"""
+    _request_id.set(request_id)
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+class RequestIdFilter(logging.Filter):
+    """在产生日志的线程中为记录附加当前请求ID（写入由后台线程完成，届时已取不到上下文）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "request_id", None):
+            record.request_id = _request_id.get() or "-"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出为一行 JSON：time、level、name、request_id、message，异常时附带 exc_info"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "name": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class LazyRotatingFileHandler(RotatingFileHandler):
+    """首次写入时才创建日志目录和文件的轮转文件处理器"""
+
+    def __init__(self, filename: str, **kwargs):
+        super().__init__(filename, delay=True, **kwargs)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+class DroppingQueueHandler(QueueHandler):
+    """把记录放入队列后立即返回；队列已满时丢弃记录并计数，不阻塞请求线程"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
 # 创建logger实例
 logger = logging.getLogger('StoryGenerator')
 logger.setLevel(logging.DEBUG)
 
 # 日志格式
 formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    '%(asctime)s - %(name)s - %(levelname)s - %(request_id)s - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
@@ -27,18 +103,24 @@ console_handler.setLevel(logging.INFO)
 console_handler.setFormatter(formatter)
 
 # 文件处理器（按大小轮转，最大10MB，保留5个备份）
-file_handler = RotatingFileHandler(
+file_handler = LazyRotatingFileHandler(
     LOG_FILE,
     maxBytes=10*1024*1024,  # 10MB
     backupCount=5,
     encoding='utf-8'
 )
 file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(formatter)
+file_handler.setFormatter(JsonFormatter(datefmt='%Y-%m-%d %H:%M:%S') if LOG_FORMAT == "json" else formatter)
+
+# 请求线程只把记录放入队列，由后台监听线程写入控制台和文件
+queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+queue_handler.addFilter(RequestIdFilter())
+logger.addHandler(queue_handler)
 
-# 添加处理器到logger
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+log_listener = QueueListener(queue_handler.queue, console_handler, file_handler, respect_handler_level=True)
+log_listener.start()
+# 退出时写完队列中剩余的记录
+atexit.register(log_listener.stop)
 
 def log_story_generation(pdf_file, story_length, generation_time):
     """记录故事生成信息"""
@@ -62,16 +144,176 @@ def log_translation(source_length, target_length, translation_time):
 
 def log_api_call(api_name, status, response_time):
     """记录API调用信息"""
-    logger.debug(f"API call: {api_name}")
-    logger.debug(f"Status: {status}")
-    logger.debug(f"Response time: {response_time}ms")
+    logger.debug(f"API call: {api_name}, status: {status}, response time: {response_time}ms")
+
+
+# 文本格式记录的首行：时间 - 记录器名 - 级别 - 请求ID - 消息；旧格式没有请求ID一段。
+# 请求ID只匹配UUID或 "-"，旧格式消息中的 " - " 不会被误认为请求ID
+_RECORD_HEADER = re.compile(
+    r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(?:,\d{3})? - [^ ]+ - (?P<level>" + "|".join(LOG_LEVELS) + r") - "
+    r"(?:(?P<request_id>\S+) - )?"
+)
+
+
+def _record_header(line: str) -> Optional[Tuple[str, str]]:
+    """解析一条日志记录的首行，返回 (级别, 请求ID)；不是记录首行（如异常堆栈的后续行）时返回 None"""
+    if line.startswith("{"):
+        try:
+            data = json.loads(line)
+            return data.get("level", ""), data.get("request_id", "-")
+        except ValueError:
+            return None
+    match = _RECORD_HEADER.match(line)
+    if match is None:
+        return None
+    # 旧格式的记录没有请求ID
+    return match.group("level"), match.group("request_id") or "-"
+
+
+def _record_matches(header: Tuple[str, str], request_id: Optional[str], level: Optional[str]) -> bool:
+    record_level, record_request_id = header
+    if request_id and record_request_id != request_id:
+        return False
+    if level and level in LOG_LEVELS:
+        return record_level in LOG_LEVELS and LOG_LEVELS.index(record_level) >= LOG_LEVELS.index(level)
+    return True
+
+
+def _iter_lines_reverse(path: str, end: int, max_bytes: int):
+    """从 end 位置开始按块向前读取文件，从后往前逐行产出，最多扫描 max_bytes 字节"""
+    with open(path, "rb") as f:
+        position = end
+        remainder = b""
+        scanned = 0
+        while position > 0 and scanned < max_bytes:
+            size = min(TAIL_BLOCK_SIZE, position)
+            position -= size
+            scanned += size
+            f.seek(position)
+            lines = (f.read(size) + remainder).split(b"\n")
+            # 块的第一行可能不完整，留到读取前一块时拼接
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                yield line.decode("utf-8", errors="replace")
+        if position == 0 and remainder:
+            yield remainder.decode("utf-8", errors="replace")
+
+
+def _complete_end(path: str, size: int) -> int:
+    """返回文件中最后一个换行符之后的位置；末尾未写完的行不计入"""
+    with open(path, "rb") as f:
+        position = size
+        while position > 0 and size - position < TAIL_MAX_SCAN_BYTES:
+            block = min(TAIL_BLOCK_SIZE, position)
+            position -= block
+            f.seek(position)
+            index = f.read(block).rfind(b"\n")
+            if index >= 0:
+                return position + index + 1
+    return 0
+
+
+def _tail_records(path: str, size: int, num_lines: int, request_id: Optional[str],
+                  level: Optional[str]) -> List[str]:
+    """从文件末尾向前收集最近 num_lines 条匹配的记录（多行记录保持完整）"""
+    records: List[str] = []
+    continuation: List[str] = []
+    for line in _iter_lines_reverse(path, size, TAIL_MAX_SCAN_BYTES):
+        if not line:
+            continue
+        header = _record_header(line)
+        if header is None:
+            continuation.append(line)
+            continue
+        if _record_matches(header, request_id, level):
+            records.append("\n".join([line] + continuation[::-1]))
+            if len(records) >= num_lines:
+                break
+        continuation = []
+    return records[::-1]
+
+
+def _records_from(path: str, offset: int, end: int, request_id: Optional[str],
+                  level: Optional[str]) -> Tuple[List[str], int]:
+    """读取 offset 之后新增的完整行并按记录过滤，返回 (记录列表, 已读到的位置)"""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(end - offset)
+    # 只处理到最后一个换行符，未写完的行留到下次读取
+    complete = data.rfind(b"\n") + 1
+    records: List[str] = []
+    matched = False
+    for line in data[:complete].decode("utf-8", errors="replace").split("\n"):
+        if not line:
+            continue
+        header = _record_header(line)
+        if header is None:
+            if matched:
+                records[-1] += "\n" + line
+            continue
+        matched = _record_matches(header, request_id, level)
+        if matched:
+            records.append(line)
+    return records, offset + complete
+
+
+def read_log(num_lines: int = 100, offset: Optional[Tuple[int, int]] = None, request_id: Optional[str] = None,
+             level: Optional[str] = None, path: str = LOG_FILE) -> Tuple[str, Optional[Tuple[int, int]]]:
+    """
+    读取日志，不加载整个文件
+
+    offset 为 None 时从文件末尾向前读取最近 num_lines 条匹配的记录；否则只读取 offset 之后
+    新增的记录，用于增量刷新。文件在两次读取之间被轮转时先读完轮转出的文件（path.1）的剩余部分，
+    再读新文件；找不到原文件、文件被截短或新增内容过多时退回读取末尾。末尾未写完的行留到下次读取。
+
+    Args:
+        num_lines: 最多返回的记录条数
+        offset: 上次读取返回的位置
+        request_id: 只返回该请求ID的记录
+        level: 只返回不低于该级别的记录
+        path: 日志文件路径
+
+    Returns:
+        Tuple[str, Optional[Tuple[int, int]]]: (日志文本, 下次增量读取的位置，即 (文件标识, 偏移)；
+        日志文件不存在时为 None)
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return "", None
+    end = _complete_end(path, stat.st_size)
+    records = None
+    if offset is not None:
+        inode, position = offset
+        if inode == stat.st_ino:
+            if position <= end and end - position <= TAIL_MAX_SCAN_BYTES:
+                records = _records_from(path, position, end, request_id, level)[0]
+        else:
+            records = _records_after_rotation(path, inode, position, end, request_id, level)
+    if records is None:
+        records = _tail_records(path, end, num_lines, request_id, level)
+    records = records[-num_lines:]
+    return "\n".join(records) + ("\n" if records else ""), (stat.st_ino, end)
+
+
+def _records_after_rotation(path: str, inode: int, position: int, end: int, request_id: Optional[str],
+                            level: Optional[str]) -> Optional[List[str]]:
+    """上次读取的文件已轮转为 path.1 时，读取其 position 之后的记录和新文件 end 之前的记录"""
+    rotated = f"{path}.1"
+    try:
+        stat = os.stat(rotated)
+    except OSError:
+        return None
+    if stat.st_ino != inode or position > stat.st_size or stat.st_size - position + end > TAIL_MAX_SCAN_BYTES:
+        return None
+    return (_records_from(rotated, position, stat.st_size, request_id, level)[0]
+            + _records_from(path, 0, end, request_id, level)[0])
+
 
 def get_log_contents(num_lines=100):
     """获取最近的日志内容"""
     try:
-        with open(LOG_FILE, 'r', encoding='utf-8') as f:
-            lines = f.readlines()[-num_lines:]
-        return ''.join(lines)
+        return read_log(num_lines)[0]
     except Exception as e:
         logger.error(f"Error reading log file: {str(e)}")
-        return "无法读取日志文件" 
\ No newline at end of file
+        return "无法读取日志文件"
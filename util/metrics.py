@@ -0,0 +1,248 @@
+import bisect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from .logger import current_request_id, log_api_call, logger, set_request_id
+
+# 延迟直方图的桶上限（秒），最后一个桶为 +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# 界面中可查看的最近耗时记录条数
+RECENT_SPANS = 2000
+
+class Histogram:
+    """固定桶的延迟直方图（调用方负责加锁）"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """按桶估计分位数（桶内线性插值，不超过实际最大值）"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= target and count:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(self.max, lower + (upper - lower) * (target - cumulative) / count)
+            cumulative += count
+        return self.max
+
+
+class MetricsRegistry:
+    """
+    进程内的耗时和 token 统计：按阶段汇总的延迟直方图、按模型的 token 计数、
+    取消请求节省的工作量、预筛选跳过的页面和最近的耗时记录
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms: Dict[str, Histogram] = {}
+        self.errors: Dict[str, int] = {}
+        self.tokens: Dict[tuple, int] = {}
+        self.cancellations: Dict[str, float] = {}
+        self.filtered_pages: Dict[str, int] = {}
+        self.recent = deque(maxlen=RECENT_SPANS)
+
+    def observe(self, stage: str, seconds: float, request_id: Optional[str] = None,
+                error: bool = False, **attrs) -> None:
+        """记录一次阶段耗时"""
+        with self._lock:
+            self.histograms.setdefault(stage, Histogram()).observe(seconds)
+            if error:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+            self.recent.append(dict(stage=stage, request_id=request_id, seconds=round(seconds, 4),
+                                    error=error, time=time.time(), **attrs))
+
+    def add_tokens(self, model: str, prompt_tokens: int, completion_tokens: int) -> None:
+        """累计模型的 token 用量"""
+        with self._lock:
+            for kind, value in (("prompt", prompt_tokens), ("completion", completion_tokens)):
+                key = (model or "unknown", kind)
+                self.tokens[key] = self.tokens.get(key, 0) + (value or 0)
+
+    def add_cancellation(self, **amounts: float) -> None:
+        """
+        累计取消请求的统计
+
+        Args:
+            requests: 被取消的请求数
+            aborted_llm_calls: 被中途关闭的模型请求数
+            aborted_call_seconds: 被关闭的模型请求已经进行的时间（秒）
+            pages_skipped: 因取消不再识别的页面数
+            saved_seconds: 估计节省的模型调用时间（秒）
+        """
+        with self._lock:
+            for kind, value in amounts.items():
+                self.cancellations[kind] = self.cancellations.get(kind, 0) + (value or 0)
+
+    def add_filtered_pages(self, **counts: int) -> None:
+        """累计页面预筛选跳过的页面数（blank: 空白页，duplicate: 复用描述的重复页）"""
+        with self._lock:
+            for reason, count in counts.items():
+                self.filtered_pages[reason] = self.filtered_pages.get(reason, 0) + count
+
+    def stage_mean(self, stage: str) -> Optional[float]:
+        """阶段的平均耗时（秒），还没有记录时返回 None"""
+        with self._lock:
+            hist = self.histograms.get(stage)
+            return hist.sum / hist.count if hist is not None and hist.count else None
+
+    def summary(self) -> List[Dict]:
+        """按阶段汇总：次数、错误数、平均、p50、p95、最大耗时（秒）"""
+        with self._lock:
+            return [
+                {
+                    "stage": stage,
+                    "count": hist.count,
+                    "errors": self.errors.get(stage, 0),
+                    "avg_s": round(hist.sum / hist.count, 4) if hist.count else 0.0,
+                    "p50_s": round(hist.quantile(0.5), 4),
+                    "p95_s": round(hist.quantile(0.95), 4),
+                    "max_s": round(hist.max, 4),
+                }
+                for stage, hist in sorted(self.histograms.items())
+            ]
+
+    def token_totals(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            totals: Dict[str, Dict[str, int]] = {}
+            for (model, kind), value in self.tokens.items():
+                totals.setdefault(model, {})[kind] = value
+            return totals
+
+    def cancellation_totals(self) -> Dict[str, float]:
+        with self._lock:
+            return {kind: round(value, 3) for kind, value in sorted(self.cancellations.items())}
+
+    def filtered_page_totals(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(sorted(self.filtered_pages.items()))
+
+    def spans(self, request_id: Optional[str] = None, limit: int = 200) -> List[Dict]:
+        """最近的耗时记录，可按请求ID过滤，最新的在前"""
+        with self._lock:
+            spans = [span for span in self.recent if request_id is None or span["request_id"] == request_id]
+        return spans[::-1][:limit]
+
+    def render_prometheus(self) -> str:
+        """导出 Prometheus 文本格式"""
+        lines = [
+            "# HELP story_stage_duration_seconds Duration of pipeline stages.",
+            "# TYPE story_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage, hist in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(BUCKETS) + ["+Inf"], hist.counts):
+                    cumulative += count
+                    lines.append(f'story_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'story_stage_duration_seconds_sum{{stage="{stage}"}} {hist.sum}')
+                lines.append(f'story_stage_duration_seconds_count{{stage="{stage}"}} {hist.count}')
+            lines += ["# HELP story_stage_errors_total Failed pipeline stages.",
+                      "# TYPE story_stage_errors_total counter"]
+            for stage, count in sorted(self.errors.items()):
+                lines.append(f'story_stage_errors_total{{stage="{stage}"}} {count}')
+            lines += ["# HELP story_llm_tokens_total Tokens reported in model responses.",
+                      "# TYPE story_llm_tokens_total counter"]
+            for (model, kind), value in sorted(self.tokens.items()):
+                lines.append(f'story_llm_tokens_total{{model="{model}",type="{kind}"}} {value}')
+            lines += ["# HELP story_cancellation_total Work aborted or avoided by cancelled requests.",
+                      "# TYPE story_cancellation_total counter"]
+            for kind, value in sorted(self.cancellations.items()):
+                lines.append(f'story_cancellation_total{{kind="{kind}"}} {value}')
+            lines += ["# HELP story_pages_filtered_total Pages not sent to the vision model by the page pre-filter.",
+                      "# TYPE story_pages_filtered_total counter"]
+            for reason, count in sorted(self.filtered_pages.items()):
+                lines.append(f'story_pages_filtered_total{{reason="{reason}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+@contextmanager
+def span(stage: str, request_id: Optional[str] = None, api_name: Optional[str] = None, **attrs):
+    """
+    记录代码块的耗时
+
+    请求ID默认取当前上下文中的请求ID。代码块内可以向产出的字典中补充属性（如 token 数），
+    一并保存在最近的耗时记录中。指定 api_name 时同时写入API调用日志。
+
+    Example:
+        with span("vl_request", page=3) as s:
+            ...
+            s["prompt_tokens"] = usage.prompt_tokens
+    """
+    request_id = request_id or current_request_id()
+    start = time.perf_counter()
+    error = False
+    try:
+        yield attrs
+    except Exception:
+        error = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe(stage, seconds, request_id, error, **attrs)
+        if api_name:
+            log_api_call(api_name, "error" if error else "ok", round(seconds * 1000))
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1", token: str = ""):
+    """
+    在后台线程中启动 /metrics 接口（Prometheus 文本格式）
+
+    Args:
+        port: 监听端口
+        host: 监听地址，默认只在本机监听
+        token: 访问令牌，设置后请求需带上 Authorization: Bearer <令牌>
+
+    Raises:
+        ValueError: 没有设置令牌却监听非本机地址
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    from .auth import check_bearer_token, is_loopback_host
+
+    if not token and not is_loopback_host(host):
+        raise ValueError(f"/metrics 接口监听 {host} 时必须设置访问令牌")
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            if token and not check_bearer_token(self.headers.get("Authorization"), token):
+                self.send_response(401)
+                self.send_header("WWW-Authenticate", "Bearer")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Metrics endpoint: http://{host}:{port}/metrics")
+    return server
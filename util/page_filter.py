@@ -0,0 +1,133 @@
+import io
+from typing import List, Optional, Tuple, Union
+
+# 感知哈希：页面缩小为 PHASH_IMAGE_SIZE 见方的灰度图，取DCT左上角 PHASH_SIZE x PHASH_SIZE 的低频系数
+PHASH_IMAGE_SIZE = 32
+PHASH_SIZE = 8
+# 计算墨迹覆盖率的缩略图最长边（像素）
+INK_IMAGE_SIZE = 128
+# 与页面背景（灰度中位数）相差超过该值的像素计为墨迹，纸张底色和扫描噪点不计入
+INK_THRESHOLD = 32
+
+_dct_matrix = None
+
+
+def _dct() -> "numpy.ndarray":
+    """PHASH_IMAGE_SIZE 阶的 DCT-II 变换矩阵，二维DCT为 C @ X @ C.T"""
+    global _dct_matrix
+    if _dct_matrix is None:
+        import numpy as np
+        n = PHASH_IMAGE_SIZE
+        k = np.arange(n)[:, None]
+        _dct_matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)).astype(np.float32)
+    return _dct_matrix
+
+
+def page_fingerprint(image: Union[str, bytes]) -> Tuple[int, float]:
+    """
+    计算页面图片的64位感知哈希和墨迹覆盖率
+
+    在低分辨率灰度图上计算：JPEG 解码时直接按比例缩小（draft），其他格式解码后缩小。
+    能拿到PDF页面时使用 pdf_page_fingerprint，不必解码渲染好的整页图片。
+
+    Args:
+        image: 页面图片路径或编码后的图片字节
+
+    Returns:
+        Tuple[int, float]: (感知哈希, 墨迹覆盖率 0-1)
+    """
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as img:
+        img.draft("L", (INK_IMAGE_SIZE, INK_IMAGE_SIZE))
+        gray = img.convert("L")
+    gray.thumbnail((INK_IMAGE_SIZE, INK_IMAGE_SIZE), Image.BOX)
+    return _fingerprint(np.asarray(gray))
+
+
+def pdf_page_fingerprint(page) -> Tuple[int, float]:
+    """
+    直接以低分辨率（最长边 INK_IMAGE_SIZE 像素）把PDF页面渲染为灰度图并计算指纹，结果同 page_fingerprint
+
+    Args:
+        page: PyMuPDF 页面对象
+    """
+    import fitz
+    import numpy as np
+
+    zoom = INK_IMAGE_SIZE / max(page.rect.width, page.rect.height, 1)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    pixels = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+    return _fingerprint(pixels)
+
+
+def _fingerprint(pixels: "numpy.ndarray") -> Tuple[int, float]:
+    """由缩小后的灰度像素计算 (感知哈希, 墨迹覆盖率)"""
+    import numpy as np
+    from PIL import Image
+
+    ink = float(np.mean(np.abs(pixels.astype(np.int16) - np.median(pixels)) > INK_THRESHOLD))
+
+    gray = Image.fromarray(np.ascontiguousarray(pixels, dtype=np.uint8), "L")
+    small = np.asarray(gray.resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.BOX), dtype=np.float32)
+    dct = _dct()
+    low = (dct @ small @ dct.T)[:PHASH_SIZE, :PHASH_SIZE].ravel()
+    # 直流分量只反映整体亮度，不参与中位数
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big"), ink
+
+
+class PageFilter:
+    """
+    页面预筛选：在调用视觉模型前识别空白页和与之前页面近似重复的页面
+
+    空白页（墨迹覆盖率低于阈值，如环衬、空白页）不需要描述；重复页（如重复的跨页、
+    重复扫描的页面）与之前某页的感知哈希汉明距离不超过阈值且墨迹覆盖率接近时，
+    复用那一页的描述。与所有已见页面的比较一次完成（numpy 按位异或后统计位数）。
+    """
+
+    def __init__(self, max_distance: int = 4, blank_ink_ratio: float = 0.002, max_ink_delta: float = 0.01):
+        """
+        Args:
+            max_distance: 视为重复页面的最大汉明距离（64位感知哈希）
+            blank_ink_ratio: 墨迹覆盖率低于该值的页面视为空白页
+            max_ink_delta: 视为重复页面时墨迹覆盖率的最大差异，避免只有文字不同的页面被合并
+        """
+        import numpy as np
+        self.max_distance = max_distance
+        self.blank_ink_ratio = blank_ink_ratio
+        self.max_ink_delta = max_ink_delta
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._inks = np.empty(0, dtype=np.float32)
+        self._pages: List[int] = []
+
+    def check(self, index: int, image: Union[str, bytes]) -> Tuple[str, Optional[int]]:
+        """
+        检查页面并记录其指纹
+
+        Returns:
+            Tuple[str, Optional[int]]: ('blank', None)、('duplicate', 原页面的页码索引) 或 ('unique', None)
+        """
+        return self.classify(index, *page_fingerprint(image))
+
+    def add(self, index: int, phash: int, ink: float) -> None:
+        """记录一个已知页面的指纹（如断点中已识别的页面），之后与之重复的页面可复用其描述"""
+        import numpy as np
+        self._hashes = np.append(self._hashes, np.uint64(phash))
+        self._inks = np.append(self._inks, np.float32(ink))
+        self._pages.append(index)
+
+    def classify(self, index: int, phash: int, ink: float) -> Tuple[str, Optional[int]]:
+        """按已计算的指纹（见 page_fingerprint）检查页面，不重复的页面记录其指纹，返回值同 check"""
+        import numpy as np
+        if ink < self.blank_ink_ratio:
+            return "blank", None
+        if self._pages:
+            distances = np.unpackbits((self._hashes ^ np.uint64(phash)).view(np.uint8)).reshape(-1, 64).sum(axis=1)
+            distances[np.abs(self._inks - ink) > self.max_ink_delta] = 64
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= self.max_distance:
+                return "duplicate", self._pages[nearest]
+        self.add(index, phash, ink)
+        return "unique", None
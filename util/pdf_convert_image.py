@@ -1,11 +1,208 @@
+import contextvars
+import io
+import queue
+import threading
 import time
+from collections import deque
+from contextlib import closing
 from datetime import datetime
-import fitz
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
 import os
 
+from .cancel import CancelToken, current_cancel_token
+from .logger import current_request_id, logger
+from .metrics import metrics, span
+from .page_filter import pdf_page_fingerprint
+
+# PyMuPDF (fitz) 在首次使用时才导入，避免拖慢不处理PDF的进程启动
+
+# 通义千问视觉模型约每 28x28 像素计为一个图片 token
+VL_TOKEN_PATCH = 28
+
+
+class ImagePolicy:
+    """页面图片渲染策略：缩放比例、最大尺寸或 token 预算、输出格式和质量"""
+
+    FORMATS = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+    def __init__(self, format: str = "png", quality: int = 85, zoom: float = 2.0,
+                 max_dimension: Optional[int] = None, max_tokens: Optional[int] = None):
+        """
+        Args:
+            format: 输出格式 ('png', 'jpeg' 或 'webp')
+            quality: JPEG/WebP 的压缩质量 (1-100)，PNG 忽略此参数
+            zoom: 相对PDF页面尺寸的默认缩放比例
+            max_dimension: 渲染结果最长边的像素上限，超出时自动缩小
+            max_tokens: 单页图片 token 预算，超出时自动缩小
+        """
+        format = format.lower().replace("jpg", "jpeg")
+        if format not in self.FORMATS:
+            raise ValueError(f"Unsupported image format: {format}")
+        self.format = format
+        self.quality = quality
+        self.zoom = zoom
+        self.max_dimension = max_dimension
+        self.max_tokens = max_tokens
+
+    @classmethod
+    def from_config(cls, options: Optional[dict]) -> "ImagePolicy":
+        """根据配置字典创建策略，None 表示默认策略"""
+        return cls(**(options or {}))
+
+    @property
+    def mime_type(self) -> str:
+        return self.FORMATS[self.format]
+
+    @property
+    def extension(self) -> str:
+        return "jpg" if self.format == "jpeg" else self.format
+
+    def zoom_for(self, rect) -> float:
+        """计算页面实际使用的缩放比例，保证结果不超过尺寸和 token 上限"""
+        zoom = self.zoom
+        width, height = rect.width, rect.height
+        if self.max_dimension:
+            zoom = min(zoom, self.max_dimension / max(width, height))
+        if self.max_tokens:
+            max_pixels = self.max_tokens * VL_TOKEN_PATCH * VL_TOKEN_PATCH
+            zoom = min(zoom, (max_pixels / (width * height)) ** 0.5)
+        return zoom
+
+    def render(self, page) -> bytes:
+        """按策略渲染单个PDF页面，返回编码后的图片字节"""
+        with span("pdf_render", page=page.number + 1, format=self.format) as attrs:
+            data = self.encode(page)
+            attrs["bytes"] = len(data)
+            return data
+
+    def encode(self, page) -> bytes:
+        """渲染并编码单个页面，不记录耗时（供渲染进程使用，耗时由主进程记录）"""
+        import fitz
+        zoom = self.zoom_for(page.rect)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        logger.debug(f"处理第 {page.number + 1} 页: {pix.width}x{pix.height} ({self.format})")
+        if self.format == "png":
+            return pix.tobytes("png")
+        if self.format == "jpeg":
+            return pix.tobytes("jpeg", jpg_quality=self.quality)
+        # PyMuPDF 不支持 WebP 编码，交给 Pillow 处理
+        from PIL import Image
+        image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+        buffer = io.BytesIO()
+        image.save(buffer, "WEBP", quality=self.quality)
+        return buffer.getvalue()
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def get_render_pool(processes: int):
+    """
+    返回进程内共享的页面渲染进程池，首次调用时按 processes 创建
+
+    所有请求共用同一个进程池，同时处理多本书时渲染进程总数仍为 processes，不会超额占用CPU。
+    子进程以 spawn 方式启动：fork 会把日志监听线程、连接池等线程状态复制到子进程中，
+    而它们在子进程里并不运行（例如日志队列不会再被写出）。
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _render_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        return _render_pool
+
+
+def _render_page_range(pdf_file: str, page_numbers: List[int], image_policy: ImagePolicy,
+                       fingerprint: bool = False) -> List[Tuple[int, bytes, float, Optional[Tuple[int, float]]]]:
+    """在渲染进程中执行：打开自己的文档句柄，渲染一段页面，返回 (页码索引, 图片字节, 耗时, 页面指纹)"""
+    import fitz
+    results = []
+    with fitz.open(pdf_file) as pdf_document:
+        for page_num in page_numbers:
+            start = time.perf_counter()
+            page = pdf_document[page_num]
+            image_bytes = image_policy.encode(page)
+            seconds = time.perf_counter() - start
+            results.append((page_num, image_bytes, seconds, _page_fingerprint(page) if fingerprint else None))
+    return results
+
+
+def _page_fingerprint(page) -> Optional[Tuple[int, float]]:
+    """计算页面指纹，失败时返回 None（由预筛选按渲染好的图片重新计算）"""
+    try:
+        return pdf_page_fingerprint(page)
+    except Exception as e:
+        logger.warning(f"计算第 {page.number + 1} 页的指纹失败: {e}")
+        return None
+
+
+def _render_pages(pdf_file: str, page_numbers: Optional[List[int]], image_policy: ImagePolicy,
+                  processes: int = 0, chunk_pages: int = 4, max_pages: int = 2,
+                  cancel: Optional[CancelToken] = None,
+                  fingerprints: Optional[Dict[int, Tuple[int, float]]] = None) -> Iterator[Tuple[int, bytes]]:
+    """
+    按页码顺序产出 (页码索引, 图片字节)
+
+    processes 大于1时把页面按每段 chunk_pages 页（第一段为1页）分给共享进程池；同一请求已提交
+    但尚未产出的页面（含进程池中正在渲染的页面）不超过 max_pages 页，也不超过 processes 段，
+    内存占用不随进程数增长，其余请求的页面可以穿插执行。否则在当前线程中逐页渲染。
+    请求被取消时不再提交新的页面段，尚未开始的页面段随之撤销。
+    传入 fingerprints 时同时按低分辨率渲染计算页面指纹，在产出该页之前写入 fingerprints[页码索引]。
+    """
+    import fitz
+    if processes <= 1:
+        with fitz.open(pdf_file) as pdf_document:
+            numbers = page_numbers if page_numbers is not None else range(pdf_document.page_count)
+            for page_num in numbers:
+                if cancel is not None and cancel.cancelled:
+                    return
+                page = pdf_document[page_num]
+                image_bytes = image_policy.render(page)
+                if fingerprints is not None:
+                    fingerprint = _page_fingerprint(page)
+                    if fingerprint is not None:
+                        fingerprints[page_num] = fingerprint
+                yield page_num, image_bytes
+        return
+
+    if page_numbers is None:
+        page_numbers = list(range(pdf_page_count(pdf_file)))
+    # 第一段只含一页，首页不必等整段渲染完成即可产出
+    max_pages = max(1, max_pages)
+    chunk_pages = max(1, min(chunk_pages, max_pages))
+    max_chunks = max(1, min(processes, max_pages // chunk_pages))
+    chunks = page_numbers[:1] and [page_numbers[:1]]
+    chunks += [page_numbers[i:i + chunk_pages] for i in range(1, len(page_numbers), chunk_pages)]
+    pool = get_render_pool(processes)
+    request_id = current_request_id()
+    pending: deque = deque()
+    try:
+        next_chunk = 0
+        while next_chunk < len(chunks) or pending:
+            while next_chunk < len(chunks) and len(pending) < max_chunks:
+                if cancel is not None and cancel.cancelled:
+                    return
+                pending.append(pool.submit(_render_page_range, pdf_file, chunks[next_chunk], image_policy,
+                                           fingerprints is not None))
+                next_chunk += 1
+            for page_num, image_bytes, seconds, fingerprint in pending.popleft().result():
+                if cancel is not None and cancel.cancelled:
+                    return
+                metrics.observe("pdf_render", seconds, request_id, page=page_num + 1, format=image_policy.format,
+                                bytes=len(image_bytes), process=True)
+                if fingerprints is not None and fingerprint is not None:
+                    fingerprints[page_num] = fingerprint
+                yield page_num, image_bytes
+    finally:
+        for future in pending:
+            future.cancel()
 
 
 def pdf_convert_images(pdf_file: str, dst_images_dir: str = "../images")  -> list[str]:
+    import fitz
 
     file_name_prefix = os.path.splitext(os.path.basename(pdf_file))[0]
 
@@ -13,7 +210,7 @@ def pdf_convert_images(pdf_file: str, dst_images_dir: str = "../images")  -> lis
     dst_dir = f"{dst_images_dir}/{file_name_prefix}-{datetime.now().now()}"
     if not os.path.exists(dst_dir):
         os.makedirs(dst_dir)
-    print(f"create dir {dst_dir}.")
+    logger.debug(f"创建目录 {dst_dir}")
 
     images_name= []
     for current_page in range(pdf_document.page_count):
@@ -26,7 +223,7 @@ def pdf_convert_images(pdf_file: str, dst_images_dir: str = "../images")  -> lis
                 pix_gray = fitz.Pixmap(fitz.csRGB, pix)
 
             image_path = f"{dst_dir}/page{current_page}-{img_index}.png"
-            print(f"Processing page {current_page}, image {img_index}: {pix.width}x{pix.height}")
+            logger.debug(f"处理第 {current_page} 页的第 {img_index} 张图片: {pix.width}x{pix.height}")
             pix_gray.save(image_path, jpg_quality=85)  # 注意：jpg_quality参数对于PNG格式不起作用
 
             images_name.append(image_path)
@@ -36,41 +233,141 @@ def pdf_convert_images(pdf_file: str, dst_images_dir: str = "../images")  -> lis
             pix = None
     return images_name
 
-def pdf_convert_page_to_image(pdf_file: str, dst_images_dir: str = "../images") -> list[str]:
+def pdf_convert_page_to_image(pdf_file: str, dst_images_dir: str = "../images",
+                              image_policy: Optional[ImagePolicy] = None,
+                              processes: int = 0, chunk_pages: int = 4) -> list[str]:
     """
     将PDF文件的每一页转换为单独的图片
     Args:
         pdf_file: PDF文件路径
         dst_images_dir: 输出图片目录
+        image_policy: 页面图片渲染策略，默认按2倍缩放输出PNG
+        processes: 大于1时使用共享渲染进程池（见 get_render_pool）并行渲染
+        chunk_pages: 并行渲染时每个任务渲染的连续页数
     Returns:
         list[str]: 生成的图片路径列表
     """
+    image_policy = image_policy or ImagePolicy()
     file_name_prefix = os.path.splitext(os.path.basename(pdf_file))[0]
-    
-    pdf_document = fitz.open(pdf_file)
+
     dst_dir = f"{dst_images_dir}/{file_name_prefix}-{datetime.now().strftime('%Y%m%d_%H%M%S')}"
     if not os.path.exists(dst_dir):
         os.makedirs(dst_dir)
-    print(f"创建目录 {dst_dir}")
+    logger.debug(f"创建目录 {dst_dir}")
 
     images_name = []
-    for page_num in range(pdf_document.page_count):
-        page = pdf_document[page_num]
-        # 设置缩放比例，可以根据需要调整
-        zoom = 2
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat)
-        
-        image_path = f"{dst_dir}/page_{page_num + 1}.png"
-        print(f"处理第 {page_num + 1} 页: {pix.width}x{pix.height}")
-        pix.save(image_path)
-        
+    for page_num, image_bytes in _render_pages(pdf_file, None, image_policy, processes, chunk_pages):
+        image_path = f"{dst_dir}/page_{page_num + 1}.{image_policy.extension}"
+        with open(image_path, "wb") as f:
+            f.write(image_bytes)
         images_name.append(image_path)
-        pix = None  # 释放资源
-    
-    pdf_document.close()
+
     return images_name
 
+def pdf_page_count(pdf_file: str) -> int:
+    """返回PDF文件的页数"""
+    import fitz
+    with fitz.open(pdf_file) as pdf_document:
+        return pdf_document.page_count
+
+
+def pdf_iter_page_images(pdf_file: str, dst_images_dir: Optional[str] = "../images",
+                         prefetch: int = 2, in_memory: bool = False,
+                         image_policy: Optional[ImagePolicy] = None,
+                         page_numbers: Optional[Iterable[int]] = None,
+                         processes: int = 0, chunk_pages: int = 4,
+                         fingerprints: Optional[Dict[int, Tuple[int, float]]] = None) -> Iterator[Union[str, bytes]]:
+    """
+    流式地将PDF的每一页转换为图片
+
+    后台线程逐页渲染并放入有界队列，调用方处理第N页时第N+1页已在渲染，
+    首页可用时间只取决于单页渲染耗时。调用方提前结束迭代（break或close）时
+    后台线程会随之停止。
+
+    Args:
+        pdf_file: PDF文件路径
+        dst_images_dir: 输出图片目录；in_memory 为 True 时可为 None，表示不落盘
+        prefetch: 最多预先渲染的页数，同时也是内存中最多缓存的页数
+        in_memory: 为 True 时直接产出编码后的图片字节，不再从磁盘读回
+        image_policy: 页面图片渲染策略，默认按2倍缩放输出PNG
+        page_numbers: 只渲染这些页（从0开始的页码索引，按给定顺序），None 表示全部页面
+        processes: 大于1时由共享渲染进程池（见 get_render_pool）并行渲染，结果仍按页码顺序产出；
+            同时在渲染的页面计入 prefetch，prefetch 小于进程数时单个请求用不满所有渲染进程
+        chunk_pages: 并行渲染时每个任务渲染的连续页数（每个任务打开一次文档）
+        fingerprints: 传入字典时渲染线程（或渲染进程）同时以低分辨率渲染页面并计算页面指纹（见
+            util.page_filter.pdf_page_fingerprint），在产出该页之前写入 fingerprints[页码索引]，
+            预筛选不必再解码整页图片
+
+    Yields:
+        Union[str, bytes]: 按页码顺序生成的图片路径，或 in_memory 时的图片字节
+    """
+    image_policy = image_policy or ImagePolicy()
+    page_numbers = list(page_numbers) if page_numbers is not None else None
+    dst_dir = None
+    if dst_images_dir is not None:
+        file_name_prefix = os.path.splitext(os.path.basename(pdf_file))[0]
+        dst_dir = f"{dst_images_dir}/{file_name_prefix}-{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        if not os.path.exists(dst_dir):
+            os.makedirs(dst_dir)
+        logger.debug(f"创建目录 {dst_dir}")
+    elif not in_memory:
+        raise ValueError("dst_images_dir is required unless in_memory is True")
+
+    # 并行渲染时已渲染未产出的页面由 _render_pages 按 prefetch 限制，队列只做交接
+    pages: queue.Queue = queue.Queue(maxsize=1 if processes > 1 else max(1, prefetch))
+    stop_event = threading.Event()
+    done = object()
+
+    def _put(item) -> bool:
+        # 队列满时定期检查停止标志，避免调用方退出后渲染线程永久阻塞
+        while not stop_event.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _render() -> None:
+        # 请求被取消时不再渲染剩余页面，迭代随之结束
+        cancel = current_cancel_token()
+        try:
+            rendered = _render_pages(pdf_file, page_numbers, image_policy, processes, chunk_pages, prefetch, cancel,
+                                     fingerprints)
+            with closing(rendered):
+                for page_num, image_bytes in rendered:
+                    if stop_event.is_set():
+                        return
+                    item = image_bytes
+                    if dst_dir is not None:
+                        image_path = f"{dst_dir}/page_{page_num + 1}.{image_policy.extension}"
+                        with open(image_path, "wb") as f:
+                            f.write(image_bytes)
+                        if not in_memory:
+                            item = image_path
+                    image_bytes = None
+                    if not _put(item):
+                        return
+            _put(done)
+        except Exception as e:
+            _put(e)
+
+    # 渲染线程继承调用方的上下文，耗时记录带上同一个请求ID
+    worker = threading.Thread(target=contextvars.copy_context().run, args=(_render,), name="pdf-render", daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = pages.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop_event.set()
+        worker.join(timeout=5)
+
+
 # images_name = pdf_convert_page_to_image("../01- What a Mess-已压缩.pdf")
 # print(images_name)
 